@@ -1,30 +1,328 @@
 import os
 import time
+import errno
 import shutil
 import hashlib
 import zipfile
 import json
+import re
+import struct
+import zlib
+import tempfile
+import tarfile
+import unicodedata
+import threading
+import secrets
+import base64
+import heapq
+import sqlite3
+import atexit
+import itertools
+import select
+import ctypes
+import ctypes.util
+from array import array
+from bisect import bisect_left, bisect_right
+from collections import OrderedDict, deque
+from concurrent.futures import ThreadPoolExecutor
+try:
+    import fcntl
+except ImportError:  # Windows
+    fcntl = None
 from pathlib import Path
-from io import BytesIO
-from flask import Flask, request, jsonify, send_from_directory, render_template, send_file
+from urllib.parse import quote, unquote
+from flask import Flask, request, jsonify, send_from_directory, render_template, send_file, Response
 from werkzeug.utils import secure_filename
 from datetime import datetime
 
 app = Flask(__name__)
 
 # 配置
-CHUNK_SIZE = 20 * 1024 * 1024  # 20MB分片
+CHUNK_SIZE = 20 * 1024 * 1024  # 20MB分片（客户端没有给出建议值时的默认大小）
 MAX_FILE_SIZE = 50 * 1024 * 1024 * 1024  # 50GB
 UPLOAD_FOLDER = 'uploads'
 CHUNK_FOLDER = 'chunks'
+ARCHIVE_CACHE_FOLDER = 'archive_cache'  # 文件夹打包结果的缓存目录
+ARCHIVE_CACHE_SIZE = 10 * 1024 * 1024 * 1024  # 打包缓存总大小上限（字节），0表示不缓存
+ARCHIVE_CACHE_MAX_ENTRY = 512 * 1024 * 1024  # 文件夹总大小超过该值时打包结果不缓存（字节）
+ZIP_READ_SIZE = 1024 * 1024  # 打包时读取源文件的块大小
+ZIP_FLUSH_SIZE = 512 * 1024  # 输出缓冲达到该大小才交给响应
+ZIP_COMPRESS_LEVEL = 6  # 默认压缩级别，下载时可用level参数指定（0表示全部直接存储）
+WORKER_THREADS = os.cpu_count() or 1  # 后台计算（打包压缩、分段摘要）的线程数
+ZIP_PIPELINE_BLOCKS = 2  # 每个压缩线程最多排队的块数，限制内存占用
+ZIP_SAMPLE_SIZE = 64 * 1024  # 抽样判断数据是否值得压缩
+ZIP_STORE_RATIO = 0.95  # 抽样压缩后仍大于原始大小的该比例时直接存储
+ZIP_STORED_EXTENSIONS = frozenset((  # 本身已经压缩的格式，直接存储
+    '.zip', '.gz', '.tgz', '.bz2', '.xz', '.7z', '.rar', '.zst', '.lz4',
+    '.jpg', '.jpeg', '.png', '.gif', '.webp', '.heic', '.heif', '.avif',
+    '.mp4', '.m4v', '.mov', '.mkv', '.webm', '.avi', '.wmv', '.flv',
+    '.mp3', '.m4a', '.aac', '.ogg', '.opus', '.flac', '.wma',
+    '.docx', '.xlsx', '.pptx', '.odt', '.ods', '.odp', '.epub', '.apk', '.jar', '.whl',
+))
+DOWNLOAD_SEGMENT_SIZE = 16 * 1024 * 1024  # 分段下载的默认段大小
+DOWNLOAD_MAX_SEGMENTS = 4096  # 单个文件最多分段数，超大文件相应放大段
+MANIFEST_CACHE_SIZE = 256  # 缓存分段清单的文件数量
+MANIFEST_WORKERS = 2  # 计算分段摘要的专用线程数，与打包压缩的线程池分开
+MANIFEST_INLINE_WAIT = 1  # 请求中等待清单计算完成的最长时间（秒），超时后返回202由客户端稍后再取
+BATCH_TOKEN_TTL = 300  # 批量下载令牌有效期（秒）
+LISTING_MAX_LIMIT = 5000  # 文件列表单页最多返回的条目数
+LISTING_CACHE_SIZE = 64  # 缓存排序结果的文件夹数量
+LISTING_SORT_KEYS = ('name', 'size', 'modified')
+UPLOAD_COPY_BUFFER = 4 * 1024 * 1024  # 写入分片时的缓冲区大小
+UPLOAD_MIN_CHUNK_SIZE = 1024 * 1024  # 分片大小下限（只有一个分片的小文件除外）
+UPLOAD_MAX_CHUNK_SIZE = 64 * 1024 * 1024  # 分片大小上限
+UPLOAD_MAX_CHUNKS = 1024  # 单个文件最多分片数，超大文件相应放大分片
+UPLOAD_MAX_PARALLEL = 4  # 建议客户端同时上传的分片数
+INSTANT_UPLOAD_HARDLINK = True  # 文件系统不支持reflink时秒传改用硬链接；两个路径共用同一inode，绕过API原地修改其中一个会同时改变另一个
+UPLOAD_FINISHED_TTL = 600  # 合并完成的上传标识在该时间内拒绝迟到的分片，不再重建暂存（秒）
+CHECK_BATCH_LIMIT = 10000  # 批量检查单次最多的文件数
+BATCH_OPERATION_LIMIT = 10000  # 批量文件操作单次最多的项目数
+UPLOAD_BUNDLE_MAX_SIZE = 256 * 1024 * 1024  # 小文件打包上传单个请求的最大字节数
+STAGING_TTL = 24 * 3600  # 暂存的上传超过该时间没有活动即被清理（秒）
+STAGING_QUOTA = 200 * 1024 * 1024 * 1024  # 暂存区总配额（字节），0表示不限制
+STAGING_SWEEP_INTERVAL = 600  # 后台清理暂存区的间隔（秒）
+JOB_WORKERS = 2  # 同时执行的后台任务（移动、复制、删除）数
+JOB_INLINE_WAIT = 2  # 请求中等待任务完成的最长时间（秒），超时后返回任务标识由客户端轮询
+JOB_RETENTION = 3600  # 已结束的任务保留多久（秒）
+SEARCH_SHARD_SIZE = 4096  # 搜索索引每个分片的条目数，修改后只重建所在分片
+SEARCH_DEFAULT_LIMIT = 100  # 搜索默认返回的结果数
+SEARCH_MAX_LIMIT = 1000  # 搜索单次最多返回的结果数
+CHANGE_LOG_SIZE = 10000  # 保留的最近变更事件数，更早的令牌要求客户端重新加载
+CHANGE_MAX_WAIT = 30  # 获取变更时最多等待新事件的时间（秒）
+CHANGE_STREAM_KEEPALIVE = 15  # 事件流没有变更时发送保活注释的间隔（秒）
+CHANGE_STREAM_LIMIT = 64  # 同时打开的事件流上限，超出时客户端改为轮询
+WATCH_UPLOAD_FOLDER = True  # 监视上传目录中绕过API的变更（Linux inotify）
+WATCH_BATCH_DELAY = 0.5  # 收到文件系统事件后等待多久再统一处理（秒）
+WATCH_RECONCILE_INTERVAL = 300  # 无法用inotify监视的文件夹定期比较mtime的间隔（秒）
+DIR_STATS_VERIFY_INTERVAL = 2  # 没有被监视的文件夹读取统计时逐层核对子文件夹mtime的最短间隔（秒）
+CATALOG_PATH = 'catalog.db'  # 元数据目录（SQLite），重启后不必重新遍历上传目录；为空表示不使用
+CATALOG_FLUSH_INTERVAL = 5  # 把变化写入元数据目录的间隔（秒）
+METRICS_ENABLED = True  # 统计请求和上传下载指标，通过/metrics以Prometheus文本格式导出
+METRICS_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 300)  # 耗时直方图的分桶上界（秒）
+UPLOAD_ID_PATTERN = re.compile(r'^[0-9A-Za-z_-]{1,128}$')
+DIGEST_PATTERN = re.compile(r'^[0-9a-f]{64}$')  # 内容摘要：sha256十六进制
+LEGACY_CHUNK_PATTERN = re.compile(r'^chunk_(\d+)$')
+TRANSIENT_NAME_PATTERN = re.compile(r'\.(?:[0-9a-f]{16}\.partial|[0-9a-f]{8}\.bundle|\d+\.clone)$')
+FICLONE = 0x40049409  # Linux reflink ioctl
 
 # 确保目录存在
 os.makedirs(UPLOAD_FOLDER, exist_ok=True)
 os.makedirs(CHUNK_FOLDER, exist_ok=True)
+os.makedirs(ARCHIVE_CACHE_FOLDER, exist_ok=True)
 
 app.config['MAX_CONTENT_LENGTH'] = MAX_FILE_SIZE
 app.config['UPLOAD_FOLDER'] = UPLOAD_FOLDER
 
+# 待下载的批量打包任务：令牌 -> (过期时间, 文件列表, 文件夹列表)
+batch_downloads = {}
+batch_downloads_lock = threading.Lock()
+
+
+# 运行指标：计数器、仪表和直方图常驻内存，/metrics请求时才格式化
+class Metrics:
+    """每次记录只是一次无竞争的加锁和字典更新，不做任何I/O，满负载时也可以一直开启
+
+    指标先用describe登记类型和说明；标签是 ((名称, 值), ...) 元组，取值范围要有限
+    （路由模板而不是实际路径）。需要现算的仪表（暂存区占用等）用gauge登记回调，导出时调用。
+    """
+
+    def __init__(self, enabled=True, buckets=METRICS_BUCKETS):
+        self.enabled = enabled
+        self.buckets = tuple(buckets)
+        self._lock = threading.Lock()
+        self._kinds = {}  # 名称 -> (类型, 说明)
+        self._series = {}  # 名称 -> {标签: 数值，直方图为[各桶计数..., 总和]}
+        self._callbacks = {}  # 名称 -> 返回数值的函数
+
+    def describe(self, name, kind, help_text):
+        self._kinds[name] = (kind, help_text)
+        self._series[name] = {}
+
+    def gauge(self, name, help_text, callback):
+        self.describe(name, 'gauge', help_text)
+        self._callbacks[name] = callback
+
+    def inc(self, name, value=1, labels=()):
+        if not self.enabled:
+            return
+        series = self._series[name]
+        with self._lock:
+            series[labels] = series.get(labels, 0) + value
+
+    def observe(self, name, value, labels=()):
+        if not self.enabled:
+            return
+        series = self._series[name]
+        index = bisect_left(self.buckets, value)
+        with self._lock:
+            counts = series.get(labels)
+            if counts is None:
+                counts = series[labels] = [0] * (len(self.buckets) + 1) + [0.0]
+            counts[index] += 1
+            counts[-1] += value
+
+    @staticmethod
+    def _escape(value):
+        return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+    @staticmethod
+    def _labels(labels, extra=None):
+        pairs = list(labels)
+        if extra:
+            pairs.append(extra)
+        if not pairs:
+            return ''
+        escaped = (f'{key}="{Metrics._escape(value)}"' for key, value in pairs)
+        return '{' + ','.join(escaped) + '}'
+
+    def render(self):
+        """Prometheus文本格式（0.0.4）"""
+        with self._lock:
+            snapshot = {name: {labels: (list(value) if isinstance(value, list) else value)
+                               for labels, value in series.items()}
+                        for name, series in self._series.items()}
+
+        for name, callback in self._callbacks.items():
+            try:
+                snapshot[name] = {(): callback()}
+            except Exception as e:
+                print(f"指标采集错误: {name}: {str(e)}")
+
+        lines = []
+        for name, (kind, help_text) in self._kinds.items():
+            lines.append(f'# HELP {name} {help_text}')
+            lines.append(f'# TYPE {name} {kind}')
+            for labels, value in sorted(snapshot[name].items()):
+                if kind != 'histogram':
+                    lines.append(f'{name}{self._labels(labels)} {value}')
+                    continue
+                cumulative = 0
+                for bound, count in zip(self.buckets + (float('inf'),), value):
+                    cumulative += count
+                    le = '+Inf' if bound == float('inf') else format(bound, 'g')
+                    lines.append(f'{name}_bucket{self._labels(labels, ("le", le))} {cumulative}')
+                lines.append(f'{name}_sum{self._labels(labels)} {value[-1]}')
+                lines.append(f'{name}_count{self._labels(labels)} {cumulative}')
+        return '\n'.join(lines) + '\n'
+
+
+metrics = Metrics(METRICS_ENABLED)
+metrics.describe('filefly_http_requests_total', 'counter', 'HTTP requests by route, method and status code.')
+metrics.describe('filefly_http_request_duration_seconds', 'histogram',
+                 'Time from receiving a request until its response body was fully sent, by route.')
+metrics.describe('filefly_http_requests_in_progress', 'gauge', 'Requests currently being handled.')
+metrics.describe('filefly_http_received_bytes_total', 'counter', 'Request body bytes received, by route.')
+metrics.describe('filefly_http_sent_bytes_total', 'counter', 'Response body bytes sent, by route.')
+metrics.describe('filefly_upload_chunks_total', 'counter', 'Uploaded chunks by result (written, duplicate, error).')
+metrics.describe('filefly_upload_chunk_write_seconds', 'histogram', 'Time to receive and write one chunk.')
+metrics.describe('filefly_upload_chunk_writes_in_progress', 'gauge', 'Chunks currently being written.')
+metrics.describe('filefly_upload_merge_seconds', 'histogram',
+                 'Time to finalize an upload, by mode (offset: rename, legacy: copy chunks).')
+metrics.describe('filefly_zip_builds_total', 'counter', 'ZIP streams by result (complete, aborted).')
+metrics.describe('filefly_zip_build_seconds', 'histogram', 'Time to build and send a complete ZIP stream.')
+metrics.describe('filefly_zip_bytes_total', 'counter', 'Bytes of ZIP data produced.')
+metrics.describe('filefly_archive_cache_requests_total', 'counter', 'Folder downloads by archive cache result (hit, miss).')
+
+
+class MetricsMiddleware:
+    """包在app.wsgi_app外层，按路由统计请求数、耗时和收发字节数
+
+    耗时和发送字节数在响应体发送完、服务器调用close时才记录，流式下载和打包也能统计完整。
+    send_file返回的wsgi.file_wrapper原样交回服务器（保留sendfile零拷贝），
+    只替换它的close，发送字节数按Content-Length计。
+    """
+
+    def __init__(self, wsgi_app):
+        self.wsgi_app = wsgi_app
+
+    def __call__(self, environ, start_response):
+        started = time.perf_counter()
+        state = [None, None]  # 状态码, Content-Length
+
+        def metered_start_response(status, headers, exc_info=None):
+            state[0] = status[:3]
+            for key, value in headers:
+                if key.lower() == 'content-length':
+                    state[1] = value
+            return start_response(status, headers, exc_info)
+
+        metrics.inc('filefly_http_requests_in_progress')
+        try:
+            result = self.wsgi_app(environ, metered_start_response)
+        except Exception:
+            state[0] = '500'
+            self._finish(environ, state, started, 0)
+            raise
+
+        def finish(sent):
+            self._finish(environ, state, started, sent)
+
+        file_wrapper = environ.get('wsgi.file_wrapper')
+        if isinstance(file_wrapper, type) and isinstance(result, file_wrapper):
+            close = getattr(result, 'close', None)
+
+            def close_file_wrapper():
+                try:
+                    if close:
+                        close()
+                finally:
+                    finish(int(state[1] or 0))
+
+            result.close = close_file_wrapper
+            return result
+        return MeteredBody(result, finish)
+
+    @staticmethod
+    def _finish(environ, state, started, sent):
+        elapsed = time.perf_counter() - started
+        route = (('route', environ.get('filefly.route') or 'unmatched'),)
+        metrics.inc('filefly_http_requests_in_progress', -1)
+        metrics.inc('filefly_http_requests_total',
+                    labels=route + (('method', environ.get('REQUEST_METHOD', '')), ('code', state[0] or '500')))
+        metrics.observe('filefly_http_request_duration_seconds', elapsed, route)
+        try:
+            received = int(environ.get('CONTENT_LENGTH') or 0)
+        except ValueError:
+            received = 0
+        if received:
+            metrics.inc('filefly_http_received_bytes_total', received, route)
+        if sent:
+            metrics.inc('filefly_http_sent_bytes_total', sent, route)
+
+
+class MeteredBody:
+    """转发响应体并累计发送的字节数，close时（无论是否发送完）调用一次finish(已发送字节数)"""
+
+    def __init__(self, result, finish):
+        self.result = result
+        self.finish = finish
+        self.sent = 0
+
+    def __iter__(self):
+        for data in self.result:
+            self.sent += len(data)
+            yield data
+
+    def close(self):
+        finish, self.finish = self.finish, None
+        if finish is None:
+            return
+        try:
+            if hasattr(self.result, 'close'):
+                self.result.close()
+        finally:
+            finish(self.sent)
+
+
+if METRICS_ENABLED:
+    app.wsgi_app = MetricsMiddleware(app.wsgi_app)
+
+
+# 请求按路由模板（而不是实际路径）统计，指标的标签数量有限
+@app.before_request
+def tag_request_route():
+    request.environ['filefly.route'] = request.url_rule.rule if request.url_rule else None
+
 
 # 辅助函数：安全地处理相对路径
 def safe_relative_path(rel_path):
@@ -54,58 +352,1846 @@ def safe_relative_path(rel_path):
         return None
 
 
-# 辅助函数：获取指定路径的目录树
-def get_directory_tree(base_path, target_path=None):
-    """获取指定路径的目录树结构"""
-    if target_path:
-        full_path = safe_relative_path(target_path)
-        if not full_path or not os.path.isdir(full_path):
-            return []
-        current_path = full_path
-    else:
-        current_path = base_path
-
-    tree = []
-
-    try:
-        # 获取当前路径信息
-        rel_current = os.path.relpath(current_path, base_path)
-        if rel_current == '.':
-            rel_current = ''
-
-        for item in os.listdir(current_path):
-            item_path = os.path.join(current_path, item)
-            rel_path = os.path.relpath(item_path, base_path)
-
-            if os.path.isfile(item_path):
-                stat = os.stat(item_path)
-                tree.append({
-                    'name': item,
-                    'path': rel_path.replace('\\', '/'),  # 统一使用正斜杠
-                    'type': 'file',
-                    'size': stat.st_size,
-                    'modified': datetime.fromtimestamp(stat.st_mtime).isoformat(),
-                    'url': f'/download/{rel_path.replace("\\", "/")}'
-                })
-            elif os.path.isdir(item_path):
-                # 统计子文件夹中的文件数量
-                file_count = sum([len(files) for _, _, files in os.walk(item_path)])
-                tree.append({
-                    'name': item,
-                    'path': rel_path.replace('\\', '/'),
-                    'type': 'folder',
-                    'size': 0,
+# 辅助函数：两个绝对路径相同，或其中一个位于另一个之下
+def paths_overlap(a, b):
+    return a == b or a.startswith(b + os.sep) or b.startswith(a + os.sep)
+
+
+# 目录统计索引：缓存每个文件夹的递归文件数和总大小
+class DirStatsIndex:
+    """缓存每个文件夹的递归文件数和总大小，避免每次列表都os.walk整棵子树
+
+    每个文件夹记录自身的mtime、直接包含的文件数和大小、子文件夹以及递归合计。读取时比较
+    该文件夹自身的mtime，变化了才重新扫描这一层（子文件夹直接使用缓存值），并把合计的差值
+    加到已缓存的上级文件夹上。通过API产生的变更由record_*系列函数主动更新。
+
+    被inotify监视的文件夹，更深层的外部变更由监视线程经record_external_changes校正。没有被监视时
+    （非Linux、关闭了监视或超出监视数上限），读取时还要逐层比较已缓存子文件夹的mtime，重新扫描
+    有变化的那些；同一文件夹在DIR_STATS_VERIFY_INTERVAL秒内只核对一次。这种方式发现不了原地改写
+    已有文件造成的大小变化（所在文件夹的mtime不变），要等该文件夹中有文件增删后才反映出来。
+    """
+
+    def __init__(self, root):
+        self.root = os.path.abspath(root)
+        self._entries = {}
+        self._lock = threading.RLock()
+        self._dirty = None  # 启用元数据目录后记录有变化的文件夹，定期写入
+
+    def track_changes(self):
+        """开始记录变化，已经缓存的文件夹都视为有变化"""
+        with self._lock:
+            if self._dirty is None:
+                self._dirty = set(self._entries)
+
+    def take_changes(self):
+        """返回上次调用之后有变化的文件夹：[(路径, 统计或None)]，None表示已不再缓存"""
+        with self._lock:
+            if not self._dirty:
+                return []
+            changes = []
+            for key in self._dirty:
+                entry = self._entries.get(key)
+                changes.append((key, None if entry is None else (
+                    entry['mtime_ns'], entry['own_files'], entry['own_size'],
+                    entry['file_count'], entry['total_size'])))
+            self._dirty = set()
+            return changes
+
+    def _mark(self, key):
+        if self._dirty is not None:
+            self._dirty.add(key)
+
+    def load(self, rows):
+        """从元数据目录载入统计，rows为 (路径, mtime_ns, 直接文件数, 直接文件大小, 递归文件数, 递归总大小)
+
+        已经在内存中计算过的文件夹保持不变。
+        """
+        with self._lock:
+            loaded = {}
+            for path, mtime_ns, own_files, own_size, file_count, total_size in rows:
+                if path in self._entries:
+                    continue
+                loaded[path] = {
+                    'mtime_ns': mtime_ns,
+                    'own_files': own_files,
+                    'own_size': own_size,
+                    'subdirs': [],
                     'file_count': file_count,
-                    'modified': datetime.fromtimestamp(os.path.getmtime(item_path)).isoformat(),
-                    'url': f'/browse/{rel_path.replace("\\", "/")}'
-                })
-    except Exception as e:
-        print(f"Error reading directory {current_path}: {e}")
+                    'total_size': total_size,
+                }
+            for path in loaded:
+                parent = loaded.get(os.path.dirname(path)) if path != self.root else None
+                if parent is not None:
+                    parent['subdirs'].append(path)
+            self._entries.update(loaded)
+            return len(loaded)
+
+    def get(self, path):
+        """返回文件夹的 (递归文件数, 递归总大小)，按mtime惰性校正"""
+        key = os.path.abspath(path)
+        try:
+            mtime_ns = os.stat(key).st_mtime_ns
+        except OSError:
+            return 0, 0
+
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None or entry['mtime_ns'] != mtime_ns:
+                self._refresh(key)
+                entry = self._entries.get(key)
+            if entry is None:
+                return 0, 0
+            if not fs_watcher.covers(key):
+                self._verify(key)
+                entry = self._entries.get(key)
+            return entry['file_count'], entry['total_size']
+
+    def _verify(self, key):
+        """比较已缓存子树中各文件夹的mtime，从深到浅重新扫描有变化的文件夹"""
+        now = time.monotonic()
+        stale = []
+        stack = [key]
+        while stack:
+            path = stack.pop()
+            entry = self._entries.get(path)
+            # 最近核对过的文件夹连同其子树一起跳过
+            if entry is None or now - entry.get('verified', 0) < DIR_STATS_VERIFY_INTERVAL:
+                continue
+            entry['verified'] = now
+            try:
+                mtime_ns = os.stat(path).st_mtime_ns
+            except OSError:
+                # 已被删除，上级重新扫描时清理
+                continue
+            if mtime_ns != entry['mtime_ns']:
+                stale.append(path)
+            stack.extend(entry['subdirs'])
+
+        # 子文件夹的路径总比上级长，按长度倒序即先处理深层
+        for path in sorted(stale, key=len, reverse=True):
+            if path in self._entries:
+                self._refresh(path)
+
+    def file_changed(self, path, files_delta, size_delta):
+        """文件新建、覆盖或删除后增量更新所在文件夹及其上级"""
+        parent = os.path.dirname(os.path.abspath(path))
+        with self._lock:
+            entry = self._entries.get(parent)
+            if entry is None:
+                if self._has_cached_ancestor(parent):
+                    self._refresh(parent)
+                return
+
+            entry['own_files'] += files_delta
+            entry['own_size'] += size_delta
+            self._mark(parent)
+            try:
+                entry['mtime_ns'] = os.stat(parent).st_mtime_ns
+            except OSError:
+                pass
+            self._propagate(parent, files_delta, size_delta)
+
+    def refresh(self, path):
+        """重新扫描一个文件夹的这一层（文件夹新建、删除后调用），差值传递给上级"""
+        key = os.path.abspath(path)
+        with self._lock:
+            if key in self._entries or self._has_cached_ancestor(key):
+                self._refresh(key)
+
+    def moved(self, source, target):
+        """文件夹移动或重命名：缓存整体换到新路径下，再校正新旧两个上级"""
+        source = os.path.abspath(source)
+        target = os.path.abspath(target)
+        with self._lock:
+            prefix = source + os.sep
+            for key in [k for k in self._entries if k == source or k.startswith(prefix)]:
+                entry = self._entries.pop(key)
+                new_key = target + key[len(source):]
+                entry['subdirs'] = [target + d[len(source):] for d in entry['subdirs']]
+                self._entries[new_key] = entry
+                self._mark(key)
+                self._mark(new_key)
+
+        self.refresh(os.path.dirname(source))
+        if os.path.dirname(source) != os.path.dirname(target):
+            self.refresh(os.path.dirname(target))
+
+    def _has_cached_ancestor(self, key):
+        while key != self.root and len(key) > len(self.root):
+            key = os.path.dirname(key)
+            if key in self._entries:
+                return True
+        return False
+
+    def _propagate(self, key, files_delta, size_delta):
+        if not files_delta and not size_delta:
+            return
+        while True:
+            entry = self._entries.get(key)
+            if entry is not None:
+                entry['file_count'] += files_delta
+                entry['total_size'] += size_delta
+                self._mark(key)
+            if key == self.root or len(key) <= len(self.root):
+                break
+            key = os.path.dirname(key)
+
+    def _purge(self, key):
+        prefix = key + os.sep
+        for stale in [k for k in self._entries if k == key or k.startswith(prefix)]:
+            del self._entries[stale]
+            self._mark(stale)
+
+    def _refresh(self, key):
+        old = self._entries.pop(key, None)
+        self._mark(key)
+        self._build(key)
+        new = self._entries.get(key)
+
+        if old is not None:
+            # 这一层消失的子文件夹不再有用
+            current = set(new['subdirs']) if new else set()
+            for subdir in old['subdirs']:
+                if subdir not in current:
+                    self._purge(subdir)
+        if new is None:
+            self._purge(key)
+
+        files_delta = (new['file_count'] if new else 0) - (old['file_count'] if old else 0)
+        size_delta = (new['total_size'] if new else 0) - (old['total_size'] if old else 0)
+        parent = os.path.dirname(key)
+        if key != self.root and len(parent) >= len(self.root):
+            self._propagate(parent, files_delta, size_delta)
+
+    @staticmethod
+    def _scan(path):
+        """扫描一层：返回 (mtime_ns, 直接文件数, 直接文件大小, 子文件夹列表)"""
+        own_files = 0
+        own_size = 0
+        subdirs = []
+        mtime_ns = os.stat(path).st_mtime_ns
+        with os.scandir(path) as it:
+            for item in it:
+                try:
+                    if item.is_dir(follow_symlinks=False):
+                        subdirs.append(item.path)
+                    else:
+                        own_files += 1
+                        if item.is_file():
+                            own_size += item.stat().st_size
+                except OSError:
+                    continue
+        return mtime_ns, own_files, own_size, subdirs
+
+    def _build(self, key):
+        """后序遍历计算key及其尚未缓存的子文件夹，避免深层目录导致递归过深"""
+        stack = [(key, None)]
+        while stack:
+            path, scan = stack.pop()
+            if scan is None:
+                try:
+                    scan = self._scan(path)
+                except OSError:
+                    continue
+                missing = [d for d in scan[3] if d not in self._entries]
+                if missing:
+                    stack.append((path, scan))
+                    stack.extend((d, None) for d in missing)
+                    continue
+
+            mtime_ns, own_files, own_size, subdirs = scan
+            children = [self._entries[d] for d in subdirs if d in self._entries]
+            self._mark(path)
+            self._entries[path] = {
+                'mtime_ns': mtime_ns,
+                'own_files': own_files,
+                'own_size': own_size,
+                'subdirs': [d for d in subdirs if d in self._entries],
+                'file_count': own_files + sum(c['file_count'] for c in children),
+                'total_size': own_size + sum(c['total_size'] for c in children),
+            }
+
+
+dir_stats = DirStatsIndex(UPLOAD_FOLDER)
+
+
+# 内容寻址索引：sha256摘要 -> 上传目录中内容相同的文件
+class ContentIndex:
+    """记录通过API写入的文件的内容摘要，用于秒传
+
+    每个路径同时记下登记时的大小和mtime，查找时重新stat核对，被API之外修改过的文件会被剔除。
+    移动、重命名和删除通过record_*系列函数同步。
+    """
+
+    def __init__(self):
+        self._by_digest = {}  # 摘要 -> {绝对路径: (大小, mtime_ns)}
+        self._by_path = {}  # 绝对路径 -> 摘要
+        self._lock = threading.Lock()
+
+    def add(self, path, digest):
+        key = os.path.abspath(path)
+        try:
+            stat = os.stat(key)
+        except OSError:
+            return
+        with self._lock:
+            self._discard(key)
+            self._by_digest.setdefault(digest, {})[key] = (stat.st_size, stat.st_mtime_ns)
+            self._by_path[key] = digest
+
+    def load(self, rows):
+        """从元数据目录载入记录，rows为 (绝对路径, 摘要, 大小, mtime_ns)，查找时照常核对"""
+        with self._lock:
+            for path, digest, size, mtime_ns in rows:
+                if path not in self._by_path:
+                    self._by_digest.setdefault(digest, {})[path] = (size, mtime_ns)
+                    self._by_path[path] = digest
+
+    def digest_of(self, path):
+        """返回文件登记的摘要；登记后被API之外修改过时返回None"""
+        key = os.path.abspath(path)
+        with self._lock:
+            digest = self._by_path.get(key)
+            recorded = self._by_digest[digest].get(key) if digest else None
+        if not recorded:
+            return None
+        try:
+            stat = os.stat(key)
+        except OSError:
+            return None
+        return digest if (stat.st_size, stat.st_mtime_ns) == recorded else None
+
+    def lookup(self, digest, size):
+        """返回内容为digest且大小为size的现存文件路径"""
+        with self._lock:
+            candidates = list(self._by_digest.get(digest, {}).items())
+
+        for path, (recorded_size, mtime_ns) in candidates:
+            try:
+                stat = os.stat(path)
+            except OSError:
+                stat = None
+            if stat and stat.st_size == recorded_size == size and stat.st_mtime_ns == mtime_ns:
+                return path
+            if not stat or stat.st_size != recorded_size or stat.st_mtime_ns != mtime_ns:
+                with self._lock:
+                    self._discard(path)
+        return None
+
+    @staticmethod
+    def _root_of(key, roots):
+        """key本身或其上级在roots中时返回该路径，否则返回None"""
+        path = key
+        while True:
+            if path in roots:
+                return path
+            parent = os.path.dirname(path)
+            if parent == path:
+                return None
+            path = parent
+
+    def remove(self, *paths):
+        """删除路径（文件夹时包括其下所有文件）的记录，多个路径只遍历一次"""
+        roots = {os.path.abspath(p) for p in paths}
+        with self._lock:
+            for stale in [p for p in self._by_path if self._root_of(p, roots)]:
+                self._discard(stale)
+
+    def moved(self, source, target):
+        self.moved_many([(source, target)])
+
+    def moved_many(self, pairs):
+        """批量同步移动，pairs为 (源, 目标) 列表，只遍历一次"""
+        mapping = {os.path.abspath(source): os.path.abspath(target) for source, target in pairs}
+        with self._lock:
+            for old in list(self._by_path):
+                source = self._root_of(old, mapping)
+                if not source:
+                    continue
+                digest = self._by_path.pop(old)
+                paths = self._by_digest[digest]
+                new = mapping[source] + old[len(source):]
+                paths[new] = paths.pop(old)
+                self._by_path[new] = digest
+
+    def _discard(self, key):
+        digest = self._by_path.pop(key, None)
+        if digest is not None:
+            paths = self._by_digest.get(digest, {})
+            paths.pop(key, None)
+            if not paths:
+                self._by_digest.pop(digest, None)
+
+
+content_index = ContentIndex()
+
+
+# 文件名搜索索引：整个上传目录的文件名常驻内存，按前缀、子串和扩展名查找
+class SearchIndex:
+    """记录上传目录中所有文件和文件夹的名称，查询不访问文件系统
+
+    每个条目占一个槽位，记录所在文件夹的编号、名称和类型；文件夹编号对应其相对路径，
+    移动文件夹时只需改写子树中文件夹的路径，文件的槽位不变。槽位按SEARCH_SHARD_SIZE分片，
+    每片把小写名称用换行连接成一个字符串，查询时用str.find在整片上查找，再用二分定位到条目，
+    只有命中的条目才在Python中检查其余条件。修改只让所在分片的字符串失效，下次查询时重建。
+    启动后在后台线程中遍历一次上传目录，之后由record_*系列函数增量更新。
+    """
+
+    def __init__(self, root, shard_size=SEARCH_SHARD_SIZE):
+        self.root = os.path.abspath(root)
+        self.shard_size = shard_size
+        self.ready = False
+        self.thread = None
+        self._lock = threading.RLock()
+        self._dirs = {'': 0}  # 文件夹相对路径 -> 编号
+        self._dir_paths = ['']  # 编号 -> 文件夹相对路径，已删除为None
+        self._children = [{}]  # 编号 -> {名称: 槽位}
+        self._free_dirs = []
+        self._slot_dirs = array('l')  # 槽位 -> 所在文件夹编号，空槽位为-1
+        self._slot_names = []  # 槽位 -> 名称，空槽位为None
+        self._slot_is_dir = bytearray()
+        self._free_slots = []
+        self._shards = []  # 分片 -> (连接后的字符串, 各条目起始位置, 小写名称) 或 None
+
+    @staticmethod
+    def fold(text):
+        """查询和索引共用的大小写和Unicode规范化"""
+        return unicodedata.normalize('NFC', text).lower().replace('\n', ' ')
+
+    def _relative(self, path):
+        rel_path = os.path.relpath(os.path.abspath(path), self.root)
+        if rel_path == '.':
+            return ''
+        if rel_path == '..' or rel_path.startswith('..' + os.sep):
+            return None
+        return rel_path.replace(os.sep, '/')
+
+    def _new_slot(self, dir_id, name, is_dir):
+        if self._free_slots:
+            slot = self._free_slots.pop()
+            self._slot_dirs[slot] = dir_id
+            self._slot_names[slot] = name
+            self._slot_is_dir[slot] = is_dir
+        else:
+            slot = len(self._slot_names)
+            self._slot_dirs.append(dir_id)
+            self._slot_names.append(name)
+            self._slot_is_dir.append(is_dir)
+            if slot // self.shard_size >= len(self._shards):
+                self._shards.append(None)
+        self._shards[slot // self.shard_size] = None
+        return slot
+
+    def _free_slot(self, slot):
+        self._slot_dirs[slot] = -1
+        self._slot_names[slot] = None
+        self._slot_is_dir[slot] = 0
+        self._free_slots.append(slot)
+        self._shards[slot // self.shard_size] = None
+
+    def _ensure_dir(self, rel_path):
+        """返回文件夹的编号，缺少的上级文件夹一并登记"""
+        missing = []
+        current = rel_path
+        while current not in self._dirs:
+            missing.append(current)
+            current = current.rpartition('/')[0]
+
+        dir_id = self._dirs[current]
+        for path in reversed(missing):
+            name = path.rpartition('/')[2]
+            old_slot = self._children[dir_id].get(name)
+            if old_slot is not None:
+                self._free_slot(old_slot)
+            self._children[dir_id][name] = self._new_slot(dir_id, name, 1)
+            dir_id = self._free_dirs.pop() if self._free_dirs else len(self._dir_paths)
+            if dir_id == len(self._dir_paths):
+                self._dir_paths.append(path)
+                self._children.append({})
+            else:
+                self._dir_paths[dir_id] = path
+                self._children[dir_id] = {}
+            self._dirs[path] = dir_id
+        return dir_id
+
+    def _subtree(self, dir_id):
+        """文件夹及其下所有文件夹的编号"""
+        result = [dir_id]
+        stack = [dir_id]
+        while stack:
+            current = stack.pop()
+            prefix = self._dir_paths[current] + '/' if self._dir_paths[current] else ''
+            for name, slot in self._children[current].items():
+                if self._slot_is_dir[slot]:
+                    child = self._dirs.get(prefix + name)
+                    if child is not None:
+                        result.append(child)
+                        stack.append(child)
+        return result
+
+    def _drop_dir(self, rel_path):
+        dir_id = self._dirs.get(rel_path)
+        if dir_id is None:
+            return
+        for current in self._subtree(dir_id):
+            for slot in self._children[current].values():
+                self._free_slot(slot)
+            del self._dirs[self._dir_paths[current]]
+            self._dir_paths[current] = None
+            self._children[current] = {}
+            self._free_dirs.append(current)
+
+    def _unlink(self, rel_path):
+        """从上级文件夹中摘除条目，返回 (是否存在, 是否文件夹)"""
+        parent, _, name = rel_path.rpartition('/')
+        parent_id = self._dirs.get(parent)
+        slot = self._children[parent_id].pop(name, None) if parent_id is not None else None
+        if slot is None:
+            return False, False
+        is_dir = bool(self._slot_is_dir[slot])
+        self._free_slot(slot)
+        return True, is_dir
+
+    def _add(self, rel_path, is_dir):
+        if not rel_path:
+            return
+        if is_dir:
+            self._ensure_dir(rel_path)
+            return
+        parent, _, name = rel_path.rpartition('/')
+        parent_id = self._ensure_dir(parent)
+        slot = self._children[parent_id].get(name)
+        if slot is not None:
+            if not self._slot_is_dir[slot]:
+                return
+            # 同名文件夹被文件替换
+            self._unlink(rel_path)
+            self._drop_dir(rel_path)
+        self._children[parent_id][name] = self._new_slot(parent_id, name, 0)
+
+    def add(self, path, is_dir=False):
+        rel_path = self._relative(path)
+        if rel_path is not None:
+            with self._lock:
+                self._add(rel_path, is_dir)
+
+    def add_tree(self, path):
+        """登记路径本身以及文件夹下的所有内容，每扫描一层持锁一次"""
+        rel_path = self._relative(path)
+        if rel_path is None or not os.path.lexists(path):
+            return
+        stack = [(os.path.abspath(path), rel_path)]
+        if os.path.isdir(path) and not os.path.islink(path):
+            with self._lock:
+                self._add(rel_path, True)
+        else:
+            self.add(path, False)
+            return
+
+        while stack:
+            full_path, rel_dir = stack.pop()
+            prefix = rel_dir + '/' if rel_dir else ''
+            with self._lock:
+                try:
+                    with os.scandir(full_path) as it:
+                        for item in it:
+                            try:
+                                is_dir = item.is_dir(follow_symlinks=False)
+                            except OSError:
+                                continue
+                            self._add(prefix + item.name, is_dir)
+                            if is_dir:
+                                stack.append((item.path, prefix + item.name))
+                except OSError:
+                    continue
+
+    def remove(self, path):
+        rel_path = self._relative(path)
+        if not rel_path:
+            return
+        with self._lock:
+            if self._unlink(rel_path)[1]:
+                self._drop_dir(rel_path)
+
+    def sync_dir(self, path):
+        """按文件系统校正一个文件夹的直接条目，返回 (新增, 消失) 的 [(名称, 是否文件夹)]
+
+        名称不变但类型改变（文件换成同名文件夹）的条目同时出现在两个列表中。
+        """
+        rel_path = self._relative(path)
+        if rel_path is None:
+            return [], []
+        actual = {}
+        try:
+            with os.scandir(path) as it:
+                for item in it:
+                    try:
+                        if not is_transient_name(item.name):
+                            actual[item.name] = item.is_dir(follow_symlinks=False)
+                    except OSError:
+                        continue
+        except OSError:
+            # 文件夹本身已不存在，由上级文件夹校正
+            return [], []
+
+        with self._lock:
+            dir_id = self._dirs.get(rel_path)
+            known = {}
+            if dir_id is not None:
+                known = {name: bool(self._slot_is_dir[slot]) for name, slot in self._children[dir_id].items()}
+            added = [(name, is_dir) for name, is_dir in actual.items() if known.get(name) != is_dir]
+            removed = [(name, is_dir) for name, is_dir in known.items() if actual.get(name) != is_dir]
+
+            prefix = rel_path + '/' if rel_path else ''
+            for name, is_dir in removed:
+                self._unlink(prefix + name)
+                if is_dir:
+                    self._drop_dir(prefix + name)
+            for name, is_dir in added:
+                if not is_dir:
+                    self._add(prefix + name, False)
+
+        for name, is_dir in added:
+            if is_dir:
+                self.add_tree(os.path.join(path, name))
+        return added, removed
+
+    def moved(self, source, target):
+        source_rel = self._relative(source)
+        target_rel = self._relative(target)
+        if target_rel is None:
+            self.remove(source)
+            return
+
+        with self._lock:
+            is_dir = self._unlink(source_rel)[1] if source_rel else False
+            dir_id = self._dirs.get(source_rel) if is_dir else None
+            if dir_id is None:
+                found = False
+            else:
+                # 子树中的文件夹换到新路径下，文件的槽位保持不变
+                found = True
+                self._unlink(target_rel)
+                self._drop_dir(target_rel)
+                subtree = self._subtree(dir_id)
+                for current in subtree:
+                    del self._dirs[self._dir_paths[current]]
+                for current in subtree:
+                    new_path = target_rel + self._dir_paths[current][len(source_rel):]
+                    self._dir_paths[current] = new_path
+                    self._dirs[new_path] = current
+                parent, _, name = target_rel.rpartition('/')
+                parent_id = self._ensure_dir(parent)
+                self._children[parent_id][name] = self._new_slot(parent_id, name, 1)
+
+        # 源不在索引中（如初次遍历尚未到达），或遍历还在进行时，直接扫描目标
+        if not found or not self.ready:
+            self.add_tree(target)
+
+    def _shard(self, number):
+        shard = self._shards[number]
+        if shard is None:
+            start = number * self.shard_size
+            names = self._slot_names[start:start + self.shard_size]
+            lowered = [self.fold(name) if name is not None else '' for name in names]
+            starts = array('l')
+            position = 1
+            for name in lowered:
+                starts.append(position)
+                position += len(name) + 1
+            starts.append(position)
+            shard = ('\n' + '\n'.join(lowered) + '\n', starts, lowered)
+            self._shards[number] = shard
+        return shard
+
+    def search(self, query=None, prefix=None, extensions=(), scope='', item_type=None, limit=100):
+        """返回最多limit个 (所在文件夹相对路径, 名称, 是否文件夹)，以及是否还有更多结果
+
+        query为名称中包含的子串，prefix为名称前缀，extensions为不带点的扩展名列表，
+        scope限定在某个文件夹下，item_type为file或folder。名称比较不区分大小写。
+        """
+        query = self.fold(query) if query else None
+        prefix = self.fold(prefix) if prefix else None
+        suffixes = tuple('.' + self.fold(ext).lstrip('.') for ext in extensions if ext.strip('.'))
+        if prefix:
+            needles, offset = ['\n' + prefix], 1
+        elif query:
+            needles, offset = [query], 0
+        elif suffixes:
+            needles, offset = [suffix + '\n' for suffix in suffixes], 0
+        else:
+            return [], False
+
+        results = []
+        with self._lock:
+            scope_ids = None
+            if scope:
+                scope_id = self._dirs.get(scope)
+                if scope_id is None:
+                    return [], False
+                scope_ids = set(self._subtree(scope_id))
+
+            for number in range(len(self._shards)):
+                blob, starts, lowered = self._shard(number)
+                base = number * self.shard_size
+                hits = []
+                for needle in needles:
+                    position = blob.find(needle)
+                    while position != -1:
+                        index = bisect_right(starts, position + offset) - 1
+                        hits.append(index)
+                        position = blob.find(needle, starts[index + 1] - 1)
+                if len(needles) > 1:
+                    hits = sorted(set(hits))
+
+                for index in hits:
+                    name = lowered[index]
+                    slot = base + index
+                    is_dir = self._slot_is_dir[slot]
+                    if query and query not in name:
+                        continue
+                    if prefix and not name.startswith(prefix):
+                        continue
+                    if suffixes and (is_dir or not name.endswith(suffixes)):
+                        continue
+                    if item_type and (item_type == 'folder') != bool(is_dir):
+                        continue
+                    dir_id = self._slot_dirs[slot]
+                    if scope_ids is not None and dir_id not in scope_ids:
+                        continue
+                    if len(results) == limit:
+                        return results, True
+                    results.append((self._dir_paths[dir_id], self._slot_names[slot], bool(is_dir)))
+        return results, False
+
+    def stats(self):
+        with self._lock:
+            return {
+                'ready': self.ready,
+                'entries': len(self._slot_names) - len(self._free_slots),
+                'folders': len(self._dirs) - 1,
+            }
+
+    def load(self, rows, batch=10000):
+        """从元数据目录载入条目，rows为按所在文件夹排序的 (文件夹相对路径, 名称, 是否文件夹)
+
+        每批持锁一次，载入期间的查询和修改不会长时间等待。
+        """
+        rows = iter(rows)
+        count = 0
+        while True:
+            chunk = list(itertools.islice(rows, batch))
+            if not chunk:
+                return count
+            with self._lock:
+                current, parent_id = None, None
+                for parent, name, is_dir in chunk:
+                    if parent != current:
+                        current, parent_id = parent, self._ensure_dir(parent)
+                    if is_dir:
+                        self._ensure_dir(f'{parent}/{name}' if parent else name)
+                    elif name not in self._children[parent_id]:
+                        self._children[parent_id][name] = self._new_slot(parent_id, name, 0)
+            count += len(chunk)
+
+    def start(self):
+        with self._lock:
+            if self.thread:
+                return
+            self.thread = threading.Thread(target=self.build, name='search-indexer', daemon=True)
+        self.thread.start()
+
+    def build(self, loader=None):
+        """遍历上传目录建立索引；给出loader时改为调用loader()载入"""
+        started = time.time()
+        try:
+            if loader:
+                loader()
+            else:
+                self.add_tree(self.root)
+            self.prepare()
+        except Exception as e:
+            print(f"搜索索引构建错误: {str(e)}")
+        self.ready = True
+        stats = self.stats()
+        print(f"搜索索引就绪: {stats['entries']} 个条目, 用时 {time.time() - started:.1f}秒")
+
+    def prepare(self):
+        """提前生成所有分片，第一次查询不必等待"""
+        with self._lock:
+            for number in range(len(self._shards)):
+                self._shard(number)
+
+
+search_index = SearchIndex(UPLOAD_FOLDER)
+
+
+# 变更日志：通过API产生的文件变更按顺序编号，客户端凭令牌获取之后的变更，增量更新列表
+class ChangeLog:
+    """保留最近的变更事件，令牌由进程标识和序号组成
+
+    服务重启后进程标识变化，旧令牌、或者早于保留范围的令牌都要求客户端重新加载列表。
+    等待新变更的请求阻塞在条件变量上，没有变更时不占用CPU。
+    """
+
+    def __init__(self, max_events=CHANGE_LOG_SIZE):
+        self.epoch = secrets.token_hex(4)
+        self.seq = 0
+        self.streams = 0  # 当前打开的事件流数
+        self._events = deque(maxlen=max_events)
+        self._cond = threading.Condition()
+
+    @property
+    def token(self):
+        return self.token_for(self.seq)
+
+    def token_for(self, seq):
+        return f'{self.epoch}.{seq}'
+
+    def parse(self, token):
+        """返回令牌对应的序号；令牌无效、来自之前的进程或已超出保留范围时返回None"""
+        epoch, _, seq = (token or '').partition('.')
+        if epoch != self.epoch or not seq.isdigit():
+            return None
+        seq = int(seq)
+        with self._cond:
+            oldest = self._events[0]['seq'] - 1 if self._events else self.seq
+            if seq < oldest or seq > self.seq:
+                return None
+        return seq
+
+    def append(self, changes):
+        """changes为 [(操作, 路径, 原路径, 是否文件夹)]，操作为create/modify/move/delete"""
+        events = []
+        for op, path, old_path, is_dir in changes:
+            if op == 'delete' and os.path.lexists(path):
+                # 取消或失败的删除只删除了一部分
+                op = 'modify'
+            entry = None
+            if op != 'delete':
+                try:
+                    rel_path = upload_relative(path)
+                    entry = make_entry(os.path.dirname(path), rel_path.rpartition('/')[0],
+                                       os.path.basename(path), is_dir)
+                except OSError:
+                    continue
+            events.append({
+                'op': op,
+                'path': upload_relative(path),
+                'old_path': upload_relative(old_path) if old_path else None,
+                'type': 'folder' if is_dir else 'file',
+                'entry': entry,
+            })
+        if not events:
+            return
+
+        with self._cond:
+            for event in events:
+                self.seq += 1
+                event['seq'] = self.seq
+                self._events.append(event)
+            self._cond.notify_all()
+
+    def since(self, seq, limit=None):
+        """返回 (序号seq之后的事件, 最后一个事件的序号)；seq已超出保留范围时事件为None"""
+        with self._cond:
+            skip = len(self._events) - (self.seq - seq)
+            if skip < 0:
+                return None, self.seq
+            events = [self._events[i] for i in range(skip, len(self._events))]
+            if limit is not None and len(events) > limit:
+                events = events[:limit]
+            return events, events[-1]['seq'] if events else seq
+
+    def wait(self, seq, timeout):
+        """等待序号seq之后出现新事件，返回是否有新事件"""
+        with self._cond:
+            return self._cond.wait_for(lambda: self.seq > seq, timeout)
+
+    def open_stream(self, limit):
+        with self._cond:
+            if self.streams >= limit:
+                return False
+            self.streams += 1
+            return True
+
+    def close_stream(self):
+        with self._cond:
+            self.streams -= 1
+
+
+change_log = ChangeLog()
+
+
+# 元数据维护：通过API产生的文件系统变更统一从这里通知各索引
+def record_file_written(path, size, old_size=None, digest=None):
+    """新建或覆盖了一个文件，old_size为覆盖前的大小（新建时为None），digest为内容的sha256"""
+    dir_listings.invalidate(os.path.dirname(path))
+    archive_cache.invalidate(path)
+    search_index.add(path)
+    fs_watcher.note_written(path)
+    metadata_catalog.touch(path)
+    if old_size is None:
+        dir_stats.file_changed(path, 1, size)
+    else:
+        dir_stats.file_changed(path, 0, size - old_size)
+
+    if digest:
+        content_index.add(path, digest)
+    else:
+        content_index.remove(path)
+    change_log.append([('create' if old_size is None else 'modify', path, None, False)])
+
+
+def record_folder_created(path):
+    dir_listings.invalidate(os.path.dirname(path))
+    archive_cache.invalidate(path)
+    search_index.add_tree(path)
+    metadata_catalog.touch(path)
+    dir_stats.refresh(os.path.dirname(os.path.abspath(path)))
+    change_log.append([('create', path, None, True)])
+
+
+def record_removed(path, is_dir, size=0):
+    dir_listings.invalidate(path, os.path.dirname(path))
+    archive_cache.invalidate(path)
+    content_index.remove(path)
+    search_index.remove(path)
+    metadata_catalog.touch(path)
+    if is_dir:
+        dir_stats.refresh(path)
+        dir_stats.refresh(os.path.dirname(os.path.abspath(path)))
+    else:
+        dir_stats.file_changed(path, -1, -size)
+    change_log.append([('delete', path, None, is_dir)])
+
+
+def record_moved(source, target, is_dir):
+    dir_listings.invalidate(source, target, os.path.dirname(source), os.path.dirname(target))
+    archive_cache.invalidate(source, target)
+    content_index.moved(source, target)
+    search_index.moved(source, target)
+    fs_watcher.note_written(target)
+    metadata_catalog.moved(source, target)
+    if is_dir:
+        dir_stats.moved(source, target)
+    else:
+        size = os.path.getsize(target)
+        dir_stats.file_changed(source, -1, -size)
+        dir_stats.file_changed(target, 1, size)
+    change_log.append([('move', target, source, is_dir)])
+
+
+def record_copied(source, target, is_dir):
+    if is_dir:
+        record_folder_created(target)
+    else:
+        record_file_written(target, os.path.getsize(target), None, content_index.digest_of(source))
+
+
+def record_bulk(removed=(), moved=(), copied=()):
+    """批量操作结束后统一通知各索引，每个索引只更新一次
+
+    removed为 [(路径, 是否文件夹, 大小)]，moved和copied为 [(源, 目标, 是否文件夹)]
+    """
+    dirs = set()
+    paths = []
+    for path, is_dir, size in removed:
+        dirs.add(os.path.dirname(path))
+        paths.append(path)
+        if is_dir:
+            dirs.add(path)
+    for source, target, is_dir in moved:
+        dirs.update((source, target, os.path.dirname(source), os.path.dirname(target)))
+        paths += [source, target]
+    for source, target, is_dir in copied:
+        dirs.add(os.path.dirname(target))
+        paths.append(target)
+    if not paths:
+        return
+
+    dir_listings.invalidate(*dirs)
+    archive_cache.invalidate(*paths)
+    if removed:
+        content_index.remove(*[path for path, _, _ in removed])
+    if moved:
+        content_index.moved_many([(source, target) for source, target, _ in moved])
+    for path, is_dir, size in removed:
+        search_index.remove(path)
+    for source, target, is_dir in moved:
+        search_index.moved(source, target)
+    fs_watcher.note_written(*[target for source, target, is_dir in list(moved) + list(copied)])
+    metadata_catalog.touch(*[path for path, _, _ in removed])
+    for source, target, is_dir in moved:
+        metadata_catalog.moved(source, target)
+    metadata_catalog.touch(*[target for source, target, is_dir in copied])
+    for source, target, is_dir in copied:
+        if is_dir:
+            search_index.add_tree(target)
+        else:
+            search_index.add(target)
+
+    refresh = set()
+    for path, is_dir, size in removed:
+        if is_dir:
+            refresh.update((os.path.abspath(path), os.path.dirname(os.path.abspath(path))))
+        else:
+            dir_stats.file_changed(path, -1, -size)
+    for source, target, is_dir in moved:
+        if is_dir:
+            dir_stats.moved(source, target)
+        else:
+            size = os.path.getsize(target)
+            dir_stats.file_changed(source, -1, -size)
+            dir_stats.file_changed(target, 1, size)
+    for source, target, is_dir in copied:
+        if is_dir:
+            refresh.add(os.path.dirname(os.path.abspath(target)))
+        else:
+            size = os.path.getsize(target)
+            dir_stats.file_changed(target, 1, size)
+            digest = content_index.digest_of(source)
+            if digest:
+                content_index.add(target, digest)
+    for path in refresh:
+        dir_stats.refresh(path)
+
+    change_log.append([('delete', path, None, is_dir) for path, is_dir, size in removed] +
+                      [('move', target, source, is_dir) for source, target, is_dir in moved] +
+                      [('create', target, None, is_dir) for source, target, is_dir in copied])
+
+
+def record_external_changes(path, written=()):
+    """文件夹path的直接内容被API之外的程序修改后校正各索引，written为被写入过的文件名
+
+    以搜索索引中记录的条目为准与文件系统比较，API已经登记过的变更不会重复通知。返回是否有变化。
+    """
+    added, removed = search_index.sync_dir(path)
+    added_names = {name for name, _ in added}
+    modified = [name for name in written
+                if name not in added_names and not is_transient_name(name)
+                and os.path.isfile(os.path.join(path, name))]
+    if not added and not removed and not modified:
+        return False
+
+    removed_paths = [os.path.join(path, name) for name, _ in removed]
+    changed_paths = [os.path.join(path, name) for name, _ in added] + [os.path.join(path, name) for name in modified]
+    dir_listings.invalidate(path)
+    archive_cache.invalidate(*(removed_paths + changed_paths))
+    if removed_paths:
+        # 被修改的文件不必删除摘要，查找时会核对大小和mtime
+        content_index.remove(*removed_paths)
+    metadata_catalog.touch(*(removed_paths + changed_paths))
+    dir_stats.refresh(path)
+    change_log.append([('delete', os.path.join(path, name), None, is_dir) for name, is_dir in removed] +
+                      [('create', os.path.join(path, name), None, is_dir) for name, is_dir in added] +
+                      [('modify', os.path.join(path, name), None, False) for name in modified])
+    return True
+
+
+# 辅助函数：API写入过程中使用的临时名称（复制任务、打包上传、克隆），不视为变更
+def is_transient_name(name):
+    return TRANSIENT_NAME_PATTERN.search(name) is not None
+
+
+# 辅助函数：创建目录（含缺失的上级目录）并通知索引
+def make_dirs(path):
+    top_created = None
+    current = os.path.abspath(path)
+    while not os.path.exists(current):
+        top_created = current
+        parent = os.path.dirname(current)
+        if parent == current:
+            break
+        current = parent
+
+    os.makedirs(path, exist_ok=True)
+    if top_created:
+        record_folder_created(top_created)
+
+
+# 文件系统监视：通过SMB、rsync等直接写入上传目录的变更也同步到各索引
+class FsWatcher:
+    """用inotify（通过ctypes调用libc）监视上传目录下的每个文件夹
+
+    事件先攒一小段时间，按所在文件夹合并后交给record_external_changes校正，同一批中反复写入的
+    文件只处理一次。inotify不可用（非Linux）时，或者监视数达到系统上限
+    （fs.inotify.max_user_watches）后，没有被监视的文件夹改为定期比较mtime；这种方式发现不了
+    原地修改文件内容（文件夹mtime不变）。事件队列溢出时重新建立所有监视并完整校正一次。
+    """
+
+    IN_CLOSE_WRITE = 0x00000008
+    IN_MOVED_FROM = 0x00000040
+    IN_MOVED_TO = 0x00000080
+    IN_CREATE = 0x00000100
+    IN_DELETE = 0x00000200
+    IN_Q_OVERFLOW = 0x00004000
+    IN_IGNORED = 0x00008000
+    IN_ONLYDIR = 0x01000000
+    IN_DONT_FOLLOW = 0x02000000
+    IN_ISDIR = 0x40000000
+    WATCH_MASK = (IN_CLOSE_WRITE | IN_MOVED_FROM | IN_MOVED_TO | IN_CREATE | IN_DELETE
+                  | IN_ONLYDIR | IN_DONT_FOLLOW)
+
+    def __init__(self, root, batch_delay, reconcile_interval):
+        self.root = os.path.abspath(root)
+        self.batch_delay = batch_delay
+        self.reconcile_interval = reconcile_interval
+        self.fd = None
+        self.libc = None
+        self.wds = {}  # 监视描述符 -> 文件夹绝对路径
+        self.paths = {}  # 文件夹绝对路径 -> 监视描述符
+        self.exhausted = False  # 监视数达到上限，部分文件夹靠定期比较mtime
+        self.active = False  # 监视已建立并在处理事件
+        self.dir_mtimes = None  # 定期校正时记录的文件夹mtime
+        self.api_written = {}  # API刚写入或移入的文件 -> 时间，对应的事件不再视为修改
+        self.batches = 0
+        self.thread = None
+        self.lock = threading.Lock()
+
+    def start(self):
+        with self.lock:
+            if self.thread:
+                return
+            self.thread = threading.Thread(target=self._run, name='fs-watcher', daemon=True)
+        self.thread.start()
+
+    def covers(self, path):
+        """文件夹及其下各层的变更是否都会经inotify事件得知"""
+        return self.active and not self.exhausted and os.path.abspath(path) in self.paths
+
+    def note_written(self, *paths):
+        if self.thread is None:
+            return
+        now = time.time()
+        with self.lock:
+            for path in paths:
+                self.api_written[os.path.abspath(path)] = now
+
+    def _take_api_written(self):
+        """返回近期API写入的文件，并清理超过几批事件周期的记录"""
+        expire = time.time() - max(self.batch_delay * 10, 5)
+        with self.lock:
+            for path in [p for p, t in self.api_written.items() if t < expire]:
+                del self.api_written[path]
+            return set(self.api_written)
+
+    def _init_inotify(self):
+        """返回inotify是否可用"""
+        try:
+            if self.libc is None:
+                self.libc = ctypes.CDLL(ctypes.util.find_library('c'), use_errno=True)
+                self.libc.inotify_init1.argtypes = [ctypes.c_int]
+                self.libc.inotify_add_watch.argtypes = [ctypes.c_int, ctypes.c_char_p, ctypes.c_uint32]
+                self.libc.inotify_rm_watch.argtypes = [ctypes.c_int, ctypes.c_int]
+            fd = self.libc.inotify_init1(os.O_NONBLOCK | os.O_CLOEXEC)
+        except (OSError, AttributeError, TypeError):
+            return False
+        if fd < 0:
+            print(f"无法启用inotify: {os.strerror(ctypes.get_errno())}")
+            return False
+        self.fd = fd
+        self.wds.clear()
+        self.paths.clear()
+        self.exhausted = False
+        return True
+
+    def _add_watch(self, path):
+        if self.exhausted:
+            return False
+        wd = self.libc.inotify_add_watch(self.fd, os.fsencode(path), self.WATCH_MASK)
+        if wd < 0:
+            error = ctypes.get_errno()
+            if error == errno.ENOSPC:
+                self.exhausted = True
+                print(f"inotify监视数达到系统上限（已监视 {len(self.wds)} 个文件夹），"
+                      f"其余文件夹每 {self.reconcile_interval} 秒比较一次mtime")
+            return False
+        old = self.wds.get(wd)
+        if old is not None and old != path:
+            self.paths.pop(old, None)
+        self.wds[wd] = path
+        self.paths[path] = wd
+        return True
+
+    def _add_watches(self, path):
+        """监视文件夹及其下所有文件夹（不进入符号链接）"""
+        for dirpath, dirnames, filenames in os.walk(path):
+            if not self._add_watch(dirpath):
+                if self.exhausted:
+                    return
+                dirnames[:] = []
+                continue
+            dirnames[:] = [d for d in dirnames if not os.path.islink(os.path.join(dirpath, d))]
+
+    def _subtree_watches(self, path):
+        prefix = path + os.sep
+        return [(wd, p) for wd, p in self.wds.items() if p == path or p.startswith(prefix)]
+
+    def _rename_watches(self, source, target):
+        for wd, path in self._subtree_watches(source):
+            new_path = target + path[len(source):]
+            del self.paths[path]
+            self.wds[wd] = new_path
+            self.paths[new_path] = wd
+
+    def _drop_watches(self, path):
+        for wd, p in self._subtree_watches(path):
+            self.libc.inotify_rm_watch(self.fd, wd)
+            self._forget(wd)
+
+    def _forget(self, wd):
+        path = self.wds.pop(wd, None)
+        if path is not None and self.paths.get(path) == wd:
+            del self.paths[path]
+
+    def _read_events(self):
+        events = []
+        while True:
+            try:
+                data = os.read(self.fd, 256 * 1024)
+            except BlockingIOError:
+                return events
+            if not data:
+                return events
+            offset = 0
+            while offset < len(data):
+                wd, mask, cookie, length = struct.unpack_from('iIII', data, offset)
+                name = data[offset + 16:offset + 16 + length].rstrip(b'\0')
+                events.append((wd, mask, cookie, os.fsdecode(name)))
+                offset += 16 + length
+
+    def _process(self, events):
+        """处理一批事件，返回是否需要完整校正（事件队列溢出）"""
+        written = {}  # 文件夹 -> 被写入的文件名
+        moved_from = {}  # cookie -> 移走的文件夹
+        new_dirs = []
+        for wd, mask, cookie, name in events:
+            if mask & self.IN_Q_OVERFLOW:
+                return True
+            if mask & self.IN_IGNORED:
+                self._forget(wd)
+                continue
+            parent = self.wds.get(wd)
+            if parent is None or not name:
+                continue
+
+            path = os.path.join(parent, name)
+            names = written.setdefault(parent, set())
+            if mask & self.IN_ISDIR:
+                if mask & self.IN_MOVED_FROM:
+                    moved_from[cookie] = path
+                elif mask & self.IN_MOVED_TO and cookie in moved_from:
+                    self._rename_watches(moved_from.pop(cookie), path)
+                elif mask & (self.IN_CREATE | self.IN_MOVED_TO):
+                    new_dirs.append(path)
+            elif mask & (self.IN_CLOSE_WRITE | self.IN_MOVED_TO):
+                names.add(name)
+
+        # 移出上传目录的文件夹不再监视，移入或新建的文件夹加入监视
+        for path in moved_from.values():
+            self._drop_watches(path)
+        for path in new_dirs:
+            if os.path.isdir(path) and not os.path.islink(path):
+                self._add_watches(path)
+
+        changed = 0
+        api_written = self._take_api_written()
+        for path, names in written.items():
+            names = [name for name in names if os.path.join(path, name) not in api_written]
+            if record_external_changes(path, names):
+                changed += 1
+        self.batches += 1
+        if changed:
+            print(f"文件系统变更: {len(events)} 个事件, {changed} 个文件夹已同步")
+        return False
+
+    def reconcile(self, full=False):
+        """比较文件夹的mtime，校正发生变化的文件夹；full时校正所有文件夹
+
+        只检查没有被inotify监视的文件夹。第一次调用只记录mtime。
+        """
+        first = self.dir_mtimes is None and not full
+        mtimes = {}
+        changed = 0
+        for dirpath, dirnames, filenames in os.walk(self.root):
+            dirnames[:] = [d for d in dirnames
+                           if not is_transient_name(d) and not os.path.islink(os.path.join(dirpath, d))]
+            path = os.path.abspath(dirpath)
+            if path in self.paths and not full:
+                continue
+            try:
+                mtime_ns = os.stat(path).st_mtime_ns
+            except OSError:
+                continue
+            mtimes[path] = mtime_ns
+            previous = self.dir_mtimes.get(path) if self.dir_mtimes else None
+            if full or (not first and previous is not None and previous != mtime_ns):
+                if record_external_changes(path):
+                    changed += 1
+        self.dir_mtimes = mtimes
+        if changed:
+            print(f"文件夹校正: {changed} 个文件夹已同步")
+        return changed
+
+    def _run(self):
+        try:
+            if self._init_inotify():
+                self._add_watches(self.root)
+                print(f"文件系统监视已启动: {len(self.wds)} 个文件夹")
+            else:
+                print(f"inotify不可用，每 {self.reconcile_interval} 秒比较一次文件夹mtime")
+        except Exception as e:
+            print(f"文件系统监视启动错误: {str(e)}")
+            self.fd = None
+
+        # 以搜索索引为比较基准，建立完成前的事件留在内核队列中
+        while not search_index.ready:
+            time.sleep(self.batch_delay)
+
+        self.active = self.fd is not None
+        next_reconcile = time.time()
+        while True:
+            try:
+                polling = self.fd is None or self.exhausted
+                if polling and time.time() >= next_reconcile:
+                    self.reconcile()
+                    next_reconcile = time.time() + self.reconcile_interval
+                if self.fd is None:
+                    time.sleep(max(next_reconcile - time.time(), 0))
+                    continue
+
+                timeout = max(next_reconcile - time.time(), 0) if polling else None
+                readable, _, _ = select.select([self.fd], [], [], timeout)
+                if not readable:
+                    continue
+                # 等待片刻让同一批操作的事件到齐
+                time.sleep(self.batch_delay)
+                if self._process(self._read_events()):
+                    print("inotify事件队列溢出，重新建立监视并完整校正")
+                    self.active = False
+                    os.close(self.fd)
+                    self._init_inotify()
+                    self._add_watches(self.root)
+                    self.reconcile(full=True)
+                    self.active = True
+            except Exception as e:
+                print(f"文件系统监视错误: {str(e)}")
+                time.sleep(self.batch_delay)
+
+
+fs_watcher = FsWatcher(UPLOAD_FOLDER, WATCH_BATCH_DELAY, WATCH_RECONCILE_INTERVAL)
+
+
+# 元数据目录：文件列表、文件夹统计和内容摘要保存在SQLite中，重启后直接载入，不必重新遍历上传目录
+class MetadataCatalog:
+    """entries表记录每个文件和文件夹（所在文件夹、名称、类型、大小、mtime、摘要），dirs表记录
+    DirStatsIndex的文件夹统计
+
+    运行时以内存中的索引为准：record_*系列函数登记变化的路径，后台线程每隔flush_interval秒
+    在一个事务中批量写入（WAL模式，写入时不阻塞读取）。启动时在后台把目录载入各索引，再比较
+    每个文件夹的mtime，只重新扫描停机期间变化过的文件夹；原地修改、没有改变文件夹mtime的文件
+    需要文件系统监视发现。第一次运行（或目录与程序版本、上传目录不符）时完整遍历一次。
+    """
+
+    SCHEMA_VERSION = '1'
+
+    def __init__(self, path, root, flush_interval):
+        self.path = path
+        self.root = os.path.abspath(root)
+        self.flush_interval = flush_interval
+        self.conn = None
+        self.lock = threading.Lock()  # 保护数据库连接
+        self.pending = []  # 待写入的变化：(操作, 路径, 目标路径)
+        self.stored_mtimes = []  # 启动时目录中记录的文件夹mtime
+        self.pending_lock = threading.Lock()
+        self.thread = None
+
+    def touch(self, *paths):
+        """路径（文件夹时包括其下所有内容）有变化，下次写入时按文件系统的现状更新"""
+        if self.thread is None:
+            return
+        with self.pending_lock:
+            self.pending.extend(('sync', path, None) for path in paths)
+
+    def moved(self, source, target):
+        if self.thread is None:
+            return
+        with self.pending_lock:
+            self.pending.append(('move', source, target))
+
+    def _relative(self, path):
+        rel_path = os.path.relpath(os.path.abspath(path), self.root)
+        if rel_path == '.':
+            return ''
+        if rel_path == '..' or rel_path.startswith('..' + os.sep):
+            return None
+        return rel_path.replace(os.sep, '/')
+
+    def _absolute(self, rel_path):
+        return os.path.normpath(os.path.join(self.root, rel_path)) if rel_path else self.root
+
+    def _open(self):
+        """打开数据库，返回其中的内容是否完整可用"""
+        conn = sqlite3.connect(self.path, check_same_thread=False)
+        conn.execute('PRAGMA journal_mode=WAL')
+        conn.execute('PRAGMA synchronous=NORMAL')
+        conn.execute('CREATE TABLE IF NOT EXISTS meta (key TEXT PRIMARY KEY, value TEXT)')
+        conn.execute('CREATE TABLE IF NOT EXISTS entries (parent TEXT NOT NULL, name TEXT NOT NULL, '
+                     'is_dir INTEGER NOT NULL, size INTEGER, mtime_ns INTEGER, digest TEXT, '
+                     'PRIMARY KEY (parent, name)) WITHOUT ROWID')
+        conn.execute('CREATE INDEX IF NOT EXISTS entries_digest ON entries (digest) WHERE digest IS NOT NULL')
+        conn.execute('CREATE TABLE IF NOT EXISTS dirs (path TEXT PRIMARY KEY, mtime_ns INTEGER, '
+                     'own_files INTEGER, own_size INTEGER, file_count INTEGER, total_size INTEGER) WITHOUT ROWID')
+        meta = dict(conn.execute('SELECT key, value FROM meta'))
+        if meta.get('schema') != self.SCHEMA_VERSION or meta.get('root') != self.root:
+            with conn:
+                conn.execute('DELETE FROM entries')
+                conn.execute('DELETE FROM dirs')
+                conn.execute('DELETE FROM meta')
+                conn.executemany('INSERT INTO meta VALUES (?, ?)',
+                                 [('schema', self.SCHEMA_VERSION), ('root', self.root)])
+            meta = {}
+        self.conn = conn
+        return meta.get('complete') == '1'
+
+    def start(self):
+        with self.pending_lock:
+            if self.thread:
+                return
+            self.thread = threading.Thread(target=self._run, name='metadata-catalog', daemon=True)
+        self.thread.start()
+
+    def _run(self):
+        try:
+            complete = self._open()
+        except sqlite3.Error as e:
+            print(f"元数据目录不可用（{str(e)}），改为遍历上传目录")
+            self.thread = None
+            search_index.build()
+            return
+
+        dir_stats.track_changes()
+        if complete:
+            search_index.build(loader=self._load)
+            self.reconcile()
+        else:
+            search_index.build(loader=self._populate)
+
+        while True:
+            time.sleep(self.flush_interval)
+            self.flush()
+
+    def _load(self):
+        started = time.time()
+        with self.lock:
+            conn = self.conn
+            # 文件夹统计最先载入，列表最早受益；载入前已被请求扫描过的文件夹保留扫描结果
+            rows = [(self._absolute(path),) + tuple(row) for path, *row in conn.execute('SELECT * FROM dirs')]
+            self.stored_mtimes = [(row[0], row[1]) for row in rows]
+            dirs = dir_stats.load(rows)
+            content_index.load((self._absolute(f'{parent}/{name}' if parent else name), digest, size, mtime_ns)
+                               for parent, name, size, mtime_ns, digest in conn.execute(
+                                   'SELECT parent, name, size, mtime_ns, digest FROM entries WHERE digest IS NOT NULL'))
+            entries = search_index.load(conn.execute('SELECT parent, name, is_dir FROM entries'))
+        print(f"元数据目录已载入: {entries} 个条目, {dirs} 个文件夹, 用时 {time.time() - started:.1f}秒")
+
+    def _populate(self):
+        """第一次运行时遍历上传目录，同时建立搜索索引和目录"""
+        started = time.time()
+        rows = []
+        count = 0
+        stack = ['']
+        while stack:
+            rel_dir = stack.pop()
+            dir_rows = []
+            try:
+                with os.scandir(self._absolute(rel_dir)) as it:
+                    for item in it:
+                        if is_transient_name(item.name):
+                            continue
+                        try:
+                            is_dir = item.is_dir(follow_symlinks=False)
+                            stat = item.stat(follow_symlinks=False)
+                        except OSError:
+                            continue
+                        dir_rows.append((rel_dir, item.name, int(is_dir), 0 if is_dir else stat.st_size,
+                                         stat.st_mtime_ns, None))
+                        if is_dir:
+                            stack.append(f'{rel_dir}/{item.name}' if rel_dir else item.name)
+            except OSError:
+                continue
+            search_index.load(row[:3] for row in dir_rows)
+            rows.extend(dir_rows)
+            if len(rows) >= 50000:
+                count += self._insert(rows)
+                rows = []
+        count += self._insert(rows)
+
+        # 计算整棵树的文件夹统计，随后的写入一并保存
+        dir_stats.get(self.root)
+        self.flush()
+        with self.lock, self.conn:
+            self.conn.execute("INSERT OR REPLACE INTO meta VALUES ('complete', '1')")
+        print(f"元数据目录已建立: {count} 个条目, 用时 {time.time() - started:.1f}秒")
+
+    def _insert(self, rows):
+        with self.lock, self.conn:
+            self.conn.executemany('INSERT OR REPLACE INTO entries VALUES (?, ?, ?, ?, ?, ?)', rows)
+        return len(rows)
+
+    def reconcile(self):
+        """与目录中记录的mtime比较，校正停机期间发生变化的文件夹"""
+        started = time.time()
+        changed = 0
+        for path, mtime_ns in self.stored_mtimes:
+            try:
+                current = os.stat(path).st_mtime_ns
+            except OSError:
+                # 已被删除，由上级文件夹校正
+                continue
+            if current != mtime_ns:
+                record_external_changes(path)
+                dir_stats.refresh(path)
+                changed += 1
+        self.flush()
+        print(f"元数据目录校正完成: {changed} 个文件夹有变化, 用时 {time.time() - started:.1f}秒")
+        return changed
+
+    def flush(self):
+        """把登记的变化写入数据库"""
+        if self.conn is None:
+            return
+        with self.pending_lock:
+            ops, self.pending = self.pending, []
+        dirs = dir_stats.take_changes()
+        if not ops and not dirs:
+            return
+
+        try:
+            with self.lock, self.conn:
+                for op, path, target in ops:
+                    if op == 'move':
+                        self._write_move(path, target)
+                    else:
+                        self._write_path(path)
+                for key, row in dirs:
+                    rel_path = self._relative(key)
+                    if rel_path is None:
+                        continue
+                    if row is None:
+                        self.conn.execute('DELETE FROM dirs WHERE path = ?', (rel_path,))
+                    else:
+                        self.conn.execute('INSERT OR REPLACE INTO dirs VALUES (?, ?, ?, ?, ?, ?)', (rel_path,) + row)
+        except (sqlite3.Error, OSError) as e:
+            # 写入失败时目录不再可信，下次启动完整遍历
+            print(f"元数据目录写入错误: {str(e)}")
+            try:
+                with self.lock, self.conn:
+                    self.conn.execute("DELETE FROM meta WHERE key = 'complete'")
+            except sqlite3.Error:
+                pass
+
+    def _delete_subtree(self, rel_path):
+        self.conn.execute('DELETE FROM entries WHERE parent = ?', (rel_path,))
+        self.conn.execute('DELETE FROM entries WHERE parent >= ? AND parent < ?', (rel_path + '/', rel_path + '0'))
+
+    def _write_path(self, path):
+        rel_path = self._relative(path)
+        if not rel_path:
+            return
+        parent, _, name = rel_path.rpartition('/')
+        try:
+            stat = os.lstat(path)
+        except OSError:
+            stat = None
+        self.conn.execute('DELETE FROM entries WHERE parent = ? AND name = ?', (parent, name))
+        self._delete_subtree(rel_path)
+        if stat is None or is_transient_name(name):
+            return
+
+        is_dir = os.path.isdir(path) and not os.path.islink(path)
+        digest = None if is_dir else content_index.digest_of(path)
+        self.conn.execute('INSERT INTO entries VALUES (?, ?, ?, ?, ?, ?)',
+                          (parent, name, int(is_dir), 0 if is_dir else stat.st_size, stat.st_mtime_ns, digest))
+        if not is_dir:
+            return
+
+        # 新建或复制来的文件夹：写入其下所有内容
+        rows = []
+        for dirpath, dirnames, filenames in os.walk(path):
+            rel_dir = self._relative(dirpath)
+            dirnames[:] = [d for d in dirnames if not is_transient_name(d)]
+            items = [(d, True) for d in dirnames] + [(f, False) for f in filenames if not is_transient_name(f)]
+            for item_name, item_is_dir in items:
+                item_path = os.path.join(dirpath, item_name)
+                try:
+                    item_stat = os.lstat(item_path)
+                except OSError:
+                    continue
+                # 指向文件夹的符号链接按文件记录，os.walk也不会进入
+                item_is_dir = item_is_dir and not os.path.islink(item_path)
+                rows.append((rel_dir, item_name, int(item_is_dir), 0 if item_is_dir else item_stat.st_size,
+                             item_stat.st_mtime_ns, None if item_is_dir else content_index.digest_of(item_path)))
+        self.conn.executemany('INSERT OR REPLACE INTO entries VALUES (?, ?, ?, ?, ?, ?)', rows)
+
+    def _write_move(self, source, target):
+        """移动或重命名：只改写路径，文件夹下的内容不重新扫描"""
+        source_rel = self._relative(source)
+        target_rel = self._relative(target)
+        if not source_rel or not target_rel:
+            self._write_path(source)
+            self._write_path(target)
+            return
+
+        source_parent, _, source_name = source_rel.rpartition('/')
+        target_parent, _, target_name = target_rel.rpartition('/')
+        self.conn.execute('DELETE FROM entries WHERE parent = ? AND name = ?', (target_parent, target_name))
+        self._delete_subtree(target_rel)
+        moved = self.conn.execute('UPDATE entries SET parent = ?, name = ? WHERE parent = ? AND name = ?',
+                                  (target_parent, target_name, source_parent, source_name)).rowcount
+        self.conn.execute('UPDATE entries SET parent = ? || substr(parent, ?) WHERE parent = ? '
+                          'OR (parent >= ? AND parent < ?)',
+                          (target_rel, len(source_rel) + 1, source_rel, source_rel + '/', source_rel + '0'))
+        if not moved:
+            # 目录中没有源（如尚未写入），按现状写入目标
+            self._write_path(target)
+
+
+metadata_catalog = MetadataCatalog(CATALOG_PATH, UPLOAD_FOLDER, CATALOG_FLUSH_INTERVAL)
+atexit.register(metadata_catalog.flush)
+
+
+# 文件夹列表缓存：一次scandir得到文件夹内的条目，按文件夹mtime失效
+class DirListingCache:
+    """缓存文件夹的条目和排序结果，翻页时不再重复扫描和排序
+
+    按名称排序时只需要scandir返回的名称和类型，不对每个条目调用stat；文件大小、修改时间和
+    子文件夹统计只在生成当前页时才获取。第一页用堆选出前N项，完整排序推迟到真正翻页时。
+    文件夹自身mtime变化或通过API修改后重新扫描。
+
+    每个文件夹另有一个版本号参与列表的ETag计算：列表中子文件夹的大小和文件数取决于整棵子树，
+    因此文件夹及其所有上级的版本号在其中内容变化时递增，其他文件夹的ETag不受影响。
+    """
+
+    def __init__(self, root=UPLOAD_FOLDER, max_dirs=LISTING_CACHE_SIZE):
+        self.root = os.path.abspath(root)
+        self.max_dirs = max_dirs
+        self._versions = {}  # 文件夹绝对路径 -> 版本号，没有记录时为0
+        self._cache = OrderedDict()
+        self._lock = threading.Lock()
+
+    def version(self, path):
+        with self._lock:
+            return self._versions.get(os.path.abspath(path), 0)
+
+    def invalidate(self, *paths):
+        with self._lock:
+            dirs = {os.path.abspath(p) for p in paths}
+            bumped = set()
+            for path in dirs:
+                while path not in bumped and (path == self.root or path.startswith(self.root + os.sep)):
+                    bumped.add(path)
+                    self._versions[path] = self._versions.get(path, 0) + 1
+                    path = os.path.dirname(path)
+            for key in [k for k in self._cache if k[0] in dirs]:
+                del self._cache[key]
+
+    def get(self, path, mtime_ns, sort, reverse):
+        key = (os.path.abspath(path), sort, reverse)
+        with self._lock:
+            listing = self._cache.get(key)
+            if listing is not None and listing['mtime_ns'] == mtime_ns:
+                self._cache.move_to_end(key)
+                return listing
+
+        listing = self._scan(path, mtime_ns, sort, reverse)
+        with self._lock:
+            self._cache[key] = listing
+            self._cache.move_to_end(key)
+            while len(self._cache) > self.max_dirs:
+                self._cache.popitem(last=False)
+        return listing
+
+    @staticmethod
+    def _scan(path, mtime_ns, sort, reverse):
+        folders = []
+        files = []
+        values = None if sort == 'name' else {}
+        with os.scandir(path) as it:
+            for item in it:
+                try:
+                    is_dir = item.is_dir()
+                    if values is not None:
+                        if is_dir and sort == 'size':
+                            values[item.name] = dir_stats.get(item.path)[1]
+                        else:
+                            stat = item.stat()
+                            values[item.name] = stat.st_size if sort == 'size' else stat.st_mtime_ns
+                except OSError:
+                    continue
+                (folders if is_dir else files).append(item.name)
+
+        listing = {
+            'mtime_ns': mtime_ns,
+            'sort': sort,
+            'reverse': reverse,
+            'values': values,
+            'folders': folders,
+            'files': files,
+            'sorted': False,
+            'positions': None,
+        }
+        if values is not None:
+            # 按大小或时间排序时stat已是主要开销，直接完整排序
+            DirListingCache.ensure_sorted(listing)
+        return listing
+
+    @staticmethod
+    def _sorted(listing, names):
+        if listing['sort'] == 'name':
+            return sorted(names, key=str.lower, reverse=listing['reverse'])
+        result = sorted(names, key=str.lower)
+        result.sort(key=listing['values'].__getitem__, reverse=listing['reverse'])
+        return result
+
+    @staticmethod
+    def ensure_sorted(listing):
+        if not listing['sorted']:
+            # 赋值新列表而不是原地排序，并发读取的请求不会看到排序中的列表
+            listing['folders'] = DirListingCache._sorted(listing, listing['folders'])
+            listing['files'] = DirListingCache._sorted(listing, listing['files'])
+            listing['sorted'] = True
+
+    @staticmethod
+    def head(listing, names, count):
+        """与完整排序后的前count项一致（heapq保证相同的稳定性）"""
+        if listing['sorted']:
+            return names[:count]
+        select = heapq.nlargest if listing['reverse'] else heapq.nsmallest
+        return select(count, names, key=str.lower)
+
+    @staticmethod
+    def position(listing, name):
+        """条目在排序结果（文件夹在前）中的位置，翻页游标定位用；不存在时返回None"""
+        DirListingCache.ensure_sorted(listing)
+        if listing['positions'] is None:
+            positions = {n: i for i, n in enumerate(listing['folders'])}
+            offset = len(listing['folders'])
+            positions.update((n, offset + i) for i, n in enumerate(listing['files']))
+            listing['positions'] = positions
+        return listing['positions'].get(name)
+
+    @staticmethod
+    def slice(listing, start, end):
+        """返回排序结果中 [start, end) 的 (名称, 是否文件夹)"""
+        folder_count = len(listing['folders'])
+        result = []
+        if start < folder_count:
+            if start == 0:
+                folders = DirListingCache.head(listing, listing['folders'], min(end, folder_count))
+            else:
+                DirListingCache.ensure_sorted(listing)
+                folders = listing['folders'][start:min(end, folder_count)]
+            result += [(name, True) for name in folders]
+
+        if end > folder_count:
+            file_start = max(start - folder_count, 0)
+            if file_start == 0:
+                files = DirListingCache.head(listing, listing['files'], end - folder_count)
+            else:
+                DirListingCache.ensure_sorted(listing)
+                files = listing['files'][file_start:end - folder_count]
+            result += [(name, False) for name in files]
+        return result
+
+
+dir_listings = DirListingCache()
+
+
+def encode_cursor(index, name):
+    return base64.urlsafe_b64encode(f'{index}:{name}'.encode('utf-8')).decode('ascii')
+
+
+def decode_cursor(cursor):
+    try:
+        index, name = base64.urlsafe_b64decode(cursor.encode('ascii')).decode('utf-8').split(':', 1)
+        return int(index), name
+    except Exception:
+        return None
 
-    # 按类型排序：文件夹在前，文件在后
-    tree.sort(key=lambda x: (0 if x['type'] == 'folder' else 1, x['name'].lower()))
 
-    return tree
+def make_entry(full_path, rel_dir, name, is_dir):
+    """生成列表中的单个条目，只在需要返回时才stat"""
+    item_path = os.path.join(full_path, name)
+    rel_path = f'{rel_dir}/{name}' if rel_dir else name
+
+    if is_dir:
+        file_count, total_size = dir_stats.get(item_path)
+        return {
+            'name': name,
+            'path': rel_path,
+            'type': 'folder',
+            'size': total_size,
+            'file_count': file_count,
+            'modified': datetime.fromtimestamp(os.path.getmtime(item_path)).isoformat(),
+            'url': f'/browse/{rel_path}'
+        }
+
+    stat = os.stat(item_path)
+    return {
+        'name': name,
+        'path': rel_path,
+        'type': 'file',
+        'size': stat.st_size,
+        'modified': datetime.fromtimestamp(stat.st_mtime).isoformat(),
+        'url': f'/download/{rel_path}'
+    }
+
+
+# 辅助函数：分页列出文件夹内容
+def list_directory(full_path, sort='name', reverse=False, item_type=None, cursor=None, limit=None):
+    """返回 (当前页条目, 下一页游标, 符合条件的条目总数)"""
+    mtime_ns = os.stat(full_path).st_mtime_ns
+    listing = dir_listings.get(full_path, mtime_ns, sort, reverse)
+    folder_count = len(listing['folders'])
+
+    # 文件夹排在前面，按类型过滤只需要确定范围
+    view_start, view_end = 0, folder_count + len(listing['files'])
+    if item_type == 'folder':
+        view_end = folder_count
+    elif item_type == 'file':
+        view_start = folder_count
+
+    start = view_start
+    if cursor:
+        index, name = cursor
+        position = DirListingCache.position(listing, name)
+        if position is None:
+            # 游标指向的条目已被删除，退回到原来的位置
+            position = view_start + index
+        start = max(position + 1, view_start)
+
+    end = view_end if limit is None else min(start + limit, view_end)
+
+    rel_dir = os.path.relpath(full_path, UPLOAD_FOLDER).replace('\\', '/')
+    if rel_dir == '.':
+        rel_dir = ''
+
+    page_items = DirListingCache.slice(listing, start, end) if start < end else []
+    page = []
+    for name, is_dir in page_items:
+        try:
+            page.append(make_entry(full_path, rel_dir, name, is_dir))
+        except OSError:
+            # 条目在扫描后被删除
+            continue
+
+    next_cursor = None
+    if page_items and end < view_end:
+        next_cursor = encode_cursor(end - 1 - view_start, page_items[-1][0])
+
+    return page, next_cursor, view_end - view_start
 
 
 # 辅助函数：获取面包屑导航
@@ -129,6 +2215,1694 @@ def get_breadcrumbs(path):
     return crumbs
 
 
+# 辅助函数：生成下载用的Content-Disposition头
+def attachment_disposition(download_name):
+    """生成附件下载头，非ASCII文件名按RFC 5987编码"""
+    try:
+        download_name.encode('ascii')
+        return f'attachment; filename="{download_name}"'
+    except UnicodeEncodeError:
+        simple = unicodedata.normalize('NFKD', download_name).encode('ascii', 'ignore').decode('ascii')
+        quoted = quote(download_name, safe="!#$&+^`|~")
+        return f'attachment; filename="{simple}"; filename*=UTF-8\'\'{quoted}'
+
+
+# 辅助函数：按确定顺序惰性遍历文件夹中的文件
+def iter_folder_members(folder_path, prefix=''):
+    """产出 (文件路径, ZIP内路径)，边遍历边产出，不预先收集整棵目录树"""
+    for root, dirs, files in os.walk(folder_path):
+        dirs.sort()
+        relative_root = os.path.relpath(root, folder_path)
+
+        for file in sorted(files):
+            if relative_root == '.':
+                arcname = file
+            else:
+                arcname = os.path.join(relative_root, file)
+            if prefix:
+                arcname = os.path.join(prefix, arcname)
+
+            # 确保路径使用正斜杠
+            yield os.path.join(root, file), arcname.replace('\\', '/')
+
+
+# 辅助函数：记录打包内容的指纹（每个文件的ZIP内路径、大小和mtime）
+def fingerprint_members(members, digest):
+    """原样产出members，同时把每个文件的指纹计入digest；在读取文件内容之前stat"""
+    for path, arcname in members:
+        try:
+            stat = os.stat(path)
+            line = f'{arcname}\0{stat.st_size}\0{stat.st_mtime_ns}\n'
+        except OSError:
+            line = f'{arcname}\0\n'
+        digest.update(line.encode('utf-8', 'surrogateescape'))
+        yield path, arcname
+
+
+def folder_fingerprint(folder_path):
+    """遍历文件夹，返回其中所有文件指纹的摘要；只stat不读内容，代价远小于重新打包"""
+    digest = hashlib.sha256()
+    for _ in fingerprint_members(iter_folder_members(folder_path), digest):
+        pass
+    return digest.hexdigest()
+
+
+def _dos_datetime(timestamp):
+    """将时间戳转换为ZIP使用的DOS日期和时间"""
+    t = time.localtime(timestamp)
+    if t.tm_year < 1980:
+        return 0, (1 << 5) | 1
+    year = min(t.tm_year, 2107)
+    dos_time = (t.tm_hour << 11) | (t.tm_min << 5) | (t.tm_sec // 2)
+    dos_date = ((year - 1980) << 9) | (t.tm_mon << 5) | t.tm_mday
+    return dos_time, dos_date
+
+
+# 后台计算线程池，打包压缩使用（zlib处理大块数据时释放GIL）；分段摘要有自己的线程池
+worker_pool = None
+worker_pool_lock = threading.Lock()
+
+
+def get_worker_pool():
+    global worker_pool
+    with worker_pool_lock:
+        if worker_pool is None:
+            worker_pool = ThreadPoolExecutor(max_workers=WORKER_THREADS, thread_name_prefix='worker')
+        return worker_pool
+
+
+def deflate_block(block, zdict, level, final):
+    """压缩成员的一个数据块（在线程池中执行，zlib压缩时释放GIL）
+
+    以前一块末尾的32KB作为预设字典，压缩率与整体压缩接近；非最后一块以同步刷新结束，
+    输出按字节对齐，各块的结果按顺序拼接即为完整的deflate数据。
+    """
+    if zdict:
+        compressor = zlib.compressobj(level, zlib.DEFLATED, -15, zdict=zdict)
+    else:
+        compressor = zlib.compressobj(level, zlib.DEFLATED, -15)
+    return compressor.compress(block) + compressor.flush(zlib.Z_FINISH if final else zlib.Z_SYNC_FLUSH)
+
+
+def should_store(arcname, sample):
+    """已压缩的格式和抽样压缩效果不明显的数据直接存储，不浪费CPU"""
+    if os.path.splitext(arcname)[1].lower() in ZIP_STORED_EXTENSIONS:
+        return True
+    sample = sample[:ZIP_SAMPLE_SIZE]
+    return len(zlib.compress(sample, 1, wbits=-15)) >= len(sample) * ZIP_STORE_RATIO
+
+
+class ZipStream:
+    """边构建边输出的ZIP流
+
+    依次产出本地文件头、压缩数据、数据描述符，最后是中央目录。成员的CRC和大小在写完数据后
+    才知道，因此使用数据描述符（通用标志位3）；大文件、偏移量和成员数超限时自动使用ZIP64。
+    数据按块交给线程池并行压缩，再按原顺序输出，结果与线程数无关；预读的块数有上限，
+    内存占用只与读取块大小和线程数有关，中央目录记录过多时溢出到临时文件。
+    """
+
+    # 成员压缩后可能略大于原始大小，留出余量后再判断是否需要ZIP64
+    ZIP64_MEMBER_THRESHOLD = 0xFFFFFFFF - 16 * 1024 * 1024
+    DICT_SIZE = 32 * 1024  # deflate窗口大小
+
+    def __init__(self, members, compress_level=ZIP_COMPRESS_LEVEL):
+        self.members = members
+        self.compress_level = compress_level
+        self.offset = 0
+        self.entry_count = 0
+        self._buffer = bytearray()
+
+    def __iter__(self):
+        central_dir = tempfile.SpooledTemporaryFile(max_size=8 * 1024 * 1024)
+        plan = self._plan()
+        pending = deque()
+        window = WORKER_THREADS * ZIP_PIPELINE_BLOCKS
+        queued_blocks = 0
+        started = time.perf_counter()
+        complete = False
+        try:
+            # 读取和提交压缩任务领先于输出，排队的块达到上限时先输出最早的结果
+            for event in plan:
+                pending.append(event)
+                if event[0] == 'block':
+                    queued_blocks += 1
+                while queued_blocks >= window:
+                    event = pending.popleft()
+                    if event[0] == 'block':
+                        queued_blocks -= 1
+                    yield from self._process(event, central_dir)
+
+            while pending:
+                yield from self._process(pending.popleft(), central_dir)
+
+            yield from self._write_end(central_dir)
+            yield from self._flush()
+            complete = True
+        finally:
+            # 包含等待客户端接收的时间，下载端慢时耗时也会变长
+            if complete:
+                metrics.observe('filefly_zip_build_seconds', time.perf_counter() - started)
+            metrics.inc('filefly_zip_builds_total', labels=(('result', 'complete' if complete else 'aborted'),))
+            metrics.inc('filefly_zip_bytes_total', self.offset)
+            plan.close()
+            for event in pending:
+                if event[0] == 'block' and event[3] is not None:
+                    event[3].cancel()
+            central_dir.close()
+
+    def _emit(self, data):
+        self._buffer += data
+        self.offset += len(data)
+        if len(self._buffer) >= ZIP_FLUSH_SIZE:
+            yield from self._flush()
+
+    def _flush(self):
+        if self._buffer:
+            data = bytes(self._buffer)
+            self._buffer.clear()
+            yield data
+
+    def _plan(self):
+        """按顺序读取成员数据，产出事件：
+
+        ('member', 成员信息)、('block', 成员信息, 原始块或None, 压缩任务或None)、('end', 成员信息)
+        直接存储的块保留原始数据；压缩的块只保留压缩任务。CRC和大小在读取时累计。
+        """
+        executor = get_worker_pool()
+        for file_path, arcname in self.members:
+            try:
+                source = open(file_path, 'rb')
+            except OSError as e:
+                print(f"无法添加文件到ZIP: {file_path}, 错误: {e}")
+                continue
+
+            with source:
+                stat = os.fstat(source.fileno())
+                # 只读取打包开始时的大小，保证数据描述符与实际写出的数据一致
+                remaining = stat.st_size
+                block = source.read(min(ZIP_READ_SIZE, remaining))
+                remaining -= len(block)
+
+                stored = self.compress_level == 0 or should_store(arcname, block)
+                info = {
+                    'name': arcname.encode('utf-8'),
+                    'mode': stat.st_mode,
+                    'mtime': stat.st_mtime,
+                    'zip64': stat.st_size >= self.ZIP64_MEMBER_THRESHOLD,
+                    'method': zipfile.ZIP_STORED if stored else zipfile.ZIP_DEFLATED,
+                    'crc': 0,
+                    'file_size': 0,
+                    'compress_size': 0,
+                }
+                yield 'member', info
+
+                zdict = b''
+                while True:
+                    info['crc'] = zlib.crc32(block, info['crc'])
+                    info['file_size'] += len(block)
+                    # 文件在打包过程中被截断时，读到空块即结束
+                    final = remaining <= 0 or not block
+                    if stored:
+                        if block:
+                            yield 'block', info, block, None
+                    else:
+                        future = executor.submit(deflate_block, block, zdict, self.compress_level, final)
+                        yield 'block', info, None, future
+                        zdict = (zdict + block)[-self.DICT_SIZE:]
+                    if final:
+                        break
+
+                    block = source.read(min(ZIP_READ_SIZE, remaining))
+                    remaining -= len(block)
+
+            yield 'end', info
+
+    def _process(self, event, central_dir):
+        kind, info = event[0], event[1]
+        if kind == 'member':
+            yield from self._write_header(info)
+        elif kind == 'block':
+            data = event[2] if event[3] is None else event[3].result()
+            if data:
+                info['compress_size'] += len(data)
+                yield from self._emit(data)
+        else:
+            yield from self._write_descriptor(info, central_dir)
+
+    def _write_header(self, info):
+        first_member = self.offset == 0
+        info['header_offset'] = self.offset
+        info['flags'] = 0x08 | 0x800  # 数据描述符 + UTF-8文件名
+        info['version'] = 45 if info['zip64'] else 20
+        dos_time, dos_date = _dos_datetime(info['mtime'])
+        info['dos_time'], info['dos_date'] = dos_time, dos_date
+
+        if info['zip64']:
+            extra = struct.pack('<HHQQ', 0x0001, 16, 0, 0)
+            size_field = 0xFFFFFFFF
+        else:
+            extra = b''
+            size_field = 0
+
+        name = info['name']
+        header = struct.pack('<IHHHHHIIIHH', 0x04034b50, info['version'], info['flags'], info['method'],
+                             dos_time, dos_date, 0, size_field, size_field, len(name), len(extra))
+        yield from self._emit(header + name + extra)
+        if first_member:
+            # 尽快送出第一个字节
+            yield from self._flush()
+
+    def _write_descriptor(self, info, central_dir):
+        zip64 = info['zip64']
+        crc, file_size, compress_size = info['crc'], info['file_size'], info['compress_size']
+        if zip64:
+            descriptor = struct.pack('<IIQQ', 0x08074b50, crc, compress_size, file_size)
+        else:
+            descriptor = struct.pack('<IIII', 0x08074b50, crc, compress_size, file_size)
+        yield from self._emit(descriptor)
+
+        # 中央目录记录：超过4GB的字段写入ZIP64扩展字段
+        header_offset = info['header_offset']
+        version = info['version']
+        zip64_fields = []
+        if zip64:
+            zip64_fields += [file_size, compress_size]
+        if header_offset >= 0xFFFFFFFF:
+            zip64_fields.append(header_offset)
+        if zip64_fields:
+            extra = struct.pack('<HH', 0x0001, 8 * len(zip64_fields)) + struct.pack(f'<{len(zip64_fields)}Q',
+                                                                                    *zip64_fields)
+            version = 45
+        else:
+            extra = b''
+
+        name = info['name']
+        central_dir.write(struct.pack(
+            '<IHHHHHHIIIHHHHHII', 0x02014b50, (3 << 8) | version, version, info['flags'], info['method'],
+            info['dos_time'], info['dos_date'], crc,
+            0xFFFFFFFF if zip64 else compress_size,
+            0xFFFFFFFF if zip64 else file_size,
+            len(name), len(extra), 0, 0, 0, (info['mode'] & 0xFFFF) << 16,
+            min(header_offset, 0xFFFFFFFF)
+        ) + name + extra)
+        self.entry_count += 1
+
+    def _write_end(self, central_dir):
+        cd_offset = self.offset
+        central_dir.seek(0)
+        while True:
+            block = central_dir.read(ZIP_READ_SIZE)
+            if not block:
+                break
+            yield from self._emit(block)
+        cd_size = self.offset - cd_offset
+        count = self.entry_count
+
+        if count >= 0xFFFF or cd_offset >= 0xFFFFFFFF or cd_size >= 0xFFFFFFFF:
+            zip64_end_offset = self.offset
+            yield from self._emit(struct.pack('<IQHHIIQQQQ', 0x06064b50, 44, (3 << 8) | 45, 45, 0, 0,
+                                              count, count, cd_size, cd_offset))
+            yield from self._emit(struct.pack('<IIQI', 0x07064b50, 0, zip64_end_offset, 1))
+
+        yield from self._emit(struct.pack('<IHHHHIIH', 0x06054b50, 0, 0, min(count, 0xFFFF), min(count, 0xFFFF),
+                                          min(cd_size, 0xFFFFFFFF), min(cd_offset, 0xFFFFFFFF), 0))
+
+
+# 辅助函数：读取下载请求指定的压缩级别，无效时返回None
+def requested_zip_level():
+    level = request.args.get('level')
+    if level is None or level == '':
+        return ZIP_COMPRESS_LEVEL
+    if not level.isdigit() or int(level) > 9:
+        return None
+    return int(level)
+
+
+# 辅助函数：以流式ZIP响应返回一组文件
+def zip_response(stream, download_name):
+    """stream为ZipStream等产出ZIP数据的可迭代对象，边打包边发送"""
+    response = Response(iter(stream), mimetype='application/zip')
+    response.headers['Content-Disposition'] = attachment_disposition(download_name)
+    response.headers['Cache-Control'] = 'no-store'
+    return response
+
+
+# 打包缓存：按文件夹和压缩级别缓存生成的ZIP，同一文件夹被反复下载时直接发送缓存文件
+class ArchiveCache:
+    """通过API或被监视到的修改都会经record_*系列函数调用invalidate，删除相关的缓存并作废正在生成的。
+    文件夹被inotify完整监视时，查找只再核对目录统计索引中的递归文件数和总大小，不遍历子树。
+    没有被监视时（非Linux、关闭了监视或超出监视数上限）收不到外部修改的通知，查找时遍历子树，
+    把每个文件的路径、大小和mtime与生成时记录的指纹比较。停机期间的修改无从得知，因此启动时
+    删除上次运行留下的缓存文件。
+
+    未命中时一边发送一边写入临时文件，同时记录每个文件读取前的指纹；完整生成、期间没有收到失效
+    通知、且（没有被监视时）生成后的指纹仍然一致才登记为缓存。预计或实际超过max_entry_bytes的
+    打包结果不缓存。缓存文件按LRU淘汰，总大小不超过max_bytes。
+    """
+
+    def __init__(self, root, max_bytes, max_entry_bytes):
+        self.root = os.path.abspath(root)  # send_file把相对路径当作相对于应用目录，而不是当前目录
+        self.max_bytes = max_bytes
+        self.max_entry_bytes = min(max_entry_bytes, max_bytes)
+        # (文件夹绝对路径, 压缩级别) -> (缓存标识, 递归文件数, 递归总大小, 缓存文件大小, 内容指纹)
+        self._entries = OrderedDict()
+        self._total = 0
+        self._building = {}  # (文件夹绝对路径, 压缩级别) -> 生成期间是否仍然有效
+        self._lock = threading.Lock()
+        self._clear()
+
+    def _clear(self):
+        for name in os.listdir(self.root):
+            try:
+                os.remove(os.path.join(self.root, name))
+            except OSError:
+                continue
+
+    def path(self, key):
+        return os.path.join(self.root, f'{key}.zip')
+
+    def lookup(self, folder_path, compress_level):
+        """返回 (缓存文件路径, 缓存标识)，没有有效的缓存时返回None"""
+        slot = (os.path.abspath(folder_path), compress_level)
+        with self._lock:
+            entry = self._entries.get(slot)
+        if entry is None:
+            return None
+
+        if fs_watcher.covers(folder_path):
+            # 统计不一致说明有没收到通知的修改
+            fresh = entry[1:3] == dir_stats.get(folder_path)
+        else:
+            fresh = entry[4] == folder_fingerprint(folder_path)
+
+        with self._lock:
+            if self._entries.get(slot) is not entry:
+                # 核对期间被替换或删除
+                return None
+            if not fresh:
+                self._drop(slot)
+                return None
+            self._entries.move_to_end(slot)
+            return self.path(entry[0]), entry[0]
+
+    def store(self, folder_path, compress_level, members):
+        """把members打包为ZIP流产出，同时写入缓存；同一文件夹同时只有一个请求写入"""
+        slot = (os.path.abspath(folder_path), compress_level)
+        stats = dir_stats.get(folder_path)
+        with self._lock:
+            caching = 0 < stats[1] <= self.max_entry_bytes and slot not in self._building
+            if caching:
+                self._building[slot] = True
+        if not caching:
+            yield from ZipStream(members, compress_level)
+            return
+
+        fingerprint = hashlib.sha256()
+        stream = ZipStream(fingerprint_members(members, fingerprint), compress_level)
+        key = secrets.token_hex(32)
+        tmp_path = os.path.join(self.root, f'{key}.tmp')
+        cache_file = open(tmp_path, 'wb')
+        written = 0
+        complete = False
+        try:
+            for data in stream:
+                if cache_file:
+                    written += len(data)
+                    if written > self.max_entry_bytes:
+                        # 压缩后仍超过单个缓存的上限，放弃缓存
+                        cache_file.close()
+                        cache_file = None
+                        os.remove(tmp_path)
+                    else:
+                        cache_file.write(data)
+                yield data
+            complete = True
+        finally:
+            with self._lock:
+                valid = self._building.pop(slot)
+            if cache_file:
+                cache_file.close()
+                fingerprint = fingerprint.hexdigest()
+                # 没有被监视时，生成期间的修改只能在生成后再核对一次指纹发现
+                if complete and valid and (fs_watcher.covers(folder_path)
+                                           or folder_fingerprint(folder_path) == fingerprint):
+                    self._commit(slot, key, stats, fingerprint, tmp_path, written)
+                else:
+                    os.remove(tmp_path)
+
+    def _commit(self, slot, key, stats, fingerprint, tmp_path, size):
+        os.replace(tmp_path, self.path(key))
+        with self._lock:
+            if slot in self._entries:
+                self._drop(slot)
+            self._entries[slot] = (key, stats[0], stats[1], size, fingerprint)
+            self._total += size
+            while self._total > self.max_bytes and len(self._entries) > 1:
+                self._drop(next(iter(self._entries)))
+        print(f"打包缓存: {slot[0]}, 大小: {size} bytes")
+
+    def invalidate(self, *paths):
+        """删除包含这些路径、或位于这些路径之下的文件夹的缓存，正在生成的也不再登记"""
+        targets = [os.path.abspath(p) for p in paths]
+        with self._lock:
+            for slot in self._building:
+                if any(paths_overlap(slot[0], target) for target in targets):
+                    self._building[slot] = False
+            stale = [slot for slot in self._entries
+                     if any(paths_overlap(slot[0], target) for target in targets)]
+            for slot in stale:
+                self._drop(slot)
+
+    def _drop(self, slot):
+        key, _, _, size, _ = self._entries.pop(slot)
+        self._total -= size
+        try:
+            # 正在发送的请求已打开文件，不受影响
+            os.remove(self.path(key))
+        except OSError:
+            pass
+
+
+archive_cache = ArchiveCache(ARCHIVE_CACHE_FOLDER, ARCHIVE_CACHE_SIZE, ARCHIVE_CACHE_MAX_ENTRY)
+
+
+# 分段下载清单：文件按固定大小分段，每段附带sha256，客户端可并行按Range下载、逐段校验和续传
+def segment_size_for(size):
+    """段大小为MiB的整数倍，超大文件放大段以保证段数不超过DOWNLOAD_MAX_SEGMENTS"""
+    needed = -(-size // DOWNLOAD_MAX_SEGMENTS)
+    needed = -(-needed // (1024 * 1024)) * 1024 * 1024
+    return max(DOWNLOAD_SEGMENT_SIZE, needed)
+
+
+def hash_segment(path, offset, length):
+    """计算文件中一段数据的sha256（在清单专用的线程池中执行）"""
+    digest = hashlib.sha256()
+    with open(path, 'rb') as f:
+        f.seek(offset)
+        remaining = length
+        while remaining > 0:
+            block = f.read(min(ZIP_READ_SIZE, remaining))
+            if not block:
+                raise OSError('文件在计算摘要时被截断')
+            digest.update(block)
+            remaining -= len(block)
+    return digest.hexdigest()
+
+
+class ManifestCache:
+    """按 (路径, 大小, mtime) 缓存文件的分段清单，文件变化后自然失效
+
+    清单在后台线程中构建，各段摘要交给专用的有界线程池并行计算，大文件的清单不会占用打包压缩的
+    线程，也不会让请求一直等到整个文件读完。同一文件同时被多个客户端请求时只计算一次；
+    计算期间文件被修改则丢弃结果，下次请求时重新计算。
+    """
+
+    def __init__(self, max_files=MANIFEST_CACHE_SIZE, workers=MANIFEST_WORKERS):
+        self.max_files = max_files
+        self.workers = workers
+        self._cache = OrderedDict()
+        self._pending = {}  # 键 -> {'event': 完成事件, 'hashed': 已计算的字节数}
+        self._pool = None
+        self._lock = threading.Lock()
+
+    def get(self, path, wait=0):
+        """返回 (清单, 进度)：清单就绪时进度为None；否则清单为None，进度为 (已计算字节数, 文件大小)
+
+        还没有清单时开始构建，最多等待wait秒。
+        """
+        stat = os.stat(path)
+        key = (os.path.abspath(path), stat.st_size, stat.st_mtime_ns)
+        with self._lock:
+            manifest = self._cache.get(key)
+            if manifest is not None:
+                self._cache.move_to_end(key)
+                return manifest, None
+            build = self._pending.get(key)
+            if build is None:
+                build = self._pending[key] = {'event': threading.Event(), 'hashed': 0}
+                if self._pool is None:
+                    self._pool = ThreadPoolExecutor(max_workers=self.workers, thread_name_prefix='manifest')
+                threading.Thread(target=self._run, args=(key, path, stat, build), name='manifest-build',
+                                 daemon=True).start()
+
+        if build['event'].wait(wait):
+            with self._lock:
+                manifest = self._cache.get(key)
+            if manifest is not None:
+                return manifest, None
+        return None, (build['hashed'], stat.st_size)
+
+    def _run(self, key, path, stat, build):
+        try:
+            manifest = self._build(path, stat, build)
+            if manifest is not None:
+                with self._lock:
+                    self._cache[key] = manifest
+                    while len(self._cache) > self.max_files:
+                        self._cache.popitem(last=False)
+        except Exception as e:
+            print(f"生成下载清单错误: {path}: {str(e)}")
+        finally:
+            with self._lock:
+                self._pending.pop(key, None)
+            build['event'].set()
+
+    def _build(self, path, stat, build):
+        size = stat.st_size
+        segment_size = segment_size_for(size)
+        layout = [(offset, min(segment_size, size - offset)) for offset in range(0, size, segment_size)]
+        futures = [self._pool.submit(hash_segment, path, offset, length) for offset, length in layout]
+        segments = []
+        try:
+            for i, ((offset, length), future) in enumerate(zip(layout, futures)):
+                segments.append({'index': i, 'offset': offset, 'length': length, 'sha256': future.result()})
+                build['hashed'] += length
+        finally:
+            for future in futures:
+                future.cancel()
+
+        after = os.stat(path)
+        if after.st_size != size or after.st_mtime_ns != stat.st_mtime_ns:
+            return None
+
+        return {
+            'size': size,
+            'modified': stat.st_mtime,
+            'version': f'{size}-{stat.st_mtime_ns}',
+            'segment_size': segment_size,
+            'segments': segments,
+        }
+
+
+manifest_cache = ManifestCache()
+
+
+# 分片上传暂存区：按偏移量直接写入预分配的稀疏文件
+#
+#   CHUNK_FOLDER/<上传标识>/upload.json  上传信息（目标路径、大小、分片大小、分片数）
+#   CHUNK_FOLDER/<上传标识>/data.part    预分配的稀疏文件，分片直接写到最终偏移处
+#   CHUNK_FOLDER/<上传标识>/received     每个分片一个字节，长度正确写完后置1，CRC32校验通过置2
+#   CHUNK_FOLDER/<上传标识>/checksums    每个分片4字节，校验通过的分片的CRC32
+#
+# 合并时只需检查received并把data.part原子地重命名到目标位置，不再复制数据。
+class UploadError(Exception):
+    def __init__(self, message, status=400):
+        super().__init__(message)
+        self.status = status
+
+
+# 分段锁：同一个上传的元数据创建、分片的登记与标记以及合并互斥，不同上传之间互不影响
+upload_locks = [threading.Lock() for _ in range(64)]
+upload_conditions = [threading.Condition(lock) for lock in upload_locks]
+
+# 正在写入的分片：上传标识 -> 分片序号集合，由对应的分段锁保护
+chunk_writers = {}
+
+
+def upload_lock(upload_id):
+    return upload_locks[hash(upload_id) % len(upload_locks)]
+
+
+def upload_condition(upload_id):
+    """与upload_lock使用同一把锁，分片写入结束时通知等待者"""
+    return upload_conditions[hash(upload_id) % len(upload_conditions)]
+
+
+# 最近合并完成的上传：上传标识 -> 完成时间，按完成先后排列
+finished_uploads = OrderedDict()
+finished_lock = threading.Lock()
+
+
+def mark_upload_finished(upload_id):
+    now = time.time()
+    with finished_lock:
+        finished_uploads.pop(upload_id, None)
+        finished_uploads[upload_id] = now
+        while finished_uploads and now - next(iter(finished_uploads.values())) > UPLOAD_FINISHED_TTL:
+            finished_uploads.popitem(last=False)
+
+
+def upload_finished(upload_id):
+    with finished_lock:
+        finished = finished_uploads.get(upload_id)
+    return finished is not None and time.time() - finished <= UPLOAD_FINISHED_TTL
+
+
+def wait_for_writers(upload_id):
+    """持有分段锁时调用，等待该上传所有正在进行的分片写入结束"""
+    condition = upload_condition(upload_id)
+    while chunk_writers.get(upload_id):
+        condition.wait()
+
+
+# 上传过程中按分片顺序增量计算的内容摘要：上传标识 -> [下一个待计入的分片, sha256对象]
+upload_digests = {}
+digest_locks = [threading.Lock() for _ in range(64)]
+
+
+def valid_upload_id(upload_id):
+    """上传标识会成为暂存目录名，只允许安全字符"""
+    return bool(upload_id) and bool(UPLOAD_ID_PATTERN.match(upload_id))
+
+
+def staging_dir(upload_id):
+    return os.path.join(CHUNK_FOLDER, upload_id)
+
+
+def discard_staging(upload_id):
+    """删除上传的暂存数据和进行中的摘要状态"""
+    shutil.rmtree(staging_dir(upload_id), ignore_errors=True)
+    upload_digests.pop(upload_id, None)
+    staging_area.forget(upload_id)
+
+
+# 暂存区管理：统计占用，清理长时间没有活动的上传，超出配额时按LRU淘汰
+class StagingArea:
+    """后台线程定期扫描CHUNK_FOLDER，按最后活动时间清理被放弃的上传
+
+    新建上传前按预计大小检查配额和磁盘剩余空间，不足时直接拒绝，
+    而不是写到一半或合并时才遇到磁盘写满。
+    """
+
+    def __init__(self, root, ttl, quota, interval):
+        self.root = root
+        self.ttl = ttl
+        self.quota = quota
+        self.interval = interval
+        self.lock = threading.Lock()
+        # 上传标识 -> [最后活动时间, 实际占用字节, 预计占用字节]
+        self.entries = {}
+        self.refreshed = False
+        self.last_sweep = None
+        self.thread = None
+
+    @staticmethod
+    def _measure(path):
+        """返回 (最后活动时间, 实际占用字节)；预分配的稀疏文件只计算已写入的块"""
+        last_activity = 0
+        usage = 0
+        for dirpath, dirnames, filenames in os.walk(path):
+            for name in filenames:
+                try:
+                    st = os.stat(os.path.join(dirpath, name))
+                except OSError:
+                    continue
+                last_activity = max(last_activity, st.st_mtime)
+                usage += st.st_blocks * 512 if hasattr(st, 'st_blocks') else st.st_size
+        return last_activity, usage
+
+    def refresh(self):
+        started = time.time()
+        entries = {}
+        try:
+            names = os.listdir(self.root)
+        except OSError:
+            names = []
+
+        for name in names:
+            path = os.path.join(self.root, name)
+            if not os.path.isdir(path):
+                continue
+            last_activity, usage = self._measure(path)
+            if not last_activity:
+                last_activity = os.path.getmtime(path)
+            meta = load_upload_meta(name) if valid_upload_id(name) else None
+            reserved = max(usage, meta['size']) if meta and meta.get('mode') == 'offset' else usage
+            entries[name] = [last_activity, usage, reserved]
+
+        with self.lock:
+            # 扫描期间新登记的上传还没有写入数据，保留登记
+            for upload_id, entry in self.entries.items():
+                if upload_id not in entries and entry[0] >= started:
+                    entries[upload_id] = entry
+            self.entries = entries
+            self.refreshed = True
+        return entries
+
+    def usage(self):
+        self.refresh()
+        with self.lock:
+            return {
+                'uploads': len(self.entries),
+                'used_bytes': sum(e[1] for e in self.entries.values()),
+                'reserved_bytes': sum(e[2] for e in self.entries.values()),
+                'quota_bytes': self.quota,
+                'ttl_seconds': self.ttl,
+                'last_sweep': self.last_sweep,
+            }
+
+    def admit(self, upload_id, size):
+        """新建上传前调用，配额或磁盘剩余空间不足时抛出UploadError(507)"""
+        if not self.refreshed:
+            self.refresh()
+
+        with self.lock:
+            others = [e for key, e in self.entries.items() if key != upload_id]
+            reserved = sum(e[2] for e in others)
+            if self.quota and reserved + size > self.quota:
+                raise UploadError('暂存区空间已满，请等待其他上传完成后再试', 507)
+
+            # 其他上传尚未写入的部分也要留出空间
+            pending = sum(e[2] - e[1] for e in others)
+            if size > shutil.disk_usage(self.root).free - pending:
+                raise UploadError('服务器磁盘空间不足', 507)
+
+            self.entries[upload_id] = [time.time(), 0, size]
+
+    def forget(self, upload_id):
+        with self.lock:
+            self.entries.pop(upload_id, None)
+
+    def note_write(self, upload_id, size):
+        """分片写入后更新活动时间和占用，不必等下次扫描，指标中的暂存区占用保持及时"""
+        with self.lock:
+            entry = self.entries.get(upload_id)
+            if entry is None:
+                entry = self.entries[upload_id] = [0, 0, 0]
+            entry[0] = time.time()
+            entry[1] += size
+            entry[2] = max(entry[2], entry[1])
+
+    def totals(self):
+        """返回 (上传数, 实际占用字节, 预计占用字节)，只汇总已登记的数值，不扫描磁盘"""
+        with self.lock:
+            return (len(self.entries), sum(e[1] for e in self.entries.values()),
+                    sum(e[2] for e in self.entries.values()))
+
+    def sweep(self):
+        """删除超过ttl没有活动的上传；实际占用仍超出配额时从最久没有活动的开始淘汰"""
+        now = time.time()
+        entries = self.refresh()
+        by_activity = sorted(entries.items(), key=lambda item: item[1][0])
+        used = sum(e[1] for e in entries.values())
+
+        removed = 0
+        freed = 0
+        for upload_id, (last_activity, usage, reserved) in by_activity:
+            expired = now - last_activity > self.ttl
+            if not expired and (not self.quota or used <= self.quota):
+                break
+            with upload_lock(upload_id):
+                # 正在写入分片的上传不淘汰
+                if chunk_writers.get(upload_id):
+                    continue
+                discard_staging(upload_id)
+            used -= usage
+            removed += 1
+            freed += usage
+
+        self.last_sweep = now
+        if removed:
+            print(f"暂存区清理: 删除 {removed} 个上传, 释放 {freed} bytes")
+        return removed
+
+    def start(self):
+        with self.lock:
+            if self.thread:
+                return
+            self.thread = threading.Thread(target=self._run, name='staging-sweeper', daemon=True)
+        self.thread.start()
+
+    def _run(self):
+        while True:
+            try:
+                self.sweep()
+            except Exception as e:
+                print(f"暂存区清理错误: {str(e)}")
+            time.sleep(self.interval)
+
+
+staging_area = StagingArea(CHUNK_FOLDER, STAGING_TTL, STAGING_QUOTA, STAGING_SWEEP_INTERVAL)
+metrics.gauge('filefly_uploads_in_flight', 'Uploads with data in the staging area that have not been merged.',
+              lambda: staging_area.totals()[0])
+metrics.gauge('filefly_staging_used_bytes', 'Bytes written to the staging area.', lambda: staging_area.totals()[1])
+metrics.gauge('filefly_staging_reserved_bytes', 'Bytes reserved in the staging area for admitted uploads.',
+              lambda: staging_area.totals()[2])
+metrics.gauge('filefly_staging_quota_bytes', 'Staging area quota (0 means unlimited).', lambda: staging_area.quota)
+
+
+# 后台任务：耗时的移动、复制和删除在有上限的线程池中执行，客户端轮询进度，可以取消
+class JobCancelled(Exception):
+    pass
+
+
+class FileOpError(Exception):
+    """文件操作参数或状态错误，status为返回的HTTP状态码"""
+
+    def __init__(self, message, status=400):
+        super().__init__(message)
+        self.status = status
+
+
+def upload_relative(path):
+    """上传目录下的路径转换为返回给客户端的相对路径"""
+    rel_path = os.path.relpath(path, UPLOAD_FOLDER).replace('\\', '/')
+    return '' if rel_path == '.' else rel_path
+
+
+class Job:
+    def __init__(self, kind, source=None, target=None, paths=None):
+        self.id = secrets.token_hex(8)
+        self.kind = kind  # move / copy / delete / batch
+        self.source = source
+        self.target = target
+        # 任务占用的路径，批量任务为所有涉及的路径
+        self.involved = [os.path.abspath(p) for p in (paths if paths is not None else (source, target)) if p]
+        self.status = 'queued'  # queued / scanning / running / done / failed / cancelled
+        self.total_files = 0
+        self.total_bytes = 0
+        self.done_files = 0
+        self.done_bytes = 0
+        self.error = None
+        self.result = None
+        self.created = time.time()
+        self.finished = None
+        self.cancel_event = threading.Event()
+        self.done_event = threading.Event()
+
+    def paths(self):
+        return self.involved
+
+    def check_cancelled(self):
+        if self.cancel_event.is_set():
+            raise JobCancelled()
+
+    def advance(self, files=0, nbytes=0):
+        """记录进度，同时是检查取消请求的位置"""
+        self.done_files += files
+        self.done_bytes += nbytes
+        self.check_cancelled()
+
+    def to_dict(self):
+        return {
+            'id': self.id,
+            'kind': self.kind,
+            'source': upload_relative(self.source) if self.source else None,
+            'target': upload_relative(self.target) if self.target else None,
+            'status': self.status,
+            'total_files': self.total_files,
+            'total_bytes': self.total_bytes,
+            'done_files': self.done_files,
+            'done_bytes': self.done_bytes,
+            'error': self.error,
+            'result': self.result,
+            'created': self.created,
+            'finished': self.finished,
+        }
+
+
+class JobManager:
+    """登记和执行后台任务；未结束的任务占用其源和目标路径，其他操作不能同时修改这些路径"""
+
+    def __init__(self, workers, retention):
+        self.retention = retention
+        self.pool = ThreadPoolExecutor(max_workers=workers, thread_name_prefix='job')
+        self.jobs = OrderedDict()
+        self.lock = threading.Lock()
+
+    def _busy(self, paths):
+        for job in self.jobs.values():
+            if job.finished is None and any(paths_overlap(a, b) for a in job.paths() for b in paths):
+                return True
+        return False
+
+    def busy(self, *paths):
+        paths = [os.path.abspath(p) for p in paths if p]
+        with self.lock:
+            return self._busy(paths)
+
+    def submit(self, job, fn):
+        """在线程池中执行fn(job)，返回值作为任务结果；路径被其他任务占用时抛出FileOpError(409)"""
+        now = time.time()
+        with self.lock:
+            if self._busy(job.paths()):
+                raise FileOpError('该路径正在被其他任务处理，请稍后再试', 409)
+            for stale in [key for key, item in self.jobs.items()
+                          if item.finished is not None and now - item.finished > self.retention]:
+                del self.jobs[stale]
+            self.jobs[job.id] = job
+        self.pool.submit(self._run, job, fn)
+        return job
+
+    @staticmethod
+    def _run(job, fn):
+        try:
+            job.check_cancelled()
+            job.status = 'running'
+            job.result = fn(job)
+            job.status = 'done'
+        except JobCancelled:
+            job.status = 'cancelled'
+        except Exception as e:
+            job.status = 'failed'
+            job.error = str(e)
+            print(f"后台任务失败: {job.kind} {job.source}, 错误: {e}")
+        finally:
+            job.finished = time.time()
+            job.done_event.set()
+
+    def get(self, job_id):
+        with self.lock:
+            return self.jobs.get(job_id)
+
+    def list(self):
+        with self.lock:
+            return list(self.jobs.values())
+
+
+jobs = JobManager(JOB_WORKERS, JOB_RETENTION)
+
+
+def job_response(job, message):
+    """任务很快完成时按原来的格式直接返回结果，否则返回202和任务信息，由客户端轮询"""
+    if job.done_event.wait(JOB_INLINE_WAIT):
+        if job.status == 'done':
+            return jsonify({'success': True, 'message': message, **(job.result or {})})
+        if job.status == 'cancelled':
+            return jsonify({'error': '任务已取消'}), 409
+        return jsonify({'error': job.error}), 500
+
+    return jsonify({'success': True, 'message': '任务已转入后台执行', 'job': job.to_dict()}), 202
+
+
+def scan_tree(path, job):
+    """统计要处理的文件数和字节数"""
+    job.status = 'scanning'
+    if os.path.isdir(path) and not os.path.islink(path):
+        for root, dirs, files in os.walk(path):
+            for name in files:
+                try:
+                    job.total_bytes += os.lstat(os.path.join(root, name)).st_size
+                    job.total_files += 1
+                except OSError:
+                    continue
+            job.check_cancelled()
+    else:
+        job.total_files = 1
+        job.total_bytes = os.lstat(path).st_size
+    job.status = 'running'
+
+
+def copy_file_with_progress(source, target, job):
+    if os.path.islink(source):
+        os.symlink(os.readlink(source), target)
+        job.advance(files=1)
+        return
+
+    with open(source, 'rb') as src, open(target, 'wb') as dst:
+        # 同一文件系统且支持reflink时直接共享数据块
+        cloned = False
+        if fcntl is not None and hasattr(fcntl, 'ioctl'):
+            try:
+                fcntl.ioctl(dst.fileno(), FICLONE, src.fileno())
+                cloned = True
+            except OSError:
+                pass
+
+        if cloned:
+            job.advance(nbytes=os.fstat(src.fileno()).st_size)
+        else:
+            while True:
+                block = src.read(UPLOAD_COPY_BUFFER)
+                if not block:
+                    break
+                dst.write(block)
+                job.advance(nbytes=len(block))
+
+    shutil.copystat(source, target)
+    job.advance(files=1)
+
+
+def copy_tree_with_progress(source, target, job):
+    if os.path.islink(source) or not os.path.isdir(source):
+        copy_file_with_progress(source, target, job)
+        return
+
+    os.makedirs(target)
+    copied_dirs = [(source, target)]
+    for root, dirs, files in os.walk(source):
+        dest_root = os.path.normpath(os.path.join(target, os.path.relpath(root, source)))
+        for name in dirs:
+            src_dir = os.path.join(root, name)
+            dst_dir = os.path.join(dest_root, name)
+            if os.path.islink(src_dir):
+                os.symlink(os.readlink(src_dir), dst_dir)
+            else:
+                os.makedirs(dst_dir)
+                copied_dirs.append((src_dir, dst_dir))
+        for name in files:
+            copy_file_with_progress(os.path.join(root, name), os.path.join(dest_root, name), job)
+
+    # 文件夹的时间最后复制，写入文件会改变文件夹的mtime
+    for src_dir, dst_dir in reversed(copied_dirs):
+        shutil.copystat(src_dir, dst_dir)
+
+
+def remove_path(path, job=None):
+    """删除文件或文件夹；给出job时逐个文件删除并记录进度，可以在中途取消"""
+    if os.path.islink(path) or not os.path.isdir(path):
+        os.remove(path)
+        return
+
+    if job is None:
+        shutil.rmtree(path)
+        return
+
+    for root, dirs, files in os.walk(path, topdown=False):
+        for name in files:
+            file_path = os.path.join(root, name)
+            size = os.lstat(file_path).st_size
+            os.remove(file_path)
+            job.advance(files=1, nbytes=size)
+        for name in dirs:
+            dir_path = os.path.join(root, name)
+            if os.path.islink(dir_path):
+                os.remove(dir_path)
+            else:
+                os.rmdir(dir_path)
+    os.rmdir(path)
+
+
+def copy_into_place(source, target, job):
+    """先复制到目标旁边的临时名称，完成后再改名，其他请求不会看到复制了一半的结果"""
+    tmp_path = f'{target}.{job.id}.partial'
+    try:
+        copy_tree_with_progress(source, tmp_path, job)
+        if os.path.lexists(target):
+            raise FileOpError('目标位置已存在同名文件或文件夹')
+        os.rename(tmp_path, target)
+    except BaseException:
+        if os.path.lexists(tmp_path):
+            remove_path(tmp_path)
+        raise
+
+
+def run_copy(job, source, target):
+    is_dir = os.path.isdir(source) and not os.path.islink(source)
+    scan_tree(source, job)
+    copy_into_place(source, target, job)
+    record_copied(source, target, is_dir)
+    return {'new_path': upload_relative(target)}
+
+
+def run_move(job, source, target):
+    """跨文件系统移动：复制到目标所在的文件系统，改名到位后再删除源"""
+    is_dir = os.path.isdir(source) and not os.path.islink(source)
+    scan_tree(source, job)
+    copy_into_place(source, target, job)
+    # 目标已经完整，此后不再响应取消
+    remove_path(source)
+    record_moved(source, target, is_dir)
+    return {'new_path': upload_relative(target)}
+
+
+def run_delete(job, path):
+    scan_tree(path, job)
+    try:
+        remove_path(path, job)
+    finally:
+        # 取消或失败时也要同步已经删除的部分
+        record_removed(path, True)
+    return None
+
+
+def resolve_transfer(source_path, target_dir, new_name=None):
+    """校验移动或复制的参数，返回 (源路径, 目标路径)，不合法时抛出FileOpError"""
+    if not source_path:
+        raise FileOpError('参数不完整：缺少source_path')
+
+    # 获取安全的源路径
+    source_safe_path = safe_relative_path(source_path)
+
+    if not source_safe_path:
+        raise FileOpError('无效的源文件路径')
+
+    # 修复：确保target_dir总是字符串，即使是None也转为空字符串
+    if target_dir is None:
+        target_dir = ''
+
+    # 获取安全的目标目录
+    target_safe_dir = safe_relative_path(target_dir)
+
+    if target_safe_dir is None:
+        raise FileOpError('无效的目标目录')
+
+    # 确保源路径存在
+    if not os.path.exists(source_safe_path):
+        raise FileOpError('源文件或文件夹不存在', 404)
+
+    if new_name is not None:
+        # 安全检查新文件名
+        if not new_name or secure_filename(new_name) != new_name:
+            raise FileOpError('无效的新文件名')
+
+    # 确保目标目录存在，如果不存在则创建
+    if target_safe_dir and not os.path.exists(target_safe_dir):
+        make_dirs(target_safe_dir)
+    elif target_safe_dir and not os.path.isdir(target_safe_dir):
+        raise FileOpError('目标路径不是目录')
+
+    # 构建目标路径
+    filename = new_name or os.path.basename(source_safe_path)
+    target_safe_path = os.path.join(target_safe_dir or UPLOAD_FOLDER, filename)
+
+    # 检查目标路径是否已存在
+    if os.path.exists(target_safe_path):
+        raise FileOpError('目标位置已存在同名文件或文件夹')
+
+    # 修复：正确的路径检查逻辑
+    # 1. 检查是否是移动到自身（源路径和目标路径相同）
+    if source_safe_path == target_safe_path:
+        raise FileOpError('不能移动到自身')
+
+    # 2. 检查是否是文件夹移动到自己（或自己的子文件夹）中
+    if os.path.isdir(source_safe_path):
+        if os.path.abspath(target_safe_path).startswith(os.path.abspath(source_safe_path) + os.sep):
+            raise FileOpError('不能将文件夹移动到自己的子文件夹中')
+
+    return source_safe_path, target_safe_path
+
+
+def plan_batch(operations):
+    """校验批量操作的所有项目，返回 (计划, 结果)
+
+    计划为 [(序号, 操作, 源, 目标)]；结果中无效的项目已填入错误。项目之间路径重叠（如同时删除
+    文件夹和其中的文件）或目标重复时，后出现的项目视为无效。
+    """
+    plan = []
+    results = [None] * len(operations)
+    claimed = set()  # 已被前面项目占用的路径
+    claimed_parents = set()  # 这些路径的所有上级
+
+    def overlaps(path):
+        if path in claimed_parents:
+            return True
+        current = path
+        while True:
+            if current in claimed:
+                return True
+            parent = os.path.dirname(current)
+            if parent == current:
+                return False
+            current = parent
+
+    def claim(path):
+        claimed.add(path)
+        current = os.path.dirname(path)
+        while current not in claimed_parents:
+            claimed_parents.add(current)
+            parent = os.path.dirname(current)
+            if parent == current:
+                break
+            current = parent
+
+    for index, item in enumerate(operations):
+        try:
+            if not isinstance(item, dict):
+                raise FileOpError('无效的操作')
+
+            op = item.get('op')
+            if op == 'delete':
+                path = item.get('path')
+                source = safe_relative_path(path) if isinstance(path, str) and path else None
+                if not source or os.path.abspath(source) == os.path.abspath(UPLOAD_FOLDER):
+                    raise FileOpError('无效的文件路径')
+                if not os.path.lexists(source):
+                    raise FileOpError('文件或文件夹不存在', 404)
+                target = None
+            elif op in ('move', 'copy'):
+                source, target = resolve_transfer(item.get('source_path'), item.get('target_dir'),
+                                                  item.get('new_name') if op == 'copy' else None)
+            else:
+                raise FileOpError('不支持的操作类型')
+
+            paths = [os.path.abspath(p) for p in (source, target) if p]
+            if any(overlaps(p) for p in paths):
+                raise FileOpError('与本批次中其他项目的路径重叠')
+            for p in paths:
+                claim(p)
+            plan.append((index, op, source, target))
+        except FileOpError as e:
+            results[index] = {'index': index, 'success': False, 'error': str(e), 'status': e.status}
+
+    return plan, results
+
+
+def run_batch(job, plan, results):
+    """依次执行计划中的操作，逐项记录结果；索引在全部结束后统一更新"""
+    job.total_files = len(plan)
+    removed, moved, copied = [], [], []
+    try:
+        for index, op, source, target in plan:
+            job.check_cancelled()
+            try:
+                is_dir = os.path.isdir(source) and not os.path.islink(source)
+                if op == 'delete':
+                    size = 0 if is_dir else os.lstat(source).st_size
+                    remove_path(source)
+                    removed.append((source, is_dir, size))
+                else:
+                    if os.path.lexists(target):
+                        raise FileOpError('目标位置已存在同名文件或文件夹')
+                    # 跨文件系统的移动和复制共用单项任务的复制逻辑，取消请求同样有效
+                    step = Job(op, source, target)
+                    step.cancel_event = job.cancel_event
+                    if op == 'copy':
+                        copy_into_place(source, target, step)
+                        copied.append((source, target, is_dir))
+                    else:
+                        try:
+                            os.rename(source, target)
+                        except OSError as e:
+                            if e.errno != errno.EXDEV:
+                                raise
+                            copy_into_place(source, target, step)
+                            remove_path(source)
+                        moved.append((source, target, is_dir))
+                    job.done_bytes += step.done_bytes
+                results[index] = {'index': index, 'success': True}
+                if target:
+                    results[index]['new_path'] = upload_relative(target)
+            except JobCancelled:
+                raise
+            except (FileOpError, OSError) as e:
+                results[index] = {'index': index, 'success': False, 'error': str(e)}
+            job.done_files += 1
+    finally:
+        # 取消或出错时也要同步已经完成的部分
+        record_bulk(removed, moved, copied)
+        # 取消后未执行的项目
+        for index, op, source, target in plan:
+            if results[index] is None:
+                results[index] = {'index': index, 'success': False, 'error': '任务已取消'}
+
+    return batch_summary(results)
+
+
+def batch_summary(results):
+    succeeded = sum(1 for result in results if result['success'])
+    return {'results': results, 'succeeded': succeeded, 'failed': len(results) - succeeded}
+
+
+def load_upload_meta(upload_id):
+    try:
+        with open(os.path.join(staging_dir(upload_id), 'upload.json'), 'r', encoding='utf-8') as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return None
+
+
+def save_upload_meta(upload_id, meta):
+    meta_path = os.path.join(staging_dir(upload_id), 'upload.json')
+    tmp_path = f'{meta_path}.{threading.get_ident()}.tmp'
+    with open(tmp_path, 'w', encoding='utf-8') as f:
+        json.dump(meta, f, ensure_ascii=False)
+    os.replace(tmp_path, meta_path)
+
+
+def chunk_size_bounds(size):
+    """分片大小的允许范围 (下限, 上限)：超大文件按UPLOAD_MAX_CHUNKS放大，均为1MB的整数倍"""
+    per_chunk = -(-size // UPLOAD_MAX_CHUNKS)
+    per_chunk = -(-per_chunk // UPLOAD_MIN_CHUNK_SIZE) * UPLOAD_MIN_CHUNK_SIZE
+    return max(UPLOAD_MIN_CHUNK_SIZE, per_chunk), max(UPLOAD_MAX_CHUNK_SIZE, per_chunk)
+
+
+def choose_chunk_size(size, preferred=None):
+    """由服务器决定分片大小：客户端根据测得的吞吐量和延迟给出建议值，限制在允许范围内"""
+    lower, upper = chunk_size_bounds(size)
+    chunk_size = preferred if preferred and preferred > 0 else CHUNK_SIZE
+    chunk_size = max(lower, min(chunk_size, upper))
+    return chunk_size // UPLOAD_MIN_CHUNK_SIZE * UPLOAD_MIN_CHUNK_SIZE
+
+
+def check_chunk_size(size, chunk_size):
+    """校验客户端使用的分片参数，返回分片数"""
+    if size < 0 or chunk_size <= 0:
+        raise UploadError('无效的文件大小或分片大小')
+    if size > MAX_FILE_SIZE:
+        raise UploadError('文件大小超出限制', 413)
+
+    total_chunks = max(1, -(-size // chunk_size))
+    if total_chunks > 1 and chunk_size < UPLOAD_MIN_CHUNK_SIZE:
+        raise UploadError(f'分片大小不能小于 {UPLOAD_MIN_CHUNK_SIZE} 字节')
+    _, upper = chunk_size_bounds(size)
+    if min(chunk_size, size) > upper:
+        raise UploadError(f'分片大小不能超过 {upper} 字节')
+    if total_chunks > UPLOAD_MAX_CHUNKS:
+        raise UploadError(f'分片数量不能超过 {UPLOAD_MAX_CHUNKS}')
+    return total_chunks
+
+
+def open_offset_upload(upload_id, full_path, size, chunk_size, restart=False):
+    """获取或创建按偏移写入的上传，参数与已有暂存不一致时重新开始
+
+    刚合并完成的上传标识不会因为迟到的分片重建暂存，除非restart（客户端新建上传会话）。
+    """
+    total_chunks = check_chunk_size(size, chunk_size)
+
+    with upload_lock(upload_id):
+        meta = load_upload_meta(upload_id)
+        if (meta and meta.get('mode') == 'offset' and meta['size'] == size and meta['chunk_size'] == chunk_size
+                and os.path.exists(os.path.join(staging_dir(upload_id), 'checksums'))):
+            return meta
+
+        if restart:
+            with finished_lock:
+                finished_uploads.pop(upload_id, None)
+        elif upload_finished(upload_id):
+            raise UploadError('该上传已完成，请重新创建上传会话', 409)
+
+        # 不存在、旧格式或参数变化：等按旧参数进行的写入结束后重建暂存目录
+        wait_for_writers(upload_id)
+        discard_staging(upload_id)
+        staging_area.admit(upload_id, size)
+        chunk_dir = staging_dir(upload_id)
+        os.makedirs(chunk_dir, exist_ok=True)
+
+        # 截断到目标大小得到稀疏文件，不实际占用磁盘
+        with open(os.path.join(chunk_dir, 'data.part'), 'wb') as f:
+            f.truncate(size)
+        with open(os.path.join(chunk_dir, 'received'), 'wb') as f:
+            f.truncate(total_chunks)
+        with open(os.path.join(chunk_dir, 'checksums'), 'wb') as f:
+            f.truncate(total_chunks * 4)
+
+        meta = {
+            'mode': 'offset',
+            'filepath': full_path,
+            'size': size,
+            'chunk_size': chunk_size,
+            'total_chunks': total_chunks,
+            'created': time.time(),
+        }
+        save_upload_meta(upload_id, meta)
+        return meta
+
+
+def chunk_range(meta, chunk_index):
+    """返回分片的 (偏移量, 长度)"""
+    if chunk_index < 0 or chunk_index >= meta['total_chunks']:
+        raise UploadError('分片序号超出范围')
+    offset = chunk_index * meta['chunk_size']
+    return offset, min(meta['chunk_size'], meta['size'] - offset)
+
+
+def parse_chunk_crc(value):
+    """分片的CRC32：8位十六进制字符串，未提供时返回None"""
+    if not value:
+        return None
+    try:
+        if len(value) != 8:
+            raise ValueError(value)
+        return int(value, 16)
+    except ValueError:
+        raise UploadError('无效的分片校验值')
+
+
+def write_chunk_at(upload_id, meta, chunk_index, stream, expected_crc=None):
+    """把分片数据从stream写到data.part的最终偏移处，长度和CRC32都正确才标记为已接收
+
+    已接收的分片再次上传时不再写入（网络中断后客户端重发），返回False；
+    若与已接收数据的CRC32不同则拒绝，避免覆盖已经计入摘要的数据。
+    同一分片同时只有一个写入者，重发的请求等先前的写入结束后再检查。
+    """
+    started = time.perf_counter()
+    metrics.inc('filefly_upload_chunk_writes_in_progress')
+    try:
+        written = _write_chunk_at(upload_id, meta, chunk_index, stream, expected_crc)
+    except Exception:
+        metrics.inc('filefly_upload_chunks_total', labels=(('result', 'error'),))
+        raise
+    finally:
+        metrics.inc('filefly_upload_chunk_writes_in_progress', -1)
+
+    if written:
+        metrics.observe('filefly_upload_chunk_write_seconds', time.perf_counter() - started)
+        staging_area.note_write(upload_id, chunk_range(meta, chunk_index)[1])
+    metrics.inc('filefly_upload_chunks_total', labels=(('result', 'written' if written else 'duplicate'),))
+    return written
+
+
+def _write_chunk_at(upload_id, meta, chunk_index, stream, expected_crc):
+    offset, length = chunk_range(meta, chunk_index)
+    chunk_dir = staging_dir(upload_id)
+    condition = upload_condition(upload_id)
+
+    # 检查接收标记并登记为该分片的写入者，之后直到标记完成都不会有其他请求写这一段
+    with condition:
+        while chunk_index in chunk_writers.get(upload_id, ()):
+            condition.wait()
+        try:
+            with open(os.path.join(chunk_dir, 'received'), 'rb') as f:
+                f.seek(chunk_index)
+                flag = f.read(1)
+        except FileNotFoundError:
+            raise UploadError('上传不存在或已完成，请重新上传', 409)
+        if flag and flag != b'\x00':
+            if expected_crc is not None:
+                with open(os.path.join(chunk_dir, 'checksums'), 'rb') as f:
+                    f.seek(chunk_index * 4)
+                    stored_crc = struct.unpack('>I', f.read(4))[0]
+                if stored_crc != expected_crc:
+                    raise UploadError(f'分片 {chunk_index} 已接收且内容不同', 409)
+            return False
+        chunk_writers.setdefault(upload_id, set()).add(chunk_index)
+
+    try:
+        written = 0
+        crc = 0
+        with open(os.path.join(chunk_dir, 'data.part'), 'r+b') as f:
+            f.seek(offset)
+            while written < length:
+                block = stream.read(min(UPLOAD_COPY_BUFFER, length - written))
+                if not block:
+                    break
+                f.write(block)
+                crc = zlib.crc32(block, crc)
+                written += len(block)
+
+            if written != length or stream.read(1):
+                raise UploadError(f'分片 {chunk_index} 长度不正确，期望 {length} 字节')
+
+        # 校验失败的数据不标记为已接收，重发时会被覆盖
+        if expected_crc is not None and crc != expected_crc:
+            raise UploadError(f'分片 {chunk_index} 校验失败，请重新上传', 422)
+
+        with condition:
+            with open(os.path.join(chunk_dir, 'checksums'), 'r+b') as f:
+                f.seek(chunk_index * 4)
+                f.write(struct.pack('>I', crc))
+            with open(os.path.join(chunk_dir, 'received'), 'r+b') as f:
+                f.seek(chunk_index)
+                f.write(b'\x01' if expected_crc is None else b'\x02')
+
+        # 分片乱序到达时只计入已连续的部分，其余留给后续分片或合并时计算；
+        # 计入完成前仍登记为写入者，合并不会在读取过程中移走暂存文件
+        advance_upload_digest(upload_id, meta)
+    finally:
+        with condition:
+            writers = chunk_writers.get(upload_id)
+            writers.discard(chunk_index)
+            if not writers:
+                del chunk_writers[upload_id]
+            condition.notify_all()
+    return True
+
+
+def advance_upload_digest(upload_id, meta, blocking=False):
+    """把从头开始连续已接收的分片计入摘要，全部计入后返回sha256十六进制字符串
+
+    刚写入的分片还在页缓存中，读回的代价很小；非阻塞模式下若有其他线程正在计算则直接返回。
+    """
+    lock = digest_locks[hash(upload_id) % len(digest_locks)]
+    if not lock.acquire(blocking):
+        return None
+
+    try:
+        state = upload_digests.get(upload_id)
+        if state is None:
+            state = upload_digests[upload_id] = [0, hashlib.sha256()]
+
+        total_chunks = meta['total_chunks']
+        received = set(received_chunks(upload_id))
+        if state[0] < total_chunks and state[0] in received:
+            with open(os.path.join(staging_dir(upload_id), 'data.part'), 'rb') as f:
+                while state[0] < total_chunks and state[0] in received:
+                    offset, length = chunk_range(meta, state[0])
+                    f.seek(offset)
+                    while length > 0:
+                        block = f.read(min(UPLOAD_COPY_BUFFER, length))
+                        if not block:
+                            upload_digests.pop(upload_id, None)
+                            raise UploadError('暂存文件不完整', 500)
+                        state[1].update(block)
+                        length -= len(block)
+                    state[0] += 1
+
+        if state[0] == total_chunks:
+            return state[1].hexdigest()
+        return None
+    finally:
+        lock.release()
+
+
+def received_chunks(upload_id):
+    try:
+        with open(os.path.join(staging_dir(upload_id), 'received'), 'rb') as f:
+            received = f.read()
+    except OSError:
+        return []
+    return [i for i, flag in enumerate(received) if flag]
+
+
+def finalize_offset_upload(upload_id, meta, safe_filepath, expected_digest=None):
+    """所有分片都已接收时，把暂存文件重命名到目标位置，返回 (文件大小, sha256摘要)
+
+    客户端提供了摘要时先校验，不一致说明传输中数据损坏，丢弃暂存数据让客户端重新上传。
+    """
+    with upload_lock(upload_id):
+        # 不在还有分片写入时检查或移走暂存文件
+        wait_for_writers(upload_id)
+        received = received_chunks(upload_id)
+        if len(received) != meta['total_chunks']:
+            missing = meta['total_chunks'] - len(received)
+            raise UploadError(f'还有 {missing} 个分片未上传')
+
+        part_path = os.path.join(staging_dir(upload_id), 'data.part')
+        if os.path.getsize(part_path) != meta['size']:
+            raise UploadError('暂存文件长度不正确', 500)
+
+        # 通常只剩最后几个乱序到达的分片需要计入
+        digest = advance_upload_digest(upload_id, meta, blocking=True)
+        if expected_digest and digest != expected_digest:
+            discard_staging(upload_id)
+            raise UploadError('文件内容校验失败，请重新上传', 409)
+
+        target_dir = os.path.dirname(safe_filepath)
+        if target_dir and not os.path.exists(target_dir):
+            make_dirs(target_dir)
+
+        old_size = os.path.getsize(safe_filepath) if os.path.isfile(safe_filepath) else None
+        try:
+            os.replace(part_path, safe_filepath)
+        except OSError:
+            # 暂存区与上传目录不在同一文件系统
+            shutil.move(part_path, safe_filepath)
+
+        discard_staging(upload_id)
+        mark_upload_finished(upload_id)
+        record_file_written(safe_filepath, meta['size'], old_size, digest)
+        return meta['size'], digest
+
+
+# 辅助函数：在不复制数据的前提下复制文件（优先reflink，其次硬链接）
+def clone_file(source, target):
+    """返回使用的方式 'reflink' / 'hardlink'，都不支持（或关闭了INSTANT_UPLOAD_HARDLINK）时返回None"""
+    if fcntl is not None and hasattr(fcntl, 'ioctl'):
+        tmp_path = f'{target}.{threading.get_ident()}.clone'
+        try:
+            with open(source, 'rb') as src, open(tmp_path, 'wb') as dst:
+                fcntl.ioctl(dst.fileno(), FICLONE, src.fileno())
+            os.replace(tmp_path, target)
+            return 'reflink'
+        except OSError:
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
+
+    if not INSTANT_UPLOAD_HARDLINK:
+        return None
+    try:
+        os.link(source, target)
+        return 'hardlink'
+    except OSError:
+        return None
+
+
+# 辅助函数：服务器上已有相同内容时直接完成上传
+def instant_upload(digest, size, safe_path):
+    source = content_index.lookup(digest, size)
+    if not source:
+        return None
+
+    target_dir = os.path.dirname(safe_path)
+    if target_dir and not os.path.exists(target_dir):
+        make_dirs(target_dir)
+
+    method = clone_file(source, safe_path)
+    if method:
+        record_file_written(safe_path, size, None, digest)
+        print(f"秒传完成: {safe_path} <- {source} ({method})")
+    return method
+
+
+# 辅助函数：把tar流中的文件逐个解包到目标目录
+def unpack_bundle(stream, target_path, results):
+    """边接收边写入，不落地整个包；每个文件先写临时文件再替换，结果逐个追加到results"""
+    token = secrets.token_hex(4)
+    target_root = safe_relative_path(target_path)
+    with tarfile.open(fileobj=stream, mode='r|') as archive:
+        for member in archive:
+            name = member.name
+            full_path = f"{target_path}/{name}" if target_path else name
+            safe_path = safe_relative_path(full_path)
+            # 包内路径不能通过..跳出目标目录
+            if (not safe_path or safe_path == target_root
+                    or os.path.commonpath([target_root, safe_path]) != target_root):
+                results.append({'path': name, 'success': False, 'error': '无效的文件路径'})
+                continue
+
+            if member.isdir():
+                if not os.path.isdir(safe_path):
+                    make_dirs(safe_path)
+                continue
+
+            if not member.isfile():
+                results.append({'path': name, 'success': False, 'error': '不支持的文件类型'})
+                continue
+
+            if os.path.isdir(safe_path):
+                results.append({'path': name, 'success': False, 'error': '已存在同名文件夹'})
+                continue
+
+            tmp_path = f'{safe_path}.{token}.bundle'
+            try:
+                target_dir = os.path.dirname(safe_path)
+                if target_dir and not os.path.isdir(target_dir):
+                    make_dirs(target_dir)
+
+                old_size = os.path.getsize(safe_path) if os.path.isfile(safe_path) else None
+                source = archive.extractfile(member)
+                digest = hashlib.sha256()
+                with open(tmp_path, 'wb') as f:
+                    while True:
+                        block = source.read(UPLOAD_COPY_BUFFER)
+                        if not block:
+                            break
+                        digest.update(block)
+                        f.write(block)
+                os.replace(tmp_path, safe_path)
+            except OSError as e:
+                if os.path.exists(tmp_path):
+                    os.remove(tmp_path)
+                results.append({'path': name, 'success': False, 'error': str(e)})
+                continue
+
+            record_file_written(safe_path, member.size, old_size, digest.hexdigest())
+            results.append({'path': name, 'success': True, 'size': member.size})
+
+
+# 第一个请求到来时启动后台任务（只在实际处理请求的进程中启动）
+@app.before_request
+def start_background_tasks():
+    staging_area.start()
+    if CATALOG_PATH:
+        metadata_catalog.start()
+    else:
+        search_index.start()
+    if WATCH_UPLOAD_FOLDER:
+        fs_watcher.start()
+
+
 # 主页面路由 - 文件浏览器
 @app.route('/')
 @app.route('/browse/')
@@ -144,13 +3918,11 @@ def browse(folder_path=''):
                                breadcrumbs=get_breadcrumbs(''),
                                files=[])
 
-    # 获取当前路径的文件列表
-    files = get_directory_tree(UPLOAD_FOLDER, folder_path)
-
+    # 文件列表由前端通过/api/files分页加载，这里不再扫描目录
     return render_template('index.html',
                            current_path=folder_path,
                            breadcrumbs=get_breadcrumbs(folder_path),
-                           files=files)
+                           files=[])
 
 
 # 上传检查API
@@ -166,7 +3938,7 @@ def check_file():
         filename = data.get('filename')
         target_path = data.get('target_path', '')
 
-        if not file_hash:
+        if not valid_upload_id(file_hash):
             return jsonify({'error': '缺少文件标识'}), 400
 
         # 构建完整路径
@@ -194,10 +3966,35 @@ def check_file():
             else:
                 return jsonify({'exists': True, 'is_folder': True})
 
+        # 服务器上已有相同内容的文件时直接链接过去，无需上传
+        digest = data.get('digest')
+        size = data.get('size')
+        if digest and size is not None:
+            if not isinstance(digest, str) or not DIGEST_PATTERN.match(digest):
+                return jsonify({'error': '无效的内容摘要'}), 400
+            if not str(size).isdigit():
+                return jsonify({'error': '无效的文件大小'}), 400
+            size = int(size)
+            method = instant_upload(digest, size, safe_path)
+            if method:
+                discard_staging(file_hash)
+                return jsonify({'exists': True, 'instant': True, 'method': method, 'size': size})
+
+        # 按偏移写入的上传：已接收的分片记录在received中
+        meta = load_upload_meta(file_hash)
+        if meta and meta.get('mode') == 'offset':
+            uploaded = received_chunks(file_hash)
+            return jsonify({
+                'exists': False,
+                'uploaded_chunks': [f'chunk_{i}' for i in uploaded],
+                'chunk_count': len(uploaded),
+                'chunk_size': meta['chunk_size']
+            })
+
         # 检查是否有分片存在
         chunk_dir = os.path.join(CHUNK_FOLDER, file_hash)
         if os.path.exists(chunk_dir):
-            chunks = [f for f in os.listdir(chunk_dir) if f.startswith('chunk_')]
+            chunks = [f for f in os.listdir(chunk_dir) if LEGACY_CHUNK_PATTERN.match(f)]
             uploaded_chunks = sorted(chunks, key=lambda x: int(x.split('_')[1]))
             return jsonify({
                 'exists': False,
@@ -212,6 +4009,93 @@ def check_file():
         return jsonify({'error': str(e)}), 500
 
 
+# 辅助函数：目标文件不存在时，根据暂存区判断是否有可续传的部分
+def staged_upload_status(upload_id, size):
+    meta = load_upload_meta(upload_id)
+    if meta and meta.get('mode') == 'offset' and (size is None or meta['size'] == size):
+        received = received_chunks(upload_id)
+        if received:
+            return {
+                'status': 'partial',
+                'received_chunks': received,
+                'chunk_size': meta['chunk_size'],
+                'received_bytes': sum(chunk_range(meta, i)[1] for i in received)
+            }
+    return {'status': 'missing'}
+
+
+# 批量检查文件API：上传文件夹前一次检查大量文件，每个父目录只扫描一次
+@app.route('/api/check/batch', methods=['POST'])
+def check_files_batch():
+    try:
+        data = request.get_json()
+        if not data:
+            return jsonify({'error': '无效的JSON数据'}), 400
+
+        files = data.get('files')
+        target_path = data.get('target_path', '')
+        if not isinstance(files, list):
+            return jsonify({'error': '缺少文件列表'}), 400
+        if len(files) > CHECK_BATCH_LIMIT:
+            return jsonify({'error': f'单次最多检查 {CHECK_BATCH_LIMIT} 个文件'}), 400
+
+        # 按父目录分组：父目录 -> {文件名: [请求中的序号]}
+        results = [None] * len(files)
+        by_parent = {}
+        for i, item in enumerate(files):
+            filepath = item.get('filepath') if isinstance(item, dict) else None
+            safe_path = None
+            if filepath:
+                safe_path = safe_relative_path(f"{target_path}/{filepath}" if target_path else filepath)
+            if not safe_path or safe_path == UPLOAD_FOLDER:
+                results[i] = {'status': 'invalid'}
+                continue
+
+            parent, name = os.path.split(safe_path)
+            by_parent.setdefault(parent, {}).setdefault(name, []).append(i)
+
+        for parent, wanted in by_parent.items():
+            try:
+                with os.scandir(parent) as it:
+                    for entry in it:
+                        indexes = wanted.get(entry.name)
+                        if not indexes:
+                            continue
+                        try:
+                            if entry.is_dir():
+                                result = {'status': 'folder'}
+                            else:
+                                result = {'status': 'exists', 'size': entry.stat().st_size}
+                        except OSError:
+                            continue
+                        for i in indexes:
+                            results[i] = result
+            except OSError:
+                pass  # 父目录还不存在，其中的文件都需要上传
+
+        # 其余文件看暂存区里有没有未完成的上传，暂存区也只列一次
+        try:
+            staged = set(os.listdir(CHUNK_FOLDER))
+        except OSError:
+            staged = set()
+
+        for i, item in enumerate(files):
+            if results[i] is not None:
+                continue
+            upload_id = item.get('hash')
+            size = item.get('size')
+            if isinstance(upload_id, str) and valid_upload_id(upload_id) and upload_id in staged:
+                results[i] = staged_upload_status(upload_id, size if isinstance(size, int) else None)
+            else:
+                results[i] = {'status': 'missing'}
+
+        return jsonify({'results': results})
+
+    except Exception as e:
+        print(f"批量检查错误: {str(e)}")
+        return jsonify({'error': str(e)}), 500
+
+
 # 上传分片API
 @app.route('/api/upload/chunk', methods=['POST'])
 def upload_chunk():
@@ -222,7 +4106,7 @@ def upload_chunk():
         filepath = request.form.get('filepath')
         target_path = request.form.get('target_path', '')
 
-        if not file_hash:
+        if not valid_upload_id(file_hash):
             return jsonify({'error': '缺少文件标识'}), 400
 
         if not chunk_index or not total_chunks:
@@ -231,16 +4115,40 @@ def upload_chunk():
         chunk_index = int(chunk_index)
         total_chunks = int(total_chunks)
 
+        if chunk_index < 0 or chunk_index >= total_chunks:
+            return jsonify({'error': '分片序号超出范围'}), 400
+
         file = request.files.get('chunk')
         if not file:
             return jsonify({'error': '未找到文件分片'}), 400
 
+        expected_crc = parse_chunk_crc(request.form.get('chunkCrc32'))
+
         # 构建完整文件路径
         if target_path and filepath:
             full_path = f"{target_path}/{filepath}" if target_path else filepath
         else:
             full_path = filepath or file.filename
 
+        # 提供了文件大小和分片大小时，分片直接写入预分配文件的最终偏移处
+        file_size = request.form.get('fileSize')
+        chunk_size = request.form.get('chunkSize')
+        if file_size is not None and chunk_size is not None:
+            if not safe_relative_path(full_path):
+                return jsonify({'error': '无效的文件路径'}), 400
+
+            meta = open_offset_upload(file_hash, full_path, int(file_size), int(chunk_size))
+            if meta['total_chunks'] != total_chunks:
+                return jsonify({'error': '分片数量与文件大小不符'}), 400
+
+            write_chunk_at(file_hash, meta, chunk_index, file.stream, expected_crc)
+
+            return jsonify({
+                'success': True,
+                'chunk': chunk_index,
+                'message': f'分片 {chunk_index + 1}/{total_chunks} 上传成功'
+            })
+
         # 创建chunk目录
         chunk_dir = os.path.join(CHUNK_FOLDER, file_hash)
 
@@ -256,7 +4164,28 @@ def upload_chunk():
         chunk_filename = f'chunk_{chunk_index}'
         chunk_path = os.path.join(chunk_dir, chunk_filename)
 
-        file.save(chunk_path)
+        # 先写临时文件，校验通过才以chunk_N出现，合并时不会读到写了一半的分片
+        tmp_path = f'{chunk_path}.{threading.get_ident()}.part'
+        started = time.perf_counter()
+        crc = 0
+        size = 0
+        with open(tmp_path, 'wb') as f:
+            while True:
+                block = file.stream.read(UPLOAD_COPY_BUFFER)
+                if not block:
+                    break
+                crc = zlib.crc32(block, crc)
+                f.write(block)
+                size += len(block)
+
+        if expected_crc is not None and crc != expected_crc:
+            os.remove(tmp_path)
+            metrics.inc('filefly_upload_chunks_total', labels=(('result', 'error'),))
+            return jsonify({'error': f'分片 {chunk_index} 校验失败，请重新上传'}), 422
+        os.replace(tmp_path, chunk_path)
+        metrics.observe('filefly_upload_chunk_write_seconds', time.perf_counter() - started)
+        metrics.inc('filefly_upload_chunks_total', labels=(('result', 'written'),))
+        staging_area.note_write(file_hash, size)
 
         return jsonify({
             'success': True,
@@ -264,10 +4193,154 @@ def upload_chunk():
             'message': f'分片 {chunk_index + 1}/{total_chunks} 上传成功'
         })
 
+    except UploadError as e:
+        return jsonify({'error': str(e)}), e.status
+    except Exception as e:
+        return jsonify({'error': str(e)}), 500
+
+
+# 上传分片API（原始请求体）：不经过multipart解析，请求体直接写入暂存文件的最终偏移处
+@app.route('/api/upload/chunk/<upload_id>/<int:chunk_index>', methods=['PUT'])
+def upload_chunk_raw(upload_id, chunk_index):
+    try:
+        if not valid_upload_id(upload_id):
+            return jsonify({'error': '缺少文件标识'}), 400
+
+        # 分片信息放在请求头中，路径经过URL编码
+        try:
+            file_size = int(request.headers['X-File-Size'])
+            chunk_size = int(request.headers['X-Chunk-Size'])
+        except (KeyError, ValueError):
+            return jsonify({'error': '缺少分片信息'}), 400
+
+        filepath = unquote(request.headers.get('X-File-Path', ''))
+        target_path = unquote(request.headers.get('X-Target-Path', ''))
+        full_path = f"{target_path}/{filepath}" if target_path else filepath
+
+        if not filepath or not safe_relative_path(full_path):
+            return jsonify({'error': '无效的文件路径'}), 400
+
+        meta = open_offset_upload(upload_id, full_path, file_size, chunk_size)
+        total_chunks = request.headers.get('X-Total-Chunks')
+        if total_chunks is not None and int(total_chunks) != meta['total_chunks']:
+            return jsonify({'error': '分片数量与文件大小不符'}), 400
+
+        _, length = chunk_range(meta, chunk_index)
+        if (request.content_length or 0) != length:
+            return jsonify({'error': f'分片 {chunk_index} 长度不正确，期望 {length} 字节'}), 400
+
+        expected_crc = parse_chunk_crc(request.headers.get('X-Chunk-Crc32'))
+        written = write_chunk_at(upload_id, meta, chunk_index, request.stream, expected_crc)
+
+        return jsonify({
+            'success': True,
+            'chunk': chunk_index,
+            'duplicate': not written,
+            'message': f'分片 {chunk_index + 1}/{meta["total_chunks"]} 上传成功'
+        })
+
+    except UploadError as e:
+        return jsonify({'error': str(e)}), e.status
     except Exception as e:
         return jsonify({'error': str(e)}), 500
 
 
+# 创建上传会话API：由服务器决定分片大小，返回已接收的分片以便续传
+@app.route('/api/upload/session', methods=['POST'])
+def create_upload_session():
+    try:
+        data = request.get_json()
+        if not data:
+            return jsonify({'error': '无效的JSON数据'}), 400
+
+        # 客户端按文件路径、大小和修改时间生成标识，重新选择同一文件时得到同一会话
+        session_id = data.get('hash') or secrets.token_hex(16)
+        filepath = data.get('filepath')
+        filename = data.get('filename')
+        target_path = data.get('target_path', '')
+
+        if not valid_upload_id(session_id):
+            return jsonify({'error': '无效的会话标识'}), 400
+
+        if filepath:
+            full_path = f"{target_path}/{filepath}" if target_path else filepath
+        elif filename:
+            full_path = f"{target_path}/{filename}" if target_path else filename
+        else:
+            return jsonify({'error': '缺少文件路径或文件名'}), 400
+
+        if not safe_relative_path(full_path):
+            return jsonify({'error': '无效的文件路径'}), 400
+
+        try:
+            size = int(data.get('size'))
+            preferred = int(data.get('chunk_size') or 0)
+        except (TypeError, ValueError):
+            return jsonify({'error': '缺少文件大小'}), 400
+
+        # 已有接收的分片时沿用原来的分片大小，这些分片才能继续使用；还没有分片的会话
+        # （例如在测得吞吐量之前创建、随后暂停的文件）按客户端当前建议的大小重新划分
+        meta = load_upload_meta(session_id)
+        if (meta and meta.get('mode') == 'offset' and meta['size'] == size
+                and (received_chunks(session_id) or not preferred)):
+            chunk_size = meta['chunk_size']
+        else:
+            chunk_size = choose_chunk_size(size, preferred)
+
+        meta = open_offset_upload(session_id, full_path, size, chunk_size, restart=True)
+        received = received_chunks(session_id)
+
+        return jsonify({
+            'session_id': session_id,
+            'chunk_size': meta['chunk_size'],
+            'total_chunks': meta['total_chunks'],
+            'max_parallel': UPLOAD_MAX_PARALLEL,
+            'received_chunks': received,
+            'received_bytes': sum(chunk_range(meta, i)[1] for i in received)
+        })
+
+    except UploadError as e:
+        return jsonify({'error': str(e)}), e.status
+    except Exception as e:
+        print(f"创建上传会话错误: {str(e)}")
+        return jsonify({'error': str(e)}), 500
+
+
+# 小文件打包上传API：请求体是tar流，边接收边解包到目标目录，返回每个文件的结果
+@app.route('/api/upload/bundle', methods=['PUT'])
+def upload_bundle():
+    try:
+        target_path = unquote(request.headers.get('X-Target-Path', ''))
+        if target_path and not safe_relative_path(target_path):
+            return jsonify({'error': '无效的目标路径'}), 400
+
+        if request.content_length is None:
+            return jsonify({'error': '缺少请求长度'}), 411
+        if request.content_length > UPLOAD_BUNDLE_MAX_SIZE:
+            return jsonify({'error': f'文件包不能超过 {UPLOAD_BUNDLE_MAX_SIZE} 字节'}), 413
+
+        results = []
+        try:
+            unpack_bundle(request.stream, target_path, results)
+        except (tarfile.TarError, EOFError) as e:
+            # 已解包的文件保留，客户端重试时会覆盖
+            return jsonify({'error': f'文件包格式错误: {str(e)}', 'results': results}), 400
+
+        succeeded = sum(1 for r in results if r['success'])
+        print(f"打包上传完成: {target_path or '/'}, 成功 {succeeded}/{len(results)} 个文件")
+
+        return jsonify({
+            'success': True,
+            'results': results,
+            'succeeded': succeeded,
+            'failed': len(results) - succeeded
+        })
+
+    except Exception as e:
+        print(f"打包上传错误: {str(e)}")
+        return jsonify({'error': str(e)}), 500
+
+
 # 合并分片API
 @app.route('/api/upload/merge', methods=['POST'])
 def merge_chunks():
@@ -281,7 +4354,7 @@ def merge_chunks():
         filename = data.get('filename')
         target_path = data.get('target_path', '')
 
-        if not file_hash:
+        if not valid_upload_id(file_hash):
             return jsonify({'error': '缺少文件标识'}), 400
 
         # 构建完整路径
@@ -299,10 +4372,32 @@ def merge_chunks():
         if not safe_filepath:
             return jsonify({'error': '无效的文件路径'}), 400
 
+        # 客户端计算的内容摘要（可选），用于校验合并结果
+        expected_digest = data.get('digest')
+        if expected_digest and not DIGEST_PATTERN.match(expected_digest):
+            return jsonify({'error': '无效的内容摘要'}), 400
+
+        # 按偏移写入的上传：只需确认分片齐全并重命名
+        meta = load_upload_meta(file_hash)
+        if meta and meta.get('mode') == 'offset':
+            started = time.perf_counter()
+            file_size, digest = finalize_offset_upload(file_hash, meta, safe_filepath, expected_digest)
+            metrics.observe('filefly_upload_merge_seconds', time.perf_counter() - started, (('mode', 'offset'),))
+            print(f"文件上传完成: {full_path}, 大小: {file_size} bytes")
+
+            return jsonify({
+                'success': True,
+                'filename': os.path.basename(full_path),
+                'filepath': full_path,
+                'size': file_size,
+                'digest': digest,
+                'message': '文件合并成功'
+            })
+
         # 确保目标目录存在 - 递归创建所有需要的目录
         target_dir = os.path.dirname(safe_filepath)
         if target_dir and not os.path.exists(target_dir):
-            os.makedirs(target_dir, exist_ok=True)
+            make_dirs(target_dir)
             print(f"已创建目录: {target_dir}")
 
         # 确定chunk目录位置
@@ -320,31 +4415,66 @@ def merge_chunks():
         if not os.path.exists(chunk_dir):
             return jsonify({'error': '分片目录不存在'}), 400
 
-        # 查找所有分片文件
-        chunk_files = []
-        for root, dirs, files in os.walk(chunk_dir):
-            for file in files:
-                if file.startswith('chunk_'):
-                    chunk_files.append(os.path.join(root, file))
+        # 查找所有分片文件：分片序号 -> 路径（不包括还在写入的临时文件）
+        found = {}
+        for name in os.listdir(chunk_dir):
+            match = LEGACY_CHUNK_PATTERN.match(name)
+            if match:
+                found[int(match.group(1))] = os.path.join(chunk_dir, name)
 
-        if not chunk_files:
+        if not found:
             return jsonify({'error': '未找到分片文件'}), 400
 
-        # 按分片索引排序
-        chunk_files.sort(key=lambda x: int(os.path.basename(x).split('_')[1]))
-        total_chunks = len(chunk_files)
+        # 必须正好是 0..totalChunks-1 的全部分片，缺失或多余都不合并
+        try:
+            total_chunks = int(data.get('totalChunks'))
+        except (TypeError, ValueError):
+            return jsonify({'error': '缺少分片数量'}), 400
+        missing = [i for i in range(total_chunks) if i not in found]
+        if missing:
+            return jsonify({'error': f'还有 {len(missing)} 个分片未上传', 'missing_chunks': missing[:100]}), 400
+        if len(found) != total_chunks:
+            return jsonify({'error': '分片数量与上传时不符'}), 400
+
+        # 除最后一个外所有分片长度相同，最后一个不超过前面的分片
+        chunk_files = [found[i] for i in range(total_chunks)]
+        sizes = [os.path.getsize(path) for path in chunk_files]
+        if any(size != sizes[0] for size in sizes[:-1]) or sizes[-1] > sizes[0]:
+            return jsonify({'error': '分片长度不一致，请重新上传'}), 400
+        expected_size = data.get('fileSize')
+        if expected_size is not None and sum(sizes) != int(expected_size):
+            return jsonify({'error': '分片总长度与文件大小不符'}), 400
 
         # 合并分片
         print(f"开始合并文件: {safe_filepath}, 分片数: {total_chunks}")
-        with open(safe_filepath, 'wb') as output_file:
+        started = time.perf_counter()
+        old_size = os.path.getsize(safe_filepath) if os.path.isfile(safe_filepath) else None
+        # 先写到临时文件再替换，不会原地截断可能被硬链接共享的旧文件
+        digest = hashlib.sha256()
+        merging_path = f'{safe_filepath}.{file_hash}.merging'
+        with open(merging_path, 'wb') as output_file:
             for chunk_path in chunk_files:
                 with open(chunk_path, 'rb') as chunk_file:
-                    output_file.write(chunk_file.read())
+                    while True:
+                        block = chunk_file.read(UPLOAD_COPY_BUFFER)
+                        if not block:
+                            break
+                        digest.update(block)
+                        output_file.write(block)
+
+        if expected_digest and digest.hexdigest() != expected_digest:
+            os.remove(merging_path)
+            discard_staging(file_hash)
+            return jsonify({'error': '文件内容校验失败，请重新上传'}), 409
+
+        os.replace(merging_path, safe_filepath)
 
         # 清理chunks目录
-        shutil.rmtree(os.path.join(CHUNK_FOLDER, file_hash), ignore_errors=True)
+        discard_staging(file_hash)
 
         file_size = os.path.getsize(safe_filepath)
+        record_file_written(safe_filepath, file_size, old_size, digest.hexdigest())
+        metrics.observe('filefly_upload_merge_seconds', time.perf_counter() - started, (('mode', 'legacy'),))
         print(f"文件合并成功: {full_path}, 大小: {file_size} bytes")
 
         return jsonify({
@@ -352,35 +4482,231 @@ def merge_chunks():
             'filename': os.path.basename(full_path),
             'filepath': full_path,
             'size': file_size,
+            'digest': digest.hexdigest(),
             'message': '文件合并成功'
         })
 
+    except UploadError as e:
+        return jsonify({'error': str(e)}), e.status
     except Exception as e:
         print(f"合并分片错误: {str(e)}")
         return jsonify({'error': str(e)}), 500
 
 
-# 获取文件列表API（支持路径参数）
+# 获取文件列表API（支持路径、分页、排序和类型过滤）
 @app.route('/api/files', methods=['GET'])
 def get_files():
     try:
         # 获取路径参数
         path = request.args.get('path', '')
+        sort = request.args.get('sort', 'name')
+        order = request.args.get('order', 'asc')
+        item_type = request.args.get('type') or None
+        cursor = request.args.get('cursor') or None
+        limit = request.args.get('limit')
+
+        if sort not in LISTING_SORT_KEYS:
+            return jsonify({'error': '无效的排序方式'}), 400
+        if order not in ('asc', 'desc'):
+            return jsonify({'error': '无效的排序方向'}), 400
+        if item_type not in (None, 'file', 'folder'):
+            return jsonify({'error': '无效的类型过滤'}), 400
+
+        if limit is not None:
+            try:
+                limit = min(max(int(limit), 1), LISTING_MAX_LIMIT)
+            except ValueError:
+                return jsonify({'error': '无效的分页大小'}), 400
 
-        # 获取指定路径的文件列表
-        files = get_directory_tree(UPLOAD_FOLDER, path)
+        decoded_cursor = None
+        if cursor:
+            decoded_cursor = decode_cursor(cursor)
+            if decoded_cursor is None:
+                return jsonify({'error': '无效的分页游标'}), 400
 
-        return jsonify({
+        full_path = safe_relative_path(path)
+        if not full_path or not os.path.isdir(full_path):
+            # 与之前一致：不存在的路径返回空列表
+            return jsonify({
+                'success': True,
+                'path': path,
+                'files': [],
+                'total': 0,
+                'next_cursor': None,
+                'breadcrumbs': get_breadcrumbs(path)
+            })
+
+        # 文件夹未变化时直接返回304，不扫描目录
+        mtime_ns = os.stat(full_path).st_mtime_ns
+        etag = hashlib.md5(
+            f'{os.path.abspath(full_path)}|{mtime_ns}|{change_log.epoch}|{dir_listings.version(full_path)}|{sort}|{order}|'
+            f'{item_type}|{cursor}|{limit}'.encode('utf-8')
+        ).hexdigest()
+        if request.if_none_match.contains_weak(etag):
+            response = Response(status=304)
+            response.set_etag(etag, weak=True)
+            return response
+
+        # 先取令牌再列目录，之后的变更都能从变更接口取到
+        change_token = change_log.token
+        files, next_cursor, total = list_directory(full_path, sort, order == 'desc', item_type,
+                                                   decoded_cursor, limit)
+
+        response = jsonify({
             'success': True,
             'path': path,
             'files': files,
-            'breadcrumbs': get_breadcrumbs(path)
+            'total': total,
+            'next_cursor': next_cursor,
+            'breadcrumbs': get_breadcrumbs(path),
+            'change_token': change_token
+        })
+        response.set_etag(etag, weak=True)
+        response.headers['Cache-Control'] = 'no-cache'
+        return response
+
+    except Exception as e:
+        return jsonify({'error': str(e)}), 500
+
+
+# 文件名搜索API：在整个上传目录（或path指定的文件夹下）按名称查找
+#   q=子串  prefix=名称前缀  ext=扩展名（逗号分隔，如 jpg,png）  type=file/folder  limit=最多返回数
+@app.route('/api/search', methods=['GET'])
+def search_files():
+    try:
+        started = time.time()
+        query = request.args.get('q', '').strip()
+        prefix = request.args.get('prefix', '').strip()
+        extensions = [ext.strip() for ext in request.args.get('ext', '').split(',') if ext.strip(' .')]
+        path = request.args.get('path', '')
+        item_type = request.args.get('type') or None
+        limit = request.args.get('limit', SEARCH_DEFAULT_LIMIT)
+
+        if not query and not prefix and not extensions:
+            return jsonify({'error': '请提供搜索条件：q、prefix或ext'}), 400
+        if item_type not in (None, 'file', 'folder'):
+            return jsonify({'error': '无效的类型过滤'}), 400
+        try:
+            limit = min(max(int(limit), 1), SEARCH_MAX_LIMIT)
+        except ValueError:
+            return jsonify({'error': '无效的结果数量'}), 400
+
+        scope_path = safe_relative_path(path)
+        if scope_path is None:
+            return jsonify({'error': '无效的路径'}), 400
+        scope = upload_relative(scope_path)
+
+        matches, truncated = search_index.search(query, prefix, extensions, scope, item_type, limit)
+
+        # 只对返回的条目stat，索引中已经不存在的条目（API之外删除）跳过
+        results = []
+        for rel_dir, name, is_dir in matches:
+            try:
+                entry = make_entry(os.path.join(UPLOAD_FOLDER, rel_dir), rel_dir, name, is_dir)
+            except OSError:
+                continue
+            entry['parent'] = rel_dir
+            results.append(entry)
+        results.sort(key=lambda entry: entry['path'].lower())
+
+        return jsonify({
+            'success': True,
+            'path': scope,
+            'results': results,
+            'truncated': truncated,
+            'ready': search_index.ready,
+            'took_ms': round((time.time() - started) * 1000, 2)
         })
 
     except Exception as e:
+        print(f"搜索错误: {str(e)}")
         return jsonify({'error': str(e)}), 500
 
 
+# 辅助函数：筛选发生在path文件夹内（含子文件夹）的变更
+def changes_within(events, path):
+    if not path:
+        return events
+    prefix = path + '/'
+    return [event for event in events
+            if event['path'].startswith(prefix) or (event['old_path'] or '').startswith(prefix)
+            or path in (event['path'], event['old_path'])]
+
+
+# 变更API：返回令牌之后的变更；没有since时只返回当前令牌
+#   since=令牌  path=只返回该文件夹内的变更  wait=没有变更时最多等待的秒数（长轮询）
+# 令牌无效或已过期时返回reset，客户端应重新加载列表
+@app.route('/api/changes', methods=['GET'])
+def get_changes():
+    try:
+        since = request.args.get('since')
+        path = request.args.get('path', '').strip('/')
+        try:
+            wait = min(max(float(request.args.get('wait', 0)), 0), CHANGE_MAX_WAIT)
+            limit = min(max(int(request.args.get('limit', CHANGE_LOG_SIZE)), 1), CHANGE_LOG_SIZE)
+        except ValueError:
+            return jsonify({'error': '无效的参数'}), 400
+
+        if not since:
+            return jsonify({'success': True, 'token': change_log.token, 'events': [], 'reset': False})
+
+        seq = change_log.parse(since)
+        if seq is None:
+            return jsonify({'success': True, 'token': change_log.token, 'events': [], 'reset': True})
+
+        if wait:
+            change_log.wait(seq, wait)
+        events, last = change_log.since(seq, limit)
+        if events is None:
+            return jsonify({'success': True, 'token': change_log.token_for(last), 'events': [], 'reset': True})
+        return jsonify({'success': True, 'token': change_log.token_for(last),
+                        'events': changes_within(events, path), 'reset': False})
+
+    except Exception as e:
+        return jsonify({'error': str(e)}), 500
+
+
+# 变更事件流API（Server-Sent Events）：有变更时推送，断线重连时通过Last-Event-ID续传
+@app.route('/api/changes/stream', methods=['GET'])
+def stream_changes():
+    since = request.headers.get('Last-Event-ID') or request.args.get('since')
+    path = request.args.get('path', '').strip('/')
+
+    if not change_log.open_stream(CHANGE_STREAM_LIMIT):
+        return jsonify({'error': '事件流连接过多，请改用轮询'}), 503
+
+    def generate():
+        # 浏览器断线后按retry指定的毫秒数重连
+        yield 'retry: 3000\n\n'
+        seq = change_log.parse(since) if since else None
+        if seq is None:
+            seq = change_log.seq
+            if since:
+                yield f'id: {change_log.token_for(seq)}\nevent: reset\ndata: {{}}\n\n'
+
+        while True:
+            if not change_log.wait(seq, CHANGE_STREAM_KEEPALIVE):
+                yield ': keepalive\n\n'
+                continue
+            events, seq = change_log.since(seq)
+            token = change_log.token_for(seq)
+            if events is None:
+                # 客户端接收太慢，事件已超出保留范围
+                yield f'id: {token}\nevent: reset\ndata: {{}}\n\n'
+                continue
+            events = changes_within(events, path)
+            if events:
+                data = json.dumps({'token': token, 'events': events}, ensure_ascii=False)
+                yield f'id: {token}\nevent: changes\ndata: {data}\n\n'
+
+    # 客户端断开后服务器写入失败时关闭响应，释放名额
+    response = Response(generate(), mimetype='text/event-stream')
+    response.call_on_close(change_log.close_stream)
+    response.headers['Cache-Control'] = 'no-cache'
+    response.headers['X-Accel-Buffering'] = 'no'
+    return response
+
+
 # 删除文件/文件夹API
 @app.route('/api/files/delete', methods=['POST'])
 def delete_file():
@@ -397,26 +4723,51 @@ def delete_file():
         # 获取安全的绝对路径
         safe_path = safe_relative_path(filepath)
 
-        if not safe_path:
+        # 与批量删除相同：'.'等指向共享目录本身的路径不能删除
+        if not safe_path or os.path.abspath(safe_path) == os.path.abspath(UPLOAD_FOLDER):
             return jsonify({'error': '无效的文件路径'}), 400
 
         if not os.path.exists(safe_path):
             return jsonify({'error': '文件或文件夹不存在'}), 404
 
-        # 删除文件或文件夹
+        if jobs.busy(safe_path):
+            return jsonify({'error': '该路径正在被其他任务处理，请稍后再试'}), 409
+
+        # 删除文件；文件夹在后台任务中逐个删除，可以查看进度
         if os.path.isfile(safe_path):
+            size = os.path.getsize(safe_path)
             os.remove(safe_path)
-            message = '文件已删除'
-        else:
-            shutil.rmtree(safe_path)
-            message = '文件夹已删除'
+            record_removed(safe_path, False, size)
+            return jsonify({'success': True, 'message': '文件已删除'})
+
+        job = jobs.submit(Job('delete', safe_path), lambda job: run_delete(job, safe_path))
+        return job_response(job, '文件夹已删除')
+
+    except FileOpError as e:
+        return jsonify({'error': str(e)}), e.status
+    except Exception as e:
+        return jsonify({'error': str(e)}), 500
 
-        return jsonify({'success': True, 'message': message})
 
+# 暂存区占用API
+@app.route('/api/upload/staging', methods=['GET'])
+def staging_usage():
+    try:
+        usage = staging_area.usage()
+        usage['free_bytes'] = shutil.disk_usage(CHUNK_FOLDER).free
+        return jsonify(usage)
     except Exception as e:
         return jsonify({'error': str(e)}), 500
 
 
+# 运行指标API：Prometheus文本格式
+@app.route('/metrics', methods=['GET'])
+def metrics_endpoint():
+    if not metrics.enabled:
+        return jsonify({'error': '未启用运行指标'}), 404
+    return Response(metrics.render(), content_type='text/plain; version=0.0.4; charset=utf-8')
+
+
 # 取消上传API
 @app.route('/api/upload/cancel', methods=['POST'])
 def cancel_upload():
@@ -427,12 +4778,10 @@ def cancel_upload():
 
         file_hash = data.get('hash')
 
-        if not file_hash:
+        if not valid_upload_id(file_hash):
             return jsonify({'error': '缺少文件标识'}), 400
 
-        chunk_dir = os.path.join(CHUNK_FOLDER, file_hash)
-        if os.path.exists(chunk_dir):
-            shutil.rmtree(chunk_dir, ignore_errors=True)
+        discard_staging(file_hash)
 
         return jsonify({'success': True, 'message': '上传已取消'})
 
@@ -468,6 +4817,9 @@ def rename_file():
         if not os.path.exists(old_safe_path):
             return jsonify({'error': '文件或文件夹不存在'}), 404
 
+        if jobs.busy(old_safe_path):
+            return jsonify({'error': '该路径正在被其他任务处理，请稍后再试'}), 409
+
         # 构建新路径
         dir_path = os.path.dirname(old_safe_path)
         new_safe_path = os.path.join(dir_path, safe_new_name)
@@ -477,7 +4829,9 @@ def rename_file():
             return jsonify({'error': '目标名称已存在'}), 400
 
         # 重命名
+        is_dir = os.path.isdir(old_safe_path)
         os.rename(old_safe_path, new_safe_path)
+        record_moved(old_safe_path, new_safe_path, is_dir)
 
         # 返回新相对路径
         new_rel_path = os.path.relpath(new_safe_path, UPLOAD_FOLDER)
@@ -500,88 +4854,113 @@ def move_file():
         if not data:
             return jsonify({'error': '无效的JSON数据'}), 400
 
-        source_path = data.get('source_path')
-        target_dir = data.get('target_dir')
-
-        # 修复：确保target_dir总是字符串，即使是None也转为空字符串
-        if target_dir is None:
-            target_dir = ''
+        source_safe_path, target_safe_path = resolve_transfer(data.get('source_path'), data.get('target_dir'))
+        if jobs.busy(source_safe_path, target_safe_path):
+            return jsonify({'error': '该路径正在被其他任务处理，请稍后再试'}), 409
 
-        if not source_path:
-            return jsonify({'error': '参数不完整：缺少source_path'}), 400
+        # 同一文件系统内直接改名，瞬间完成；跨文件系统时转为后台任务复制后删除
+        is_dir = os.path.isdir(source_safe_path)
+        try:
+            os.rename(source_safe_path, target_safe_path)
+        except OSError as e:
+            if e.errno != errno.EXDEV:
+                raise
+            job = jobs.submit(Job('move', source_safe_path, target_safe_path),
+                              lambda job: run_move(job, source_safe_path, target_safe_path))
+            return job_response(job, '移动成功')
 
-        # 获取安全的源路径
-        source_safe_path = safe_relative_path(source_path)
+        record_moved(source_safe_path, target_safe_path, is_dir)
 
-        if not source_safe_path:
-            return jsonify({'error': '无效的源文件路径'}), 400
+        return jsonify({
+            'success': True,
+            'message': '移动成功',
+            'new_path': upload_relative(target_safe_path)
+        })
 
-        # 获取安全的目标目录
-        target_safe_dir = safe_relative_path(target_dir)
+    except FileOpError as e:
+        return jsonify({'error': str(e)}), e.status
+    except Exception as e:
+        import traceback
+        traceback.print_exc()
+        return jsonify({'error': str(e)}), 500
 
-        if target_safe_dir is None:
-            return jsonify({'error': '无效的目标目录'}), 400
 
-        # 确保源路径存在
-        if not os.path.exists(source_safe_path):
-            return jsonify({'error': '源文件或文件夹不存在'}), 404
+# 复制文件/文件夹API：在后台任务中执行，可选new_name指定副本名称
+@app.route('/api/files/copy', methods=['POST'])
+def copy_file():
+    try:
+        data = request.get_json()
+        if not data:
+            return jsonify({'error': '无效的JSON数据'}), 400
 
-        # 确保目标目录存在，如果不存在则创建
-        if target_safe_dir and not os.path.exists(target_safe_dir):
-            os.makedirs(target_safe_dir, exist_ok=True)
-        elif target_safe_dir and not os.path.isdir(target_safe_dir):
-            return jsonify({'error': '目标路径不是目录'}), 400
+        source_safe_path, target_safe_path = resolve_transfer(data.get('source_path'), data.get('target_dir'),
+                                                              data.get('new_name'))
+        job = jobs.submit(Job('copy', source_safe_path, target_safe_path),
+                          lambda job: run_copy(job, source_safe_path, target_safe_path))
+        return job_response(job, '复制成功')
 
-        # 构建目标路径
-        filename = os.path.basename(source_safe_path)
-        target_safe_path = os.path.join(target_safe_dir, filename) if target_safe_dir else os.path.join(UPLOAD_FOLDER,
-                                                                                                        filename)
+    except FileOpError as e:
+        return jsonify({'error': str(e)}), e.status
+    except Exception as e:
+        import traceback
+        traceback.print_exc()
+        return jsonify({'error': str(e)}), 500
 
-        # 检查目标路径是否已存在
-        if os.path.exists(target_safe_path):
-            return jsonify({'error': '目标位置已存在同名文件或文件夹'}), 400
 
-        # 修复：正确的路径检查逻辑
-        # 1. 检查是否是移动到自身（源路径和目标路径相同）
-        if source_safe_path == target_safe_path:
-            return jsonify({'error': '不能移动到自身'}), 400
+# 批量文件操作API：一次提交多个删除、移动、复制操作
+#   {"operations": [{"op": "delete", "path": "a.txt"},
+#                   {"op": "move", "source_path": "b", "target_dir": "c"},
+#                   {"op": "copy", "source_path": "d", "target_dir": "", "new_name": "d2"}]}
+# 执行前先校验所有项目，无效的项目直接返回错误，其余按顺序执行并逐项返回结果
+@app.route('/api/files/batch', methods=['POST'])
+def batch_operations():
+    try:
+        data = request.get_json(silent=True)
+        operations = data.get('operations') if isinstance(data, dict) else None
+        if not isinstance(operations, list) or not operations:
+            return jsonify({'error': '缺少操作列表'}), 400
+        if len(operations) > BATCH_OPERATION_LIMIT:
+            return jsonify({'error': f'单次最多 {BATCH_OPERATION_LIMIT} 个操作'}), 413
+
+        plan, results = plan_batch(operations)
+        if not plan:
+            return jsonify({'error': '没有可执行的操作', **batch_summary(results)}), 400
+
+        paths = [path for _, _, source, target in plan for path in (source, target) if path]
+        job = jobs.submit(Job('batch', paths=paths), lambda job: run_batch(job, plan, results))
+        return job_response(job, '批量操作完成')
+
+    except FileOpError as e:
+        return jsonify({'error': str(e)}), e.status
+    except Exception as e:
+        import traceback
+        traceback.print_exc()
+        return jsonify({'error': str(e)}), 500
 
-        # 2. 检查是否是文件夹移动到自己的子文件夹中
-        # 只有当源路径是文件夹且目标路径是源路径的子目录时才不允许
-        if os.path.isdir(source_safe_path):
-            # 规范化路径进行比较
-            source_norm = os.path.normpath(source_safe_path)
-            target_norm = os.path.normpath(target_safe_dir) if target_safe_dir else os.path.normpath(UPLOAD_FOLDER)
 
-            # 检查目标路径是否是源路径的子目录
-            try:
-                # 计算相对路径，如果是子目录，相对路径不会以..开头
-                rel_path = os.path.relpath(target_norm, source_norm)
-                # 如果相对路径不是以..开头，并且不等于.，则说明目标路径是源路径的子目录
-                if not rel_path.startswith('..') and rel_path != '.':
-                    return jsonify({'error': '不能将文件夹移动到自己的子文件夹中'}), 400
-            except ValueError:
-                # 如果无法计算相对路径（如在不同的驱动器上），则忽略此检查
-                pass
+# 后台任务API：列出最近的任务
+@app.route('/api/jobs', methods=['GET'])
+def list_jobs():
+    return jsonify({'jobs': [job.to_dict() for job in jobs.list()]})
 
-        # 移动
-        shutil.move(source_safe_path, target_safe_path)
 
-        # 返回新相对路径
-        new_rel_path = os.path.relpath(target_safe_path, UPLOAD_FOLDER)
-        if new_rel_path == '.':
-            new_rel_path = ''
+# 后台任务API：查询任务状态和进度
+@app.route('/api/jobs/<job_id>', methods=['GET'])
+def job_status(job_id):
+    job = jobs.get(job_id)
+    if not job:
+        return jsonify({'error': '任务不存在'}), 404
+    return jsonify(job.to_dict())
 
-        return jsonify({
-            'success': True,
-            'message': '移动成功',
-            'new_path': new_rel_path.replace('\\', '/')
-        })
 
-    except Exception as e:
-        import traceback
-        traceback.print_exc()
-        return jsonify({'error': str(e)}), 500
+# 后台任务API：取消任务，已完成的部分不会回滚（复制和移动会清理未完成的目标）
+@app.route('/api/jobs/<job_id>/cancel', methods=['POST'])
+def cancel_job(job_id):
+    job = jobs.get(job_id)
+    if not job:
+        return jsonify({'error': '任务不存在'}), 404
+    job.cancel_event.set()
+    return jsonify({'success': True, 'job': job.to_dict()})
 
 
 # 创建文件夹API
@@ -620,7 +4999,7 @@ def create_folder():
             return jsonify({'error': '文件夹已存在'}), 400
 
         # 创建文件夹
-        os.makedirs(full_path, exist_ok=True)
+        make_dirs(full_path)
 
         # 返回相对路径
         rel_path = os.path.relpath(full_path, UPLOAD_FOLDER)
@@ -636,7 +5015,19 @@ def create_folder():
         return jsonify({'error': str(e)}), 500
 
 
-# 批量下载API
+# 辅助函数：批量下载的成员列表
+def iter_batch_members(files, folders):
+    """依次产出选中的文件和文件夹内的文件，打包时才访问文件系统"""
+    for file_path, arcname in files:
+        if os.path.isfile(file_path):
+            yield file_path, arcname
+
+    for folder_path, folder_name in folders:
+        if os.path.isdir(folder_path):
+            yield from iter_folder_members(folder_path, folder_name)
+
+
+# 批量下载API：登记选中的项目，返回一次性的下载令牌
 @app.route('/api/files/batch-download', methods=['POST'])
 def batch_download():
     try:
@@ -646,48 +5037,41 @@ def batch_download():
 
         files = data.get('files', [])
         folders = data.get('folders', [])
-        current_path = data.get('current_path', '')
+        if not isinstance(files, list) or not isinstance(folders, list):
+            return jsonify({'error': '无效的文件列表'}), 400
 
         if len(files) == 0 and len(folders) == 0:
             return jsonify({'error': '没有选择文件或文件夹'}), 400
 
-        # 创建一个临时目录来存放所有文件
-        import tempfile
-        import uuid
-
-        temp_dir = tempfile.mkdtemp()
-        zip_filename = f"batch_download_{uuid.uuid4().hex[:8]}.zip"
-        zip_path = os.path.join(temp_dir, zip_filename)
-
-        # 创建zip文件
-        with zipfile.ZipFile(zip_path, 'w', zipfile.ZIP_DEFLATED) as zipf:
-            # 添加文件
-            for file_info in files:
-                file_path = safe_relative_path(file_info['path'])
-                if file_path and os.path.exists(file_path):
-                    # 在zip中的相对路径
-                    arcname = file_info['name']
-                    zipf.write(file_path, arcname)
-
-            # 添加文件夹
-            for folder_info in folders:
-                folder_path = safe_relative_path(folder_info['path'])
-                if folder_path and os.path.exists(folder_path):
-                    for root, dirs, files_in_folder in os.walk(folder_path):
-                        for file in files_in_folder:
-                            file_path = os.path.join(root, file)
-                            # 在zip中的相对路径
-                            rel_path = os.path.relpath(file_path, folder_path)
-                            arcname = os.path.join(folder_info['name'], rel_path)
-                            zipf.write(file_path, arcname)
-
-        # 将zip文件移动到uploads目录以供下载
-        final_zip_path = os.path.join(UPLOAD_FOLDER, zip_filename)
-        shutil.move(zip_path, final_zip_path)
+        # 预先校验路径，ZIP内的名称由服务器根据路径决定
+        selected_files = []
+        for file_info in files:
+            path = file_info.get('path') if isinstance(file_info, dict) else None
+            file_path = safe_relative_path(path) if isinstance(path, str) else None
+            if not file_path or file_path == UPLOAD_FOLDER:
+                return jsonify({'error': f"无效的文件路径: {path}"}), 400
+            selected_files.append((file_path, os.path.basename(file_path)))
+
+        selected_folders = []
+        for folder_info in folders:
+            path = folder_info.get('path') if isinstance(folder_info, dict) else None
+            folder_path = safe_relative_path(path) if isinstance(path, str) else None
+            if not folder_path or folder_path == UPLOAD_FOLDER:
+                return jsonify({'error': f"无效的文件夹路径: {path}"}), 400
+            selected_folders.append((folder_path, os.path.basename(folder_path)))
+
+        token = secrets.token_urlsafe(16)
+        now = time.time()
+        with batch_downloads_lock:
+            # 顺便清理过期的令牌
+            for expired in [t for t, item in batch_downloads.items() if item[0] < now]:
+                del batch_downloads[expired]
+            batch_downloads[token] = (now + BATCH_TOKEN_TTL, selected_files, selected_folders)
 
         return jsonify({
             'success': True,
-            'download_url': f'/download/{zip_filename}',
+            'download_url': f'/api/files/batch-download/{token}',
+            'expires_in': BATCH_TOKEN_TTL,
             'file_count': len(files) + len(folders),
             'message': '批量下载文件已准备就绪'
         })
@@ -698,6 +5082,24 @@ def batch_download():
         return jsonify({'error': str(e)}), 500
 
 
+# 批量下载API：凭令牌边打包边下载，令牌只能使用一次
+@app.route('/api/files/batch-download/<token>', methods=['GET'])
+def batch_download_stream(token):
+    compress_level = requested_zip_level()
+    if compress_level is None:
+        return jsonify({'error': '无效的压缩级别'}), 400
+
+    with batch_downloads_lock:
+        item = batch_downloads.pop(token, None)
+
+    if not item or item[0] < time.time():
+        return jsonify({'error': '下载链接无效或已过期'}), 404
+
+    _, files, folders = item
+    zip_filename = f"batch_download_{token[:8]}.zip"
+    return zip_response(ZipStream(iter_batch_members(files, folders), compress_level), zip_filename)
+
+
 # 下载文件夹API - 确保正确压缩为ZIP
 @app.route('/download-folder/<path:folder_path>')
 def download_folder(folder_path):
@@ -711,44 +5113,68 @@ def download_folder(folder_path):
         if not os.path.exists(safe_folder_path) or not os.path.isdir(safe_folder_path):
             return jsonify({'error': '文件夹不存在'}), 404
 
-        # 创建内存中的zip文件
-        memory_file = BytesIO()
+        compress_level = requested_zip_level()
+        if compress_level is None:
+            return jsonify({'error': '无效的压缩级别'}), 400
+
         folder_name = os.path.basename(folder_path) or f'folder_{int(time.time())}'
+        download_name = f'{folder_name}.zip'
 
-        with zipfile.ZipFile(memory_file, 'w', zipfile.ZIP_DEFLATED) as zf:
-            for root, dirs, files in os.walk(safe_folder_path):
-                # 计算在zip中的相对路径
-                relative_root = os.path.relpath(root, safe_folder_path)
+        # 内容没有变化时直接发送缓存的压缩包，支持断点续传和分段下载
+        cached = archive_cache.lookup(safe_folder_path, compress_level)
+        if cached:
+            try:
+                cached_path, key = cached
+                response = send_file(cached_path, mimetype='application/zip', as_attachment=True,
+                                     download_name=download_name, conditional=True, etag=key)
+                metrics.inc('filefly_archive_cache_requests_total', labels=(('result', 'hit'),))
+                return response
+            except FileNotFoundError:
+                pass  # 刚好被淘汰，重新生成
+
+        metrics.inc('filefly_archive_cache_requests_total', labels=(('result', 'miss'),))
+        # 边遍历边压缩边发送，同时写入缓存
+        members = iter_folder_members(safe_folder_path)
+        return zip_response(archive_cache.store(safe_folder_path, compress_level, members), download_name)
 
-                for file in files:
-                    file_path = os.path.join(root, file)
-                    # 在zip中的相对路径
-                    if relative_root == '.':
-                        arcname = file
-                    else:
-                        arcname = os.path.join(relative_root, file)
+    except Exception as e:
+        print(f"下载文件夹错误: {str(e)}")
+        return jsonify({'error': str(e)}), 500
 
-                    # 确保路径使用正斜杠
-                    arcname = arcname.replace('\\', '/')
 
-                    try:
-                        zf.write(file_path, arcname)
-                    except Exception as e:
-                        print(f"无法添加文件到ZIP: {file_path}, 错误: {e}")
-                        continue
+# 分段下载清单API：返回文件大小、分段方式和每段的sha256
+@app.route('/api/files/manifest', methods=['GET'])
+def file_manifest():
+    try:
+        filepath = request.args.get('path', '')
+        safe_path = safe_relative_path(filepath)
+        if not safe_path:
+            return jsonify({'error': '无效的文件路径'}), 400
 
-        memory_file.seek(0)
+        if not os.path.isfile(safe_path):
+            return jsonify({'error': '文件不存在'}), 404
 
-        # 返回ZIP文件
-        return send_file(
-            memory_file,
-            as_attachment=True,
-            download_name=f'{folder_name}.zip',
-            mimetype='application/zip'
-        )
+        # 大文件的清单在后台计算，没有及时算完时返回202和进度，客户端稍后再取
+        manifest, progress = manifest_cache.get(safe_path, MANIFEST_INLINE_WAIT)
+        if manifest is None:
+            response = jsonify({
+                'status': 'building',
+                'hashed_bytes': progress[0],
+                'size': progress[1],
+                'message': '正在计算分段摘要，请稍后再试'
+            })
+            response.status_code = 202
+            response.headers['Retry-After'] = '1'
+            return response
+
+        manifest = dict(manifest)
+        manifest['path'] = filepath
+        manifest['sha256'] = content_index.digest_of(safe_path)  # 整个文件的摘要，未知时为None
+        manifest['download_url'] = f"/download/{quote(filepath)}"
+        return jsonify(manifest)
 
     except Exception as e:
-        print(f"下载文件夹错误: {str(e)}")
+        print(f"生成下载清单错误: {str(e)}")
         return jsonify({'error': str(e)}), 500
 
 
@@ -774,7 +5200,7 @@ def download_file(filepath):
         dir_path = os.path.dirname(safe_path)
 
         return send_from_directory(
-            dir_path,
+            os.path.abspath(dir_path),
             filename,
             as_attachment=True,
             mimetype='application/octet-stream'
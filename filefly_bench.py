@@ -0,0 +1,518 @@
+"""FileFly 性能基准测试
+
+在临时目录中生成可重复的合成文件树（深层嵌套、超宽文件夹、大量小文件、少量大文件），
+分别通过Flask测试客户端（进程内）和本地真实服务器（子进程，HTTP）驱动上传、合并、
+文件列表和文件夹打包下载接口，报告吞吐量、延迟百分位、峰值RSS和写盘字节数。
+结果以JSON输出，同样的参数在不同提交上运行即可比较。
+
+用法：
+    python filefly_bench.py
+    python filefly_bench.py --scenario many-small --mode client -o before.json
+    python filefly_bench.py --scale 0.1 --jobs 8
+
+峰值RSS和写盘字节数读取/proc，只在Linux上提供，其他系统为null。
+"""
+import os
+import sys
+import json
+import time
+import zlib
+import random
+import shutil
+import hashlib
+import argparse
+import platform
+import tempfile
+import threading
+import subprocess
+import http.client
+from datetime import datetime, timezone
+from urllib.parse import quote, urlencode
+from concurrent.futures import ThreadPoolExecutor
+
+SCENARIOS = ('deep', 'wide', 'many-small', 'few-huge')
+POOL_SIZE = 1024 * 1024  # 生成文件内容用的随机数据池
+READ_SIZE = 1024 * 1024
+LIST_PASSES = 3  # 文件列表重复的轮数，第一轮之后命中服务器的列表缓存
+BENCH_DIR = os.path.dirname(os.path.abspath(__file__))
+
+
+# 合成文件树：返回 (文件列表[(相对路径, 大小)], 文件夹列表)，同样的种子和规模得到同样的树
+def build_spec(scenario, scale, rng):
+    def scaled(n):
+        return max(1, int(n * scale))
+
+    files = []
+    folders = ['']
+    if scenario == 'deep':
+        # 48层嵌套，每层几个小文件
+        path = ''
+        for level in range(48):
+            path = f'{path}/d{level:02d}' if path else f'd{level:02d}'
+            folders.append(path)
+            for i in range(scaled(5)):
+                files.append((f'{path}/f{i}.dat', rng.randint(1024, 32 * 1024)))
+    elif scenario == 'wide':
+        # 一个文件夹里有大量文件和子文件夹
+        for i in range(scaled(5000)):
+            files.append((f'wide/f{i:05d}.txt', rng.randint(256, 4096)))
+        folders.append('wide')
+        for i in range(scaled(200)):
+            folders.append(f'wide/sub{i:03d}')
+            files.append((f'wide/sub{i:03d}/readme.txt', 512))
+    elif scenario == 'many-small':
+        # 多个文件夹，每个文件夹里几百个小文件
+        for d in range(scaled(40)):
+            folders.append(f'set{d:02d}')
+            for i in range(100):
+                files.append((f'set{d:02d}/f{i:03d}.bin', rng.randint(512, 16 * 1024)))
+    elif scenario == 'few-huge':
+        for i in range(4):
+            files.append((f'huge{i}.bin', scaled(128) * 1024 * 1024 + rng.randint(0, 1024 * 1024)))
+    else:
+        raise ValueError(scenario)
+    return files, folders
+
+
+def iter_content(pool, seed, size):
+    """以数据池的不同旋转位置拼出文件内容：确定、不可压缩，生成时几乎不耗CPU"""
+    view = memoryview(pool)
+    offset = (seed * 7919) % len(pool)
+    while size > 0:
+        length = min(size, len(pool) - offset)
+        yield view[offset:offset + length]
+        size -= length
+        offset = (offset + 104729) % len(pool)
+
+
+def generate_tree(root, files, pool):
+    """写出源文件，返回每个文件的sha256（合并时提交给服务器校验，与网页客户端一致）"""
+    digests = []
+    for index, (rel_path, size) in enumerate(files):
+        path = os.path.join(root, rel_path)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        digest = hashlib.sha256()
+        with open(path, 'wb') as f:
+            for block in iter_content(pool, index, size):
+                digest.update(block)
+                f.write(block)
+        digests.append(digest.hexdigest())
+    return digests
+
+
+# 进程资源：峰值RSS（VmHWM，可通过clear_refs重置）和实际写到存储层的字节数
+def read_proc_io(pid):
+    try:
+        with open(f'/proc/{pid}/io') as f:
+            fields = dict(line.split(': ') for line in f.read().splitlines())
+        return {key: int(value) for key, value in fields.items()}
+    except (OSError, ValueError):
+        return None
+
+
+def reset_peak_rss(pid):
+    try:
+        with open(f'/proc/{pid}/clear_refs', 'w') as f:
+            f.write('5')
+    except OSError:
+        pass
+
+
+def peak_rss(pid):
+    try:
+        with open(f'/proc/{pid}/status') as f:
+            for line in f:
+                if line.startswith('VmHWM:'):
+                    return int(line.split()[1]) * 1024
+    except OSError:
+        pass
+    return None
+
+
+class PhaseMeter:
+    """统计一个阶段：墙钟时间、各类请求的延迟、被测进程的峰值RSS和写盘字节数"""
+
+    def __init__(self, pid):
+        self.pid = pid
+        self.latencies = {}
+        self.lock = threading.Lock()
+
+    def __enter__(self):
+        reset_peak_rss(self.pid)
+        self.io_before = read_proc_io(self.pid)
+        self.started = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc_info):
+        self.seconds = time.perf_counter() - self.started
+        self.io_after = read_proc_io(self.pid)
+        self.peak_rss = peak_rss(self.pid)
+
+    def record(self, kind, seconds):
+        with self.lock:
+            self.latencies.setdefault(kind, []).append(seconds)
+
+    def result(self, scenario, mode, operation, count, nbytes):
+        disk_written = written_calls = None
+        if self.io_before and self.io_after:
+            disk_written = ((self.io_after['write_bytes'] - self.io_after.get('cancelled_write_bytes', 0))
+                            - (self.io_before['write_bytes'] - self.io_before.get('cancelled_write_bytes', 0)))
+            written_calls = self.io_after['wchar'] - self.io_before['wchar']
+        return {
+            'scenario': scenario,
+            'mode': mode,
+            'operation': operation,
+            'count': count,
+            'bytes': nbytes,
+            'seconds': round(self.seconds, 6),
+            'ops_per_second': round(count / self.seconds, 3) if self.seconds else None,
+            'bytes_per_second': round(nbytes / self.seconds, 1) if self.seconds else None,
+            'latency_ms': {kind: latency_summary(values) for kind, values in sorted(self.latencies.items())},
+            'peak_rss_bytes': self.peak_rss,
+            'disk_write_bytes': disk_written,
+            'write_call_bytes': written_calls,
+        }
+
+
+def latency_summary(values):
+    """最近秩法计算百分位，单位毫秒"""
+    ordered = sorted(values)
+
+    def percentile(p):
+        return round(ordered[max(0, -(-len(ordered) * p // 100) - 1)] * 1000, 3)
+
+    return {
+        'count': len(ordered),
+        'mean': round(sum(ordered) / len(ordered) * 1000, 3),
+        'p50': percentile(50),
+        'p90': percentile(90),
+        'p99': percentile(99),
+        'max': round(ordered[-1] * 1000, 3),
+    }
+
+
+class BenchError(Exception):
+    pass
+
+
+# 驱动：进程内的Flask测试客户端，和子进程中通过HTTP访问的真实服务器，接口相同
+class ClientDriver:
+    mode = 'client'
+
+    def __init__(self, workdir):
+        os.chdir(workdir)
+        sys.path.insert(0, BENCH_DIR)
+        import app
+        self.app = app
+        self.pid = os.getpid()
+        self.local = threading.local()
+
+    def request(self, method, path, body=None, headers=None, sink=False):
+        """返回 (状态码, 响应体)；sink为True时只统计响应体长度，不保留数据"""
+        client = getattr(self.local, 'client', None)
+        if client is None:
+            client = self.local.client = self.app.app.test_client()
+        response = client.open(path, method=method, data=body, headers=headers or {}, buffered=False)
+        try:
+            if sink:
+                return response.status_code, sum(len(block) for block in response.response)
+            return response.status_code, response.get_data()
+        finally:
+            response.close()
+
+    def close(self):
+        pass
+
+
+class ServerDriver:
+    mode = 'server'
+
+    def __init__(self, workdir):
+        self.log = open(os.path.join(workdir, 'server.log'), 'wb')
+        self.process = subprocess.Popen([sys.executable, os.path.abspath(__file__), '--serve'], cwd=workdir,
+                                        stdout=subprocess.PIPE, stderr=self.log)
+        line = self.process.stdout.readline()
+        if not line:
+            raise BenchError('本地服务器启动失败，详见 server.log')
+        self.port = int(line)
+        self.pid = self.process.pid
+        self.local = threading.local()
+
+    def _connection(self, fresh=False):
+        connection = getattr(self.local, 'connection', None)
+        if connection is None or fresh:
+            if connection is not None:
+                connection.close()
+            connection = self.local.connection = http.client.HTTPConnection('127.0.0.1', self.port, timeout=600)
+        return connection
+
+    def request(self, method, path, body=None, headers=None, sink=False):
+        # 保持连接；服务器关闭了空闲连接时重连一次
+        for attempt in range(2):
+            connection = self._connection(fresh=attempt > 0)
+            try:
+                connection.request(method, path, body=body, headers=headers or {})
+                response = connection.getresponse()
+                if sink:
+                    received = 0
+                    while True:
+                        block = response.read(READ_SIZE)
+                        if not block:
+                            break
+                        received += len(block)
+                    return response.status, received
+                return response.status, response.read()
+            except (http.client.RemoteDisconnected, BrokenPipeError, ConnectionResetError):
+                if attempt:
+                    raise
+
+    def close(self):
+        self.process.terminate()
+        self.process.wait()
+        self.log.close()
+
+
+def serve():
+    """--serve：在当前目录运行服务器，端口号写到标准输出后开始处理请求"""
+    sys.path.insert(0, BENCH_DIR)
+    import logging
+    from werkzeug.serving import make_server, WSGIRequestHandler
+    import app
+
+    logging.getLogger('werkzeug').setLevel(logging.ERROR)
+    WSGIRequestHandler.protocol_version = 'HTTP/1.1'
+    server = make_server('127.0.0.1', 0, app.app, threaded=True)
+    stdout = sys.stdout
+    sys.stdout = open(os.devnull, 'w')  # 服务器日志不参与计时
+    stdout.write(f'{server.server_port}\n')
+    stdout.flush()
+    server.serve_forever()
+
+
+def call_json(driver, meter, kind, method, path, payload=None, body=None, headers=None):
+    if payload is not None:
+        body = json.dumps(payload).encode('utf-8')
+        headers = {'Content-Type': 'application/json'}
+    started = time.perf_counter()
+    status, data = driver.request(method, path, body, headers)
+    meter.record(kind, time.perf_counter() - started)
+    if not 200 <= status < 300:
+        raise BenchError(f'{method} {path}: HTTP {status} {data[:200]!r}')
+    return json.loads(data) if data else None
+
+
+# 各阶段
+def bench_upload(driver, scenario, source_root, target, files, digests, jobs):
+    """按网页客户端的方式上传：创建会话、按服务器给出的分片大小PUT分片（带CRC32）、合并（带sha256）"""
+
+    def upload(index):
+        rel_path, size = files[index]
+        session = call_json(driver, meter, 'session', 'POST', '/api/upload/session', {
+            'hash': f'bench-{driver.mode}-{scenario}-{index}', 'filepath': rel_path, 'target_path': target,
+            'size': size})
+        chunk_size = session['chunk_size']
+        with open(os.path.join(source_root, rel_path), 'rb') as f:
+            for chunk_index in range(session['total_chunks']):
+                chunk = f.read(chunk_size)
+                headers = {
+                    'Content-Type': 'application/octet-stream',
+                    'X-File-Size': str(size),
+                    'X-Chunk-Size': str(chunk_size),
+                    'X-Total-Chunks': str(session['total_chunks']),
+                    'X-File-Path': quote(rel_path),
+                    'X-Target-Path': quote(target),
+                    'X-Chunk-Crc32': f'{zlib.crc32(chunk):08x}',
+                }
+                call_json(driver, meter, 'chunk', 'PUT',
+                          f"/api/upload/chunk/{session['session_id']}/{chunk_index}", body=chunk, headers=headers)
+        call_json(driver, meter, 'merge', 'POST', '/api/upload/merge', {
+            'hash': session['session_id'], 'filepath': rel_path, 'target_path': target,
+            'totalChunks': session['total_chunks'], 'digest': digests[index]})
+
+    with PhaseMeter(driver.pid) as meter:
+        with ThreadPoolExecutor(max_workers=jobs) as pool:
+            for future in [pool.submit(upload, index) for index in range(len(files))]:
+                future.result()
+    return meter.result(scenario, driver.mode, 'upload', len(files), sum(size for _, size in files))
+
+
+def bench_list(driver, scenario, target, folders):
+    """逐页列出每个文件夹，重复LIST_PASSES轮"""
+    received = 0
+    pages = 0
+    with PhaseMeter(driver.pid) as meter:
+        for _ in range(LIST_PASSES):
+            for folder in folders:
+                cursor = None
+                while True:
+                    params = {'path': f'{target}/{folder}'.rstrip('/')}
+                    if cursor:
+                        params['cursor'] = cursor
+                    result = call_json(driver, meter, 'page', 'GET', f'/api/files?{urlencode(params)}')
+                    received += len(result['files'])
+                    pages += 1
+                    cursor = result.get('next_cursor')
+                    if not cursor:
+                        break
+    result = meter.result(scenario, driver.mode, 'list', pages, 0)
+    result['entries'] = received
+    return result
+
+
+def bench_listing(driver, scenario, target, folders):
+    """直接调用list_directory取整个文件夹的列表，不经过HTTP（只在进程内模式下测量）"""
+    app = driver.app
+    entries = 0
+    with PhaseMeter(driver.pid) as meter:
+        for _ in range(LIST_PASSES):
+            for folder in folders:
+                full_path = app.safe_relative_path(f'{target}/{folder}'.rstrip('/'))
+                started = time.perf_counter()
+                entries += len(app.list_directory(full_path)[0])
+                meter.record('call', time.perf_counter() - started)
+    result = meter.result(scenario, driver.mode, 'list-direct', LIST_PASSES * len(folders), 0)
+    result['entries'] = entries
+    return result
+
+
+def bench_archive(driver, scenario, target, operation):
+    """下载整个文件夹的ZIP：第一次边打包边发送并写入打包缓存，第二次直接发送缓存文件"""
+    with PhaseMeter(driver.pid) as meter:
+        started = time.perf_counter()
+        status, received = driver.request('GET', f'/download-folder/{quote(target)}', sink=True)
+        meter.record('download', time.perf_counter() - started)
+    if status != 200:
+        raise BenchError(f'GET /download-folder/{target}: HTTP {status}')
+    return meter.result(scenario, driver.mode, operation, 1, received)
+
+
+def run_driver(driver, scenarios, trees, jobs, progress):
+    results = []
+    for scenario in scenarios:
+        source_root, files, folders, digests = trees[scenario]
+        target = f'bench/{scenario}'
+        progress(f'[{driver.mode}] {scenario}: 上传 {len(files)} 个文件')
+        results.append(bench_upload(driver, scenario, source_root, target, files, digests, jobs))
+        progress(f'[{driver.mode}] {scenario}: 文件列表')
+        results.append(bench_list(driver, scenario, target, folders))
+        if driver.mode == 'client':
+            results.append(bench_listing(driver, scenario, target, folders))
+        progress(f'[{driver.mode}] {scenario}: 打包下载')
+        results.append(bench_archive(driver, scenario, target, 'archive'))
+        results.append(bench_archive(driver, scenario, target, 'archive-cached'))
+    return results
+
+
+def git_revision():
+    try:
+        revision = subprocess.run(['git', 'rev-parse', 'HEAD'], cwd=BENCH_DIR, capture_output=True, text=True,
+                                  check=True).stdout.strip()
+        dirty = bool(subprocess.run(['git', 'status', '--porcelain', '--untracked-files=no'], cwd=BENCH_DIR,
+                                    capture_output=True, text=True, check=True).stdout.strip())
+        return revision, dirty
+    except (OSError, subprocess.CalledProcessError):
+        return None, None
+
+
+def format_summary(results):
+    lines = [f"{'scenario':<11} {'mode':<6} {'operation':<15} {'count':>7} {'MB/s':>9} {'ops/s':>9} "
+             f"{'p50 ms':>8} {'p99 ms':>8} {'RSS MB':>7} {'disk MB':>8}"]
+    for r in results:
+        # 上传阶段看分片请求，其余阶段只有一类请求
+        latency = r['latency_ms'].get('chunk') or next(iter(r['latency_ms'].values()))
+        mbps = r['bytes_per_second'] / 1e6 if r['bytes'] else 0
+        rss = r['peak_rss_bytes'] / 2 ** 20 if r['peak_rss_bytes'] is not None else float('nan')
+        disk = r['disk_write_bytes'] / 1e6 if r['disk_write_bytes'] is not None else float('nan')
+        lines.append(f"{r['scenario']:<11} {r['mode']:<6} {r['operation']:<15} {r['count']:>7} {mbps:>9.1f} "
+                     f"{r['ops_per_second']:>9.1f} {latency['p50']:>8.2f} {latency['p99']:>8.2f} "
+                     f"{rss:>7.1f} {disk:>8.1f}")
+    return '\n'.join(lines)
+
+
+def main():
+    parser = argparse.ArgumentParser(description='FileFly性能基准测试：上传、合并、文件列表和打包下载')
+    parser.add_argument('--scenario', action='append', choices=SCENARIOS,
+                        help='要运行的文件树，可重复指定（默认全部）')
+    parser.add_argument('--mode', choices=('client', 'server', 'both'), default='both',
+                        help='client: 进程内测试客户端；server: 本地HTTP服务器；默认两者都运行')
+    parser.add_argument('--scale', type=float, default=1.0, help='文件数量和大文件大小的缩放系数（默认1）')
+    parser.add_argument('-j', '--jobs', type=int, default=4, help='同时上传的文件数（默认4）')
+    parser.add_argument('--seed', type=int, default=1, help='生成文件树的随机种子（默认1）')
+    parser.add_argument('-o', '--output', help='JSON结果写入该文件，默认输出到标准输出')
+    parser.add_argument('--workdir', help='工作目录，默认使用临时目录并在结束后删除')
+    parser.add_argument('--serve', action='store_true', help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.serve:
+        serve()
+        return
+
+    scenarios = args.scenario or list(SCENARIOS)
+    output = os.path.abspath(args.output) if args.output else None
+    workdir = os.path.abspath(args.workdir) if args.workdir else tempfile.mkdtemp(prefix='filefly-bench-')
+    keep = bool(args.workdir)
+    stdout = sys.stdout
+
+    def progress(message):
+        print(message, file=sys.stderr, flush=True)
+
+    try:
+        rng = random.Random(args.seed)
+        pool = random.Random(args.seed).randbytes(POOL_SIZE)
+        trees = {}
+        for scenario in scenarios:
+            source_root = os.path.join(workdir, 'source', scenario)
+            files, folders = build_spec(scenario, args.scale, rng)
+            progress(f'生成文件树 {scenario}: {len(files)} 个文件, {sum(s for _, s in files) / 1e6:.1f} MB')
+            trees[scenario] = (source_root, files, folders, generate_tree(source_root, files, pool))
+
+        results = []
+        modes = ('client', 'server') if args.mode == 'both' else (args.mode,)
+        for mode in modes:
+            mode_dir = os.path.join(workdir, mode)
+            os.makedirs(mode_dir, exist_ok=True)
+            if mode == 'client':
+                # 应用的日志不计入测量，也不能混进标准输出的JSON
+                sys.stdout = open(os.devnull, 'w')
+                driver = ClientDriver(mode_dir)
+            else:
+                driver = ServerDriver(mode_dir)
+            try:
+                results += run_driver(driver, scenarios, trees, args.jobs, progress)
+            finally:
+                driver.close()
+                os.chdir(workdir)
+
+        revision, dirty = git_revision()
+        report = {
+            'meta': {
+                'timestamp': datetime.now(timezone.utc).isoformat(timespec='seconds'),
+                'git_revision': revision,
+                'git_dirty': dirty,
+                'python': platform.python_version(),
+                'platform': platform.platform(),
+                'cpu_count': os.cpu_count(),
+                'scenarios': scenarios,
+                'scale': args.scale,
+                'jobs': args.jobs,
+                'seed': args.seed,
+            },
+            'results': results,
+        }
+        progress(format_summary(results))
+        if output:
+            with open(output, 'w', encoding='utf-8') as f:
+                json.dump(report, f, indent=2, ensure_ascii=False)
+                f.write('\n')
+        else:
+            json.dump(report, stdout, indent=2, ensure_ascii=False)
+            stdout.write('\n')
+    finally:
+        # 应用的后台线程可能还在输出日志，标准输出保持重定向直到进程退出
+        if not keep:
+            os.chdir(BENCH_DIR)
+            shutil.rmtree(workdir, ignore_errors=True)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,137 @@
+"""FileFly 分段下载客户端
+
+按服务器提供的分段清单并行下载文件的各段，逐段校验sha256；中断后再次运行只下载未完成的段。
+
+用法：
+    python filefly_download.py http://192.168.1.10:5000 videos/movie.mkv
+    python filefly_download.py http://192.168.1.10:5000 videos/movie.mkv -o movie.mkv -j 8
+"""
+import os
+import sys
+import json
+import time
+import hashlib
+import argparse
+import http.client
+import urllib.request
+from urllib.parse import quote
+from concurrent.futures import ThreadPoolExecutor, as_completed
+
+READ_SIZE = 1024 * 1024
+MAX_RETRIES = 5
+
+
+def fetch_manifest(url):
+    """获取分段清单；服务器还在计算分段摘要时返回202，按Retry-After等待后再取"""
+    while True:
+        with urllib.request.urlopen(url, timeout=60) as response:
+            body = json.loads(response.read().decode('utf-8'))
+            if response.status != 202:
+                return body
+            delay = float(response.headers.get('Retry-After') or 1)
+        if body.get('size'):
+            print(f"服务器正在计算分段摘要: {body['hashed_bytes'] * 100 // body['size']}%")
+        time.sleep(delay)
+
+
+def download_segment(url, part_path, segment):
+    """下载一段并写入对应位置，校验失败或网络错误时重试"""
+    start = segment['offset']
+    end = start + segment['length'] - 1
+    for attempt in range(MAX_RETRIES):
+        try:
+            request = urllib.request.Request(url, headers={'Range': f'bytes={start}-{end}'})
+            with urllib.request.urlopen(request, timeout=60) as response:
+                if response.status != 206:
+                    raise OSError(f'服务器不支持分段下载 (HTTP {response.status})')
+                data = bytearray()
+                while True:
+                    block = response.read(READ_SIZE)
+                    if not block:
+                        break
+                    data += block
+
+            if len(data) != segment['length'] or hashlib.sha256(data).hexdigest() != segment['sha256']:
+                raise OSError(f"第 {segment['index']} 段校验失败")
+
+            with open(part_path, 'r+b') as f:
+                f.seek(start)
+                f.write(data)
+            return segment['index']
+        except (OSError, http.client.HTTPException) as e:
+            if attempt == MAX_RETRIES - 1:
+                raise
+            delay = 0.5 * 2 ** attempt
+            print(f"第 {segment['index']} 段下载失败: {e}，{delay:.1f}秒后重试")
+            time.sleep(delay)
+
+
+def main():
+    parser = argparse.ArgumentParser(description='从FileFly服务器分段并行下载文件，支持断点续传')
+    parser.add_argument('server', help='服务器地址，例如 http://192.168.1.10:5000')
+    parser.add_argument('path', help='文件在共享目录中的路径')
+    parser.add_argument('-o', '--output', help='保存的文件名，默认与远程文件同名')
+    parser.add_argument('-j', '--jobs', type=int, default=4, help='同时下载的段数（默认4）')
+    args = parser.parse_args()
+
+    server = args.server.rstrip('/')
+    output = args.output or os.path.basename(args.path.rstrip('/'))
+    part_path = output + '.part'
+    state_path = output + '.part.json'
+
+    manifest = fetch_manifest(f"{server}/api/files/manifest?path={quote(args.path)}")
+    url = server + manifest['download_url']
+    segments = manifest['segments']
+
+    # 读取上次的进度，文件已变化时从头开始
+    done = set()
+    if os.path.exists(state_path) and os.path.exists(part_path):
+        with open(state_path, 'r', encoding='utf-8') as f:
+            state = json.load(f)
+        if state.get('version') == manifest['version'] and state.get('segment_size') == manifest['segment_size']:
+            done = set(state.get('done', []))
+    if not done:
+        with open(part_path, 'wb') as f:
+            f.truncate(manifest['size'])
+
+    def save_state():
+        tmp_path = state_path + '.tmp'
+        with open(tmp_path, 'w', encoding='utf-8') as f:
+            json.dump({'version': manifest['version'], 'segment_size': manifest['segment_size'],
+                       'done': sorted(done)}, f)
+        os.replace(tmp_path, state_path)
+
+    pending = [segment for segment in segments if segment['index'] not in done]
+    print(f"{args.path}: {manifest['size']} bytes, 共 {len(segments)} 段, 待下载 {len(pending)} 段")
+
+    started = time.time()
+    downloaded = 0
+    with ThreadPoolExecutor(max_workers=max(1, args.jobs)) as pool:
+        futures = {pool.submit(download_segment, url, part_path, segment): segment for segment in pending}
+        for future in as_completed(futures):
+            done.add(future.result())
+            save_state()
+            downloaded += futures[future]['length']
+            speed = downloaded / max(time.time() - started, 0.001) / 1024 / 1024
+            print(f"\r进度: {len(done)}/{len(segments)} 段, {speed:.1f} MB/s", end='', flush=True)
+    print()
+
+    # 服务器知道整个文件的摘要时再做一次完整校验
+    if manifest.get('sha256'):
+        digest = hashlib.sha256()
+        with open(part_path, 'rb') as f:
+            for block in iter(lambda: f.read(READ_SIZE), b''):
+                digest.update(block)
+        if digest.hexdigest() != manifest['sha256']:
+            if os.path.exists(state_path):
+                os.remove(state_path)
+            sys.exit('文件校验失败，请重新下载')
+
+    os.replace(part_path, output)
+    if os.path.exists(state_path):
+        os.remove(state_path)
+    print(f"下载完成: {output}")
+
+
+if __name__ == '__main__':
+    main()
@@ -12,6 +12,27 @@ class FileManager {
         this.batchOperationInProgress = false; // 防止批量操作重复执行
         this.isMobile = window.innerWidth <= 768; // 检测是否是移动端
         this.clickTimer = null; // 用于区分单击和双击
+        this.pageSize = 500; // 每次从服务器加载的条目数
+        this.nextCursor = null; // 下一页游标，为null表示已全部加载
+        this.totalCount = 0; // 当前文件夹的条目总数
+        this.segmentedDownloadMin = 64 * 1024 * 1024; // 大于该大小的文件分段并行下载
+        this.downloadParallel = 4; // 同时下载的段数
+        this.downloadRetries = 3; // 每段失败后的重试次数
+        this.jobPollInterval = 1000; // 轮询后台任务进度的间隔（毫秒）
+        this.searchDelay = 300; // 停止输入多久后在服务器上搜索（毫秒）
+        this.searchMinLength = 2; // 至少输入几个字符才搜索整个共享目录
+        this.searchLimit = 200; // 服务器搜索返回的最多结果数
+        this.searchQuery = ''; // 当前显示的是服务器搜索结果时为搜索词
+        this.searchTimer = null;
+        this.searchSeq = 0; // 丢弃过期的搜索响应
+        this.changeToken = null; // 已应用到列表的最后一个变更
+        this.changeSource = null; // 服务器推送变更的事件流
+        this.changePollInterval = 30000; // 浏览器不支持或服务器拒绝事件流时轮询变更的间隔（毫秒）
+        this.changePollTimer = null;
+        this.changeReloadDelay = 2000; // 子文件夹内有变更时，最多每隔多久重新加载一次列表（毫秒）
+        this.changeReloadTimer = null;
+        this.changeSync = null; // 正在进行的变更请求
+        this.changeSyncPending = false;
 
         this.init();
     }
@@ -173,7 +194,7 @@ class FileManager {
             if (loadingElement) loadingElement.style.display = 'block';
             if (emptyElement) emptyElement.style.display = 'none';
 
-            const response = await fetch(`${this.apiBase}/files?path=${encodeURIComponent(path)}`);
+            const response = await fetch(`${this.apiBase}/files?path=${encodeURIComponent(path)}&limit=${this.pageSize}`);
 
             if (!response.ok) {
                 const errorText = await response.text();
@@ -183,8 +204,22 @@ class FileManager {
             const data = await response.json();
 
             if (data.success) {
+                if (this.searchQuery) {
+                    // 从搜索结果打开文件夹或刷新列表时退出搜索
+                    clearTimeout(this.searchTimer);
+                    this.searchSeq++;
+                    this.searchQuery = '';
+                    const searchInput = document.getElementById('searchFiles');
+                    if (searchInput) searchInput.value = '';
+                }
                 this.files = data.files || [];
+                this.nextCursor = data.next_cursor || null;
+                this.totalCount = data.total || this.files.length;
                 this.breadcrumbs = data.breadcrumbs || [];
+                this.changeToken = data.change_token || this.changeToken;
+                clearTimeout(this.changeReloadTimer);
+                this.changeReloadTimer = null;
+                this.connectChanges();
                 this.renderBreadcrumbs();
                 this.renderFiles();
                 this.updateFileCount();
@@ -202,6 +237,178 @@ class FileManager {
         }
     }
 
+    async loadMoreFiles() {
+        if (!this.nextCursor) return;
+
+        try {
+            const cursor = this.nextCursor;
+            const response = await fetch(`${this.apiBase}/files?path=${encodeURIComponent(this.currentPath)}&limit=${this.pageSize}&cursor=${encodeURIComponent(cursor)}`);
+
+            if (!response.ok) {
+                throw new Error(`加载失败: ${response.status}`);
+            }
+
+            const data = await response.json();
+            if (!data.success) {
+                throw new Error(data.error || '无效的响应数据');
+            }
+
+            this.files = this.files.concat(data.files || []);
+            this.nextCursor = data.next_cursor || null;
+            this.totalCount = data.total || this.files.length;
+            this.renderFiles();
+            this.updateFileCount();
+        } catch (error) {
+            this.showToast('加载更多失败: ' + error.message, 'danger');
+        }
+    }
+
+    // 变更同步：服务器推送或按需获取令牌之后的变更，直接修改当前列表，不再重新加载整个文件夹
+    connectChanges() {
+        if (this.changeSource || this.changePollTimer || !this.changeToken) return;
+
+        if (typeof EventSource === 'undefined') {
+            this.changePollTimer = setInterval(() => this.syncChanges(), this.changePollInterval);
+            return;
+        }
+
+        const source = new EventSource(`${this.apiBase}/changes/stream?since=${encodeURIComponent(this.changeToken)}`);
+        source.addEventListener('changes', (e) => {
+            const data = JSON.parse(e.data);
+            this.applyChanges(data.events, data.token);
+        });
+        source.addEventListener('reset', () => this.loadFiles(this.currentPath));
+        source.onerror = () => {
+            // 断线时浏览器会自动重连；服务器拒绝（如连接过多）时改为轮询
+            if (source.readyState === EventSource.CLOSED) {
+                this.changeSource = null;
+                this.changePollTimer = setInterval(() => this.syncChanges(), this.changePollInterval);
+            }
+        };
+        this.changeSource = source;
+    }
+
+    // 主动获取变更（如上传完成后）；事件流已连接时由推送负责，多次调用合并为一个请求
+    async syncChanges() {
+        if (!this.changeToken) return;
+        if (this.changeSource && this.changeSource.readyState === EventSource.OPEN) return;
+        if (this.changeSync) {
+            this.changeSyncPending = true;
+            return this.changeSync;
+        }
+
+        this.changeSync = (async () => {
+            do {
+                this.changeSyncPending = false;
+                try {
+                    const response = await fetch(`${this.apiBase}/changes?since=${encodeURIComponent(this.changeToken)}`);
+                    const data = await response.json();
+                    if (!response.ok || !data.success) {
+                        throw new Error(data.error || `获取变更失败: ${response.status}`);
+                    }
+                    if (data.reset) {
+                        await this.loadFiles(this.currentPath);
+                    } else {
+                        this.applyChanges(data.events, data.token);
+                    }
+                } catch (error) {
+                    console.warn('获取变更失败:', error);
+                    await this.loadFiles(this.currentPath);
+                    break;
+                }
+            } while (this.changeSyncPending);
+            this.changeSync = null;
+        })();
+        return this.changeSync;
+    }
+
+    // 只接受比当前更新的令牌（推送和主动获取可能乱序到达）
+    advanceChangeToken(token) {
+        if (!token) return;
+        const [epoch, seq] = token.split('.');
+        const [currentEpoch, currentSeq] = (this.changeToken || '').split('.');
+        if (epoch !== currentEpoch || Number(seq) > Number(currentSeq)) {
+            this.changeToken = token;
+        }
+    }
+
+    isWithinPath(path, folder) {
+        return folder === '' ? path !== '' : path.startsWith(folder + '/');
+    }
+
+    applyChanges(events, token) {
+        this.advanceChangeToken(token);
+        // 显示搜索结果时不修改列表，退出搜索时会重新加载
+        if (!events || events.length === 0 || this.searchQuery) return;
+
+        const current = this.currentPath;
+        let changed = false;
+        let reload = false;
+
+        for (const event of events) {
+            const removedPath = event.op === 'move' ? event.old_path : (event.op === 'delete' ? event.path : null);
+
+            for (const path of [event.old_path, event.path]) {
+                if (!path) continue;
+                if (path === current || this.isWithinPath(current, path)) {
+                    // 当前文件夹本身被移动或删除
+                    reload = true;
+                } else if (this.isWithinPath(path, current) && this.getParentPath(path) !== current) {
+                    // 子文件夹内的变化只影响子文件夹的统计
+                    reload = true;
+                }
+            }
+
+            if (removedPath && this.getParentPath(removedPath) === current) {
+                const index = this.files.findIndex(file => file.path === removedPath);
+                if (index !== -1) {
+                    this.files.splice(index, 1);
+                    this.totalCount = Math.max(0, this.totalCount - 1);
+                    this.selectedItems.delete(removedPath);
+                    changed = true;
+                }
+            }
+
+            if (event.entry && this.getParentPath(event.path) === current) {
+                this.upsertFile(event.entry);
+                changed = true;
+            }
+        }
+
+        if (changed) {
+            this.renderFiles();
+            this.updateFileCount();
+        }
+        if (reload && !this.changeReloadTimer) {
+            this.changeReloadTimer = setTimeout(() => {
+                this.changeReloadTimer = null;
+                this.loadFiles(this.currentPath);
+            }, this.changeReloadDelay);
+        }
+    }
+
+    // 按服务器的顺序（文件夹在前，名称不区分大小写）插入或替换条目
+    upsertFile(entry) {
+        const existing = this.files.findIndex(file => file.path === entry.path);
+        if (existing !== -1) {
+            this.files[existing] = entry;
+            return;
+        }
+
+        const key = file => [file.type === 'folder' ? 0 : 1, file.name.toLowerCase()];
+        const [entryGroup, entryName] = key(entry);
+        let index = this.files.findIndex(file => {
+            const [group, name] = key(file);
+            return group > entryGroup || (group === entryGroup && name > entryName);
+        });
+        if (index === -1) index = this.files.length;
+
+        this.totalCount++;
+        // 还有未加载的分页时，排在已加载部分之后的条目留给翻页
+        if (index === this.files.length && this.nextCursor) return;
+        this.files.splice(index, 0, entry);
+    }
+
     updateFileCount() {
         const fileCountElement = document.getElementById('fileCount');
         if (!fileCountElement) return;
@@ -221,6 +428,9 @@ class FileManager {
                 countText += `${fileCount}个文件`;
             }
             fileCountElement.textContent = countText || '0个项目';
+            if (this.nextCursor) {
+                fileCountElement.textContent += `（已加载 ${this.files.length}/${this.totalCount}）`;
+            }
         }
     }
 
@@ -271,9 +481,9 @@ class FileManager {
             return;
         }
 
-        // 添加父文件夹映射项（如果不是根目录）
+        // 添加父文件夹映射项（如果不是根目录，搜索结果中不显示）
         const displayFiles = [...this.files];
-        if (this.currentPath && this.currentPath !== '') {
+        if (this.currentPath && this.currentPath !== '' && !this.searchQuery) {
             // 添加"返回上一级"的父文件夹映射
             const parentPath = this.getParentPath(this.currentPath);
             displayFiles.unshift({
@@ -367,7 +577,7 @@ class FileManager {
                     </div>
                     
                     <div class="file-info">
-                        <div class="file-name" title="${escapedName}" style="${isParent ? 'color: #6c757d;' : ''}">
+                        <div class="file-name" title="${file.parent !== undefined ? escapedPath : escapedName}" style="${isParent ? 'color: #6c757d;' : ''}">
                             ${escapedName}
                         </div>
                         <div class="file-details">
@@ -392,6 +602,17 @@ class FileManager {
             `;
         });
 
+        // 还有未加载的条目时显示“加载更多”
+        if (this.nextCursor) {
+            html += `
+                <div class="load-more-item" style="grid-column: 1 / -1; text-align: center;">
+                    <button class="btn btn-outline-primary btn-sm" onclick="window.fileManager.loadMoreFiles()">
+                        <i class="fas fa-angle-double-down me-1"></i>加载更多（${this.files.length}/${this.totalCount}）
+                    </button>
+                </div>
+            `;
+        }
+
         container.innerHTML = html;
 
         // 绑定所有事件
@@ -649,10 +870,10 @@ class FileManager {
             this.dropHandled = true;
 
             // 显示确认框
-            if (confirm(`确定要将 "${this.draggedItem.name}" 移动到上一级目录吗？`)) {
+            if (confirm(`确定要将 ${this.draggedDescription()} 移动到上一级目录吗？`)) {
                 // 移动到父目录
                 const parentPath = this.getParentPath(this.currentPath);
-                this.moveItem(this.draggedItem.path, parentPath);
+                this.moveDragged(parentPath);
             }
         });
 
@@ -724,13 +945,20 @@ class FileManager {
                 this.dropHandled = true;
 
                 // 显示确认框
-                if (confirm(`确定要将 "${this.draggedItem.name}" 移动到 "${item.dataset.name}" 中吗？`)) {
-                    this.moveItem(this.draggedItem.path, path);
+                if (confirm(`确定要将 ${this.draggedDescription()} 移动到 "${item.dataset.name}" 中吗？`)) {
+                    this.moveDragged(path);
                 }
             }
         });
     }
 
+    draggedDescription() {
+        if (this.selectedItems.size > 1 && this.selectedItems.has(this.draggedItem.path)) {
+            return `选中的 ${this.selectedItems.size} 个项目`;
+        }
+        return `"${this.draggedItem.name}"`;
+    }
+
     getParentPath(path) {
         if (!path || path === '') return '';
 
@@ -802,6 +1030,14 @@ class FileManager {
     // 下载文件的方法
     downloadFile(filePath) {
         try {
+            // 大文件在支持保存文件对话框的浏览器中分段并行下载，逐段校验
+            const path = decodeURIComponent(filePath);
+            const file = this.files.find(item => item.path === path && item.type !== 'folder');
+            if (file && file.size >= this.segmentedDownloadMin && window.showSaveFilePicker) {
+                this.downloadSegmented(path, file.name);
+                return;
+            }
+
             // filePath已经是编码后的字符串，直接使用
             window.open(`/download/${filePath}`, '_blank');
         } catch (error) {
@@ -810,6 +1046,96 @@ class FileManager {
         }
     }
 
+    // 按服务器的分段清单并行下载各段，校验后写入用户选择的文件；失败的段单独重试
+    async downloadSegmented(path, name) {
+        let handle;
+        try {
+            // 必须在点击后立即弹出保存对话框
+            handle = await window.showSaveFilePicker({ suggestedName: name });
+        } catch (error) {
+            if (error.name !== 'AbortError') {
+                window.open(`/download/${encodeURIComponent(path)}`, '_blank');
+            }
+            return;
+        }
+
+        let writable = null;
+        try {
+            this.showToast(`开始下载: ${name}`, 'info');
+            // 大文件的分段摘要在服务器后台计算，返回202时按Retry-After等待后再取
+            let response;
+            let manifest;
+            while (true) {
+                response = await fetch(`${this.apiBase}/files/manifest?path=${encodeURIComponent(path)}`);
+                manifest = await response.json();
+                if (response.status !== 202) break;
+                const delay = Number(response.headers.get('Retry-After')) || 1;
+                await new Promise(resolve => setTimeout(resolve, delay * 1000));
+            }
+            if (!response.ok) {
+                throw new Error(manifest.error || `获取下载清单失败: ${response.status}`);
+            }
+
+            writable = await handle.createWritable();
+            await writable.truncate(manifest.size);
+
+            const pending = [...manifest.segments];
+            let failed = false;
+            const lane = async () => {
+                while (pending.length > 0 && !failed) {
+                    const segment = pending.shift();
+                    try {
+                        const data = await this.fetchSegment(manifest.download_url, segment);
+                        await writable.write({ type: 'write', position: segment.offset, data });
+                    } catch (error) {
+                        failed = true;
+                        throw error;
+                    }
+                }
+            };
+            const lanes = Math.min(this.downloadParallel, pending.length);
+            await Promise.all(Array.from({ length: lanes }, lane));
+
+            await writable.close();
+            this.showToast(`下载完成: ${name}`, 'success');
+        } catch (error) {
+            console.error('分段下载失败:', error);
+            if (writable) await writable.abort().catch(() => {});
+            this.showToast('下载失败: ' + error.message, 'danger');
+        }
+    }
+
+    async fetchSegment(url, segment) {
+        const end = segment.offset + segment.length - 1;
+        for (let attempt = 0; ; attempt++) {
+            try {
+                const response = await fetch(url, { headers: { Range: `bytes=${segment.offset}-${end}` } });
+                if (response.status !== 206) {
+                    throw new Error(`分段请求失败: ${response.status}`);
+                }
+                const data = await response.blob();
+                if (data.size !== segment.length) {
+                    throw new Error(`第 ${segment.index + 1} 段长度不符`);
+                }
+                const digest = await this.segmentDigest(data);
+                if (digest && digest !== segment.sha256) {
+                    throw new Error(`第 ${segment.index + 1} 段校验失败`);
+                }
+                return data;
+            } catch (error) {
+                if (attempt >= this.downloadRetries) throw error;
+                await new Promise(resolve => setTimeout(resolve, 500 * 2 ** attempt));
+            }
+        }
+    }
+
+    // 借用上传模块的摘要计算线程；线程不可用时得到null，跳过校验
+    segmentDigest(data) {
+        const uploader = window.uploader;
+        if (!uploader || !uploader.chunkWorker) return Promise.resolve(null);
+        return uploader.runHashTask(uploader.chunkWorker, { type: 'digest', file: data }).promise;
+    }
+
     // 下载文件夹的方法
     downloadFolder(folderPath) {
         try {
@@ -840,12 +1166,7 @@ class FileManager {
                 body: JSON.stringify(requestData)
             });
 
-            if (!response.ok) {
-                const errorData = await response.json();
-                throw new Error(errorData.error || '移动失败');
-            }
-
-            const result = await response.json();
+            const result = await this.readOperationResult(response, '移动失败');
             this.showToast(result.message || '移动成功', 'success');
 
             // 刷新文件列表
@@ -856,6 +1177,96 @@ class FileManager {
         }
     }
 
+    // 解析文件操作的响应；耗时的操作转入后台任务（返回202），轮询直到任务结束
+    async readOperationResult(response, fallbackError) {
+        const result = await response.json();
+        if (!response.ok) {
+            throw new Error(result.error || fallbackError);
+        }
+        return response.status === 202 && result.job ? this.waitForJob(result, fallbackError) : result;
+    }
+
+    async waitForJob(result, fallbackError) {
+        let job = result.job;
+        let polls = 0;
+        this.showToast(result.message || '任务已转入后台执行', 'info');
+        while (!job.finished) {
+            await new Promise(resolve => setTimeout(resolve, this.jobPollInterval));
+            const poll = await fetch(`${this.apiBase}/jobs/${job.id}`);
+            job = await poll.json();
+            if (!poll.ok) {
+                throw new Error(job.error || fallbackError);
+            }
+            // 每隔几秒提示一次进度
+            if (++polls % 5 === 0 && !job.finished && job.total_bytes > 0) {
+                this.showToast(`处理中: ${this.formatSize(job.done_bytes)} / ${this.formatSize(job.total_bytes)}`, 'info');
+            }
+        }
+
+        if (job.status === 'cancelled') throw new Error('任务已取消');
+        if (job.status !== 'done') throw new Error(job.error || fallbackError);
+        return { success: true, ...(job.result || {}) };
+    }
+
+    // 提交批量文件操作，返回成功和失败的数量；失败的项目输出到控制台
+    async runBatchOperations(operations, actionName) {
+        const response = await fetch(`${this.apiBase}/files/batch`, {
+            method: 'POST',
+            headers: {
+                'Content-Type': 'application/json',
+                'Accept': 'application/json'
+            },
+            body: JSON.stringify({ operations })
+        });
+
+        // 全部项目都无效时返回400，同样带有逐项结果
+        const result = await response.json();
+        if (!response.ok && !result.results) {
+            throw new Error(result.error || `${actionName}失败`);
+        }
+        const summary = response.status === 202 && result.job ? await this.waitForJob(result, `${actionName}失败`) : result;
+
+        (summary.results || []).forEach(item => {
+            if (!item.success) {
+                const op = operations[item.index];
+                console.error(`${actionName}失败 ${op.path || op.source_path}:`, item.error);
+            }
+        });
+        return { successCount: summary.succeeded || 0, errorCount: summary.failed || 0 };
+    }
+
+    // 把选中的多个项目一起移动到目标文件夹
+    async batchMove(paths, targetDir) {
+        try {
+            const operations = paths.map(path => ({ op: 'move', source_path: path, target_dir: targetDir || '' }));
+            const { successCount, errorCount } = await this.runBatchOperations(operations, '移动');
+
+            let message = `已移动 ${successCount} 个项目`;
+            if (errorCount > 0) {
+                message += `，${errorCount} 个项目移动失败`;
+                this.showToast(message, 'warning');
+            } else {
+                this.showToast(message, 'success');
+            }
+
+            this.clearSelection();
+            await this.loadFiles(this.currentPath);
+        } catch (error) {
+            this.showToast('移动失败: ' + error.message, 'danger');
+        }
+    }
+
+    // 拖拽的项目属于多选范围时移动所有选中的项目，否则只移动拖拽的项目
+    moveDragged(targetDir) {
+        const dragged = this.draggedItem.path;
+        if (this.selectedItems.size > 1 && this.selectedItems.has(dragged)) {
+            const paths = Array.from(this.selectedItems).filter(path => path !== targetDir);
+            this.batchMove(paths, targetDir);
+        } else {
+            this.moveItem(dragged, targetDir);
+        }
+    }
+
     async renameItem(path) {
         try {
             const oldName = path.split('/').pop();
@@ -910,12 +1321,7 @@ class FileManager {
                 })
             });
 
-            if (!response.ok) {
-                const errorData = await response.json();
-                throw new Error(errorData.error || '删除失败');
-            }
-
-            const result = await response.json();
+            const result = await this.readOperationResult(response, '删除失败');
             this.showToast(result.message || '删除成功', 'success');
 
             // 刷新文件列表
@@ -965,6 +1371,18 @@ class FileManager {
     }
 
     searchFiles(query) {
+        // 先在已加载的条目中即时过滤，停止输入后再到服务器上搜索整个共享目录
+        clearTimeout(this.searchTimer);
+        const trimmed = query.trim();
+        if (trimmed.length >= this.searchMinLength) {
+            this.searchTimer = setTimeout(() => this.searchServer(trimmed), this.searchDelay);
+        } else if (this.searchQuery) {
+            this.searchSeq++;
+            this.searchQuery = '';
+            this.loadFiles(this.currentPath);
+            return;
+        }
+
         const fileItems = document.querySelectorAll('.file-item:not(.parent)');
         const lowerQuery = query.toLowerCase();
 
@@ -982,6 +1400,34 @@ class FileManager {
         });
     }
 
+    async searchServer(query) {
+        const seq = ++this.searchSeq;
+        try {
+            const response = await fetch(`${this.apiBase}/search?q=${encodeURIComponent(query)}&limit=${this.searchLimit}`);
+            const data = await response.json();
+            if (!response.ok || !data.success) {
+                throw new Error(data.error || `搜索失败: ${response.status}`);
+            }
+            if (seq !== this.searchSeq) return;
+
+            this.searchQuery = query;
+            this.files = data.results;
+            this.nextCursor = null;
+            this.totalCount = this.files.length;
+            this.renderFiles();
+
+            const fileCountElement = document.getElementById('fileCount');
+            if (fileCountElement) {
+                fileCountElement.textContent = data.truncated ?
+                    `搜索到超过 ${this.files.length} 个结果，请输入更多字符` :
+                    `搜索到 ${this.files.length} 个结果`;
+                if (!data.ready) fileCountElement.textContent += '（索引建立中，结果可能不完整）';
+            }
+        } catch (error) {
+            if (seq === this.searchSeq) this.showToast('搜索失败: ' + error.message, 'danger');
+        }
+    }
+
     // 批量操作功能
     toggleFileSelection(filePath, isSelected) {
         if (isSelected) {
@@ -1112,23 +1558,30 @@ class FileManager {
                 return;
             }
 
-            // 逐个下载选中的文件（不创建压缩包）
-            for (const file of selectedFiles) {
-                // 使用延迟以避免浏览器阻止多个下载
-                await new Promise(resolve => setTimeout(resolve, 300));
-                this.downloadFile(encodeURIComponent(file.path));
-            }
+            // 服务器登记选中的项目，返回一次性下载链接，打包过程边压缩边下载
+            const response = await fetch(`${this.apiBase}/files/batch-download`, {
+                method: 'POST',
+                headers: {
+                    'Content-Type': 'application/json',
+                    'Accept': 'application/json'
+                },
+                body: JSON.stringify({
+                    files: selectedFiles.map(f => ({ path: f.path, name: f.name })),
+                    folders: selectedFolders.map(f => ({ path: f.path, name: f.name })),
+                    current_path: this.currentPath
+                })
+            });
 
-            // 逐个下载选中的文件夹（每个文件夹单独下载为ZIP）
-            for (const folder of selectedFolders) {
-                // 使用延迟以避免浏览器阻止多个下载
-                await new Promise(resolve => setTimeout(resolve, 500));
-                this.downloadFolder(encodeURIComponent(folder.path));
+            if (!response.ok) {
+                const errorData = await response.json().catch(() => ({}));
+                throw new Error(errorData.error || `请求失败: ${response.status}`);
             }
 
-            if (selectedFiles.length > 0 || selectedFolders.length > 0) {
-                this.showToast(`开始下载 ${selectedFiles.length + selectedFolders.length} 个项目`, 'success');
-            }
+            const result = await response.json();
+            // 异步请求之后再window.open容易被弹窗拦截，附件下载不会离开当前页面
+            window.location.href = result.download_url;
+
+            this.showToast(`开始下载 ${selectedFiles.length + selectedFolders.length} 个项目`, 'success');
 
             // 清空选择
             this.clearSelection();
@@ -1157,39 +1610,9 @@ class FileManager {
         }
 
         try {
-            let successCount = 0;
-            let errorCount = 0;
-
-            // 逐个删除选中的项目
-            for (const filePath of this.selectedItems) {
-                try {
-                    const response = await fetch(`${this.apiBase}/files/delete`, {
-                        method: 'POST',
-                        headers: {
-                            'Content-Type': 'application/json',
-                            'Accept': 'application/json'
-                        },
-                        body: JSON.stringify({
-                            filepath: filePath
-                        })
-                    });
-
-                    if (response.ok) {
-                        successCount++;
-                    } else {
-                        const errorData = await response.json();
-                        console.error(`删除失败 ${filePath}:`, errorData.error);
-                        errorCount++;
-                    }
-
-                    // 添加延迟以避免请求过于频繁
-                    await new Promise(resolve => setTimeout(resolve, 100));
-
-                } catch (error) {
-                    console.error(`删除失败 ${filePath}:`, error);
-                    errorCount++;
-                }
-            }
+            // 一次请求提交所有删除操作，服务器逐项返回结果
+            const operations = Array.from(this.selectedItems, path => ({ op: 'delete', path }));
+            const { successCount, errorCount } = await this.runBatchOperations(operations, '删除');
 
             // 显示结果
             let message = `已删除 ${successCount} 个项目`;
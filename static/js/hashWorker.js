@@ -0,0 +1,226 @@
+// 文件摘要计算（Web Worker）- 分块读取文件并增量计算SHA-256或CRC32，不阻塞页面
+// 局域网通过http访问时不是安全上下文，crypto.subtle不可用，因此自带实现
+
+const READ_BLOCK_SIZE = 4 * 1024 * 1024; // 每次读取4MB
+
+const K = new Uint32Array([
+    0x428a2f98, 0x71374491, 0xb5c0fbcf, 0xe9b5dba5, 0x3956c25b, 0x59f111f1, 0x923f82a4, 0xab1c5ed5,
+    0xd807aa98, 0x12835b01, 0x243185be, 0x550c7dc3, 0x72be5d74, 0x80deb1fe, 0x9bdc06a7, 0xc19bf174,
+    0xe49b69c1, 0xefbe4786, 0x0fc19dc6, 0x240ca1cc, 0x2de92c6f, 0x4a7484aa, 0x5cb0a9dc, 0x76f988da,
+    0x983e5152, 0xa831c66d, 0xb00327c8, 0xbf597fc7, 0xc6e00bf3, 0xd5a79147, 0x06ca6351, 0x14292967,
+    0x27b70a85, 0x2e1b2138, 0x4d2c6dfc, 0x53380d13, 0x650a7354, 0x766a0abb, 0x81c2c92e, 0x92722c85,
+    0xa2bfe8a1, 0xa81a664b, 0xc24b8b70, 0xc76c51a3, 0xd192e819, 0xd6990624, 0xf40e3585, 0x106aa070,
+    0x19a4c116, 0x1e376c08, 0x2748774c, 0x34b0bcb5, 0x391c0cb3, 0x4ed8aa4a, 0x5b9cca4f, 0x682e6ff3,
+    0x748f82ee, 0x78a5636f, 0x84c87814, 0x8cc70208, 0x90befffa, 0xa4506ceb, 0xbef9a3f7, 0xc67178f2
+]);
+
+class Sha256 {
+    constructor() {
+        this.h = new Uint32Array([
+            0x6a09e667, 0xbb67ae85, 0x3c6ef372, 0xa54ff53a, 0x510e527f, 0x9b05688c, 0x1f83d9ab, 0x5be0cd19
+        ]);
+        this.w = new Uint32Array(64);
+        this.buffer = new Uint8Array(64);
+        this.bufferLength = 0;
+        this.length = 0;
+    }
+
+    update(data) {
+        this.length += data.length;
+        this.process(data);
+    }
+
+    process(data) {
+        let pos = 0;
+
+        // 先补齐上次剩余的不完整块
+        if (this.bufferLength > 0) {
+            const take = Math.min(64 - this.bufferLength, data.length);
+            this.buffer.set(data.subarray(0, take), this.bufferLength);
+            this.bufferLength += take;
+            pos = take;
+            if (this.bufferLength < 64) return;
+            this.compress(this.buffer, 0, 64);
+            this.bufferLength = 0;
+        }
+
+        const end = pos + Math.floor((data.length - pos) / 64) * 64;
+        if (end > pos) {
+            this.compress(data, pos, end);
+        }
+
+        if (end < data.length) {
+            this.buffer.set(data.subarray(end), 0);
+            this.bufferLength = data.length - end;
+        }
+    }
+
+    // 处理 [offset, end) 范围内的所有64字节块，热循环中只使用局部变量
+    compress(data, offset, end) {
+        const w = this.w;
+        const h = this.h;
+        let h0 = h[0] | 0, h1 = h[1] | 0, h2 = h[2] | 0, h3 = h[3] | 0;
+        let h4 = h[4] | 0, h5 = h[5] | 0, h6 = h[6] | 0, h7 = h[7] | 0;
+
+        for (let pos = offset; pos < end; pos += 64) {
+            for (let i = 0; i < 16; i++) {
+                const j = pos + i * 4;
+                w[i] = (data[j] << 24) | (data[j + 1] << 16) | (data[j + 2] << 8) | data[j + 3];
+            }
+            for (let i = 16; i < 64; i++) {
+                const w15 = w[i - 15];
+                const w2 = w[i - 2];
+                const s0 = ((w15 >>> 7) | (w15 << 25)) ^ ((w15 >>> 18) | (w15 << 14)) ^ (w15 >>> 3);
+                const s1 = ((w2 >>> 17) | (w2 << 15)) ^ ((w2 >>> 19) | (w2 << 13)) ^ (w2 >>> 10);
+                w[i] = (w[i - 16] + s0 + w[i - 7] + s1) | 0;
+            }
+
+            let a = h0, b = h1, c = h2, d = h3, e = h4, f = h5, g = h6, hh = h7;
+            for (let i = 0; i < 64; i++) {
+                const s1 = ((e >>> 6) | (e << 26)) ^ ((e >>> 11) | (e << 21)) ^ ((e >>> 25) | (e << 7));
+                const ch = (e & f) ^ (~e & g);
+                const t1 = (hh + s1 + ch + K[i] + w[i]) | 0;
+                const s0 = ((a >>> 2) | (a << 30)) ^ ((a >>> 13) | (a << 19)) ^ ((a >>> 22) | (a << 10));
+                const maj = (a & b) ^ (a & c) ^ (b & c);
+                const t2 = (s0 + maj) | 0;
+                hh = g;
+                g = f;
+                f = e;
+                e = (d + t1) | 0;
+                d = c;
+                c = b;
+                b = a;
+                a = (t1 + t2) | 0;
+            }
+
+            h0 = (h0 + a) | 0; h1 = (h1 + b) | 0; h2 = (h2 + c) | 0; h3 = (h3 + d) | 0;
+            h4 = (h4 + e) | 0; h5 = (h5 + f) | 0; h6 = (h6 + g) | 0; h7 = (h7 + hh) | 0;
+        }
+
+        h[0] = h0; h[1] = h1; h[2] = h2; h[3] = h3;
+        h[4] = h4; h[5] = h5; h[6] = h6; h[7] = h7;
+    }
+
+    hex() {
+        // 填充：0x80，若干0，最后8字节为消息的比特长度（大端）
+        const bitLength = this.length * 8;
+        const padLength = ((this.bufferLength < 56 ? 56 : 120) - this.bufferLength);
+        const padding = new Uint8Array(padLength + 8);
+        padding[0] = 0x80;
+        const view = new DataView(padding.buffer);
+        view.setUint32(padLength, Math.floor(bitLength / 0x100000000));
+        view.setUint32(padLength + 4, bitLength >>> 0);
+        this.process(padding);
+
+        let result = '';
+        for (let i = 0; i < 8; i++) {
+            result += this.h[i].toString(16).padStart(8, '0');
+        }
+        return result;
+    }
+}
+
+// CRC32（与zlib相同的多项式），用于分片校验；slice-by-4查表，每次处理4个字节
+const CRC_TABLES = (() => {
+    const tables = [];
+    for (let t = 0; t < 4; t++) tables.push(new Int32Array(256));
+    for (let n = 0; n < 256; n++) {
+        let c = n;
+        for (let k = 0; k < 8; k++) {
+            c = c & 1 ? 0xedb88320 ^ (c >>> 1) : c >>> 1;
+        }
+        tables[0][n] = c;
+    }
+    for (let n = 0; n < 256; n++) {
+        let c = tables[0][n];
+        for (let t = 1; t < 4; t++) {
+            c = tables[0][c & 0xff] ^ (c >>> 8);
+            tables[t][n] = c;
+        }
+    }
+    return tables;
+})();
+
+function crc32(data, crc) {
+    const [t0, t1, t2, t3] = CRC_TABLES;
+    let c = ~crc;
+    let i = 0;
+    const end4 = data.length - (data.length % 4);
+    for (; i < end4; i += 4) {
+        c ^= data[i] | (data[i + 1] << 8) | (data[i + 2] << 16) | (data[i + 3] << 24);
+        c = t3[c & 0xff] ^ t2[(c >>> 8) & 0xff] ^ t1[(c >>> 16) & 0xff] ^ t0[c >>> 24];
+    }
+    for (; i < data.length; i++) {
+        c = t0[(c ^ data[i]) & 0xff] ^ (c >>> 8);
+    }
+    return ~c >>> 0;
+}
+
+// 任务逐个执行，cancelled记录页面已经不需要的任务
+const queue = [];
+const cancelled = new Set();
+let running = false;
+
+self.onmessage = (e) => {
+    const task = e.data;
+    if (task.type === 'cancel') {
+        cancelled.add(task.id);
+        return;
+    }
+
+    queue.push(task);
+    if (!running) runQueue();
+};
+
+async function runQueue() {
+    running = true;
+    while (queue.length > 0) {
+        const task = queue.shift();
+        if (cancelled.delete(task.id)) continue;
+
+        try {
+            if (task.type === 'digest') {
+                await digestFile(task);
+            } else if (task.type === 'crc32') {
+                await crc32File(task);
+            }
+        } catch (error) {
+            self.postMessage({ id: task.id, type: 'error', message: error.message });
+        }
+    }
+    running = false;
+}
+
+async function digestFile(task) {
+    const file = task.file;
+    const hasher = new Sha256();
+    let offset = 0;
+
+    while (offset < file.size) {
+        if (cancelled.delete(task.id)) return;
+
+        const end = Math.min(offset + READ_BLOCK_SIZE, file.size);
+        const block = new Uint8Array(await file.slice(offset, end).arrayBuffer());
+        hasher.update(block);
+        offset = end;
+        self.postMessage({ id: task.id, type: 'progress', bytes: offset });
+    }
+
+    self.postMessage({ id: task.id, type: 'done', digest: hasher.hex() });
+}
+
+async function crc32File(task) {
+    const file = task.file;
+    let crc = 0;
+    let offset = 0;
+
+    while (offset < file.size) {
+        if (cancelled.delete(task.id)) return;
+
+        const end = Math.min(offset + READ_BLOCK_SIZE, file.size);
+        crc = crc32(new Uint8Array(await file.slice(offset, end).arrayBuffer()), crc);
+        offset = end;
+    }
+
+    self.postMessage({ id: task.id, type: 'done', digest: crc.toString(16).padStart(8, '0') });
+}
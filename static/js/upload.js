@@ -6,7 +6,23 @@ class FileUploader {
         this.activeUploads = new Map();
         this.isUploading = false;
         this.isPaused = false;
-        this.chunkSize = 20 * 1024 * 1024; // 20MB
+        // 分片大小由服务器在创建上传会话时决定，客户端根据测得的吞吐量和延迟给出建议值
+        this.targetChunkSeconds = 2; // 每个分片期望的传输时间
+        this.latencyMs = null; // 请求往返延迟（指数平均）
+        this.laneThroughput = null; // 单个通道的吞吐量，字节/秒（指数平均）
+
+        // 并发上传：同时传输的分片数（创建会话后采用服务器的建议值）、失败重试次数和首次重试等待时间
+        this.maxParallelChunks = 4;
+        this.maxChunkRetries = 5;
+        this.retryBaseDelay = 500; // 毫秒
+        this.pendingMerges = new Set();
+        this.checkBatchSize = 2000; // 批量检查每次请求的文件数
+
+        // 小文件打包上传：不超过bundleFileLimit的文件合并成tar包，一个请求上传一批
+        this.bundleFileLimit = 256 * 1024;
+        this.bundleMaxBytes = 16 * 1024 * 1024;
+        this.bundleMaxFiles = 1000;
+        this.bundleCounter = 0;
 
         // 添加文件夹上传支持
         this.folderMode = false;
@@ -18,12 +34,19 @@ class FileUploader {
         // 弹窗实例
         this.modal = null;
 
+        // 内容摘要和分片校验值在Web Worker中计算，任务按编号对应
+        this.hashWorker = null;
+        this.chunkWorker = null;
+        this.hashTasks = new Map();
+        this.hashTaskCounter = 0;
+
         this.init();
     }
 
     init() {
         this.bindEvents();
         this.initModal();
+        this.initHashWorker();
         console.log('文件上传器已初始化');
     }
 
@@ -34,6 +57,86 @@ class FileUploader {
         }
     }
 
+    initHashWorker() {
+        // 文件摘要和分片校验各用一个线程，分片校验不必排在大文件的摘要计算后面
+        this.hashWorker = this.createHashWorker();
+        this.chunkWorker = this.createHashWorker();
+    }
+
+    createHashWorker() {
+        if (typeof Worker === 'undefined') return null;
+
+        let worker;
+        try {
+            worker = new Worker('/static/js/hashWorker.js');
+        } catch (error) {
+            console.warn('无法启动摘要计算线程:', error);
+            return null;
+        }
+
+        worker.onmessage = (e) => {
+            const message = e.data;
+            const task = this.hashTasks.get(message.id);
+            if (!task) return;
+
+            if (message.type === 'progress') {
+                if (task.fileInfo) task.fileInfo.hashedBytes = message.bytes;
+            } else {
+                this.hashTasks.delete(message.id);
+                task.resolve(message.type === 'done' ? message.digest : null);
+            }
+        };
+
+        worker.onerror = (e) => {
+            // 线程不可用时不再校验，上传照常进行
+            console.warn('摘要计算线程出错:', e.message);
+            this.hashTasks.forEach((task, taskId) => {
+                if (task.worker !== worker) return;
+                this.hashTasks.delete(taskId);
+                task.resolve(null);
+            });
+            if (this.hashWorker === worker) this.hashWorker = null;
+            if (this.chunkWorker === worker) this.chunkWorker = null;
+        };
+
+        return worker;
+    }
+
+    runHashTask(worker, message, fileInfo = null) {
+        if (!worker) return { taskId: null, promise: Promise.resolve(null) };
+
+        const taskId = ++this.hashTaskCounter;
+        const promise = new Promise(resolve => {
+            this.hashTasks.set(taskId, { worker, fileInfo, resolve });
+            worker.postMessage({ ...message, id: taskId });
+        });
+        return { taskId, promise };
+    }
+
+    // 后台计算文件的SHA-256，失败时得到null
+    computeDigest(fileInfo) {
+        const { taskId, promise } = this.runHashTask(this.hashWorker, { type: 'digest', file: fileInfo.file }, fileInfo);
+        fileInfo.hashTaskId = taskId;
+        return promise.then(digest => {
+            fileInfo.digest = digest;
+            return digest;
+        });
+    }
+
+    // 分片的CRC32（8位十六进制），随分片发送由服务器校验；线程不可用时得到null
+    computeChunkCrc(chunk) {
+        return this.runHashTask(this.chunkWorker, { type: 'crc32', file: chunk }).promise;
+    }
+
+    cancelDigest(fileInfo) {
+        const task = this.hashTasks.get(fileInfo.hashTaskId);
+        if (!task) return;
+
+        this.hashTasks.delete(fileInfo.hashTaskId);
+        task.worker.postMessage({ type: 'cancel', id: fileInfo.hashTaskId });
+        task.resolve(null);
+    }
+
     bindEvents() {
         // 上传按钮
         document.getElementById('uploadBtn')?.addEventListener('click', () => {
@@ -201,7 +304,7 @@ class FileUploader {
             }
 
             if (files.length > 0) {
-                this.processFilesWithPaths(files);
+                await this.processFilesWithPaths(files);
             }
         } catch (error) {
             this.showToast('处理文件夹失败: ' + error.message, 'danger');
@@ -315,7 +418,7 @@ class FileUploader {
                 };
             });
 
-            this.processFilesWithPaths(filesWithPaths);
+            await this.processFilesWithPaths(filesWithPaths);
         } catch (error) {
             this.showToast('处理文件夹失败: ' + error.message, 'danger');
         }
@@ -325,21 +428,18 @@ class FileUploader {
         try {
             const files = Array.from(fileList);
 
-            for (let file of files) {
-                await this.addToQueue(file, file.name);
-            }
-
             // 显示上传队列
             document.getElementById('uploadQueue').style.display = 'block';
+            await this.addFilesToQueue(files.map(file => ({ file: file, relativePath: file.name })));
 
             // 自动开始上传
-            setTimeout(() => this.startUpload(), 100);
+            this.startUpload();
         } catch (error) {
             this.showToast('处理文件失败: ' + error.message, 'danger');
         }
     }
 
-    processFilesWithPaths(filesWithPaths) {
+    async processFilesWithPaths(filesWithPaths) {
         // 按目录分组，显示上传统计
         const folderStats = {};
         let fileCount = 0;
@@ -358,78 +458,152 @@ class FileUploader {
         });
 
         if (fileCount > 0) {
-            filesWithPaths.forEach(async item => {
+            const items = filesWithPaths.map(item => {
                 const file = item.file || item;
-                const relativePath = item.relativePath || file.name;
-                await this.addToQueue(file, relativePath);
+                return { file: file, relativePath: item.relativePath || file.name };
             });
 
             document.getElementById('uploadQueue').style.display = 'block';
-            setTimeout(() => this.startUpload(), 100);
+            await this.addFilesToQueue(items);
+            this.startUpload();
         }
     }
 
-    async addToQueue(file, relativePath) {
-        try {
-            // 生成文件标识（包含路径信息）
-            const fileId = this.generateFileId(file, relativePath);
-
-            // 检查文件是否已存在
-            const checkResult = await this.checkFileExists(fileId, relativePath);
-
-            if (checkResult.exists && !checkResult.is_folder) {
-                this.showToast('文件已存在: ' + relativePath, 'warning');
-                return;
-            }
+    // 批量加入队列：每批文件只发一次检查请求，整批处理完再刷新队列界面
+    async addFilesToQueue(items) {
+        let added = 0;
+        const skipped = [];
+        let bundle = [];
+        let bundleBytes = 0;
+
+        for (let i = 0; i < items.length; i += this.checkBatchSize) {
+            const batch = items.slice(i, i + this.checkBatchSize).map(({ file, relativePath }) => ({
+                file,
+                relativePath,
+                id: this.generateFileId(file, relativePath)
+            }));
+
+            const results = await this.checkFilesBatch(batch);
+            batch.forEach((item, index) => {
+                const result = results[index] || { status: 'missing' };
+                if (result.status === 'exists') {
+                    skipped.push(item.relativePath);
+                    return;
+                }
+                if (result.status === 'invalid') {
+                    this.showToast('无效的文件路径: ' + item.relativePath, 'danger');
+                    return;
+                }
+                added++;
 
-            // 计算分片
-            const chunkSize = file.size > 500 * 1024 * 1024 ? 50 * 1024 * 1024 : this.chunkSize;
-            const totalChunks = Math.ceil(file.size / chunkSize);
-
-            const fileInfo = {
-                id: fileId,
-                file: file,
-                name: file.name,
-                path: relativePath,
-                fullPath: this.currentPath ? `${this.currentPath}/${relativePath}` : relativePath,
-                size: file.size,
-                chunkSize: chunkSize,
-                totalChunks: totalChunks,
-                uploadedChunks: checkResult.uploaded_chunks || [],
-                status: 'pending',
-                progress: 0,
-                startTime: null,
-                element: null
-            };
+                if (item.file.size > this.bundleFileLimit) {
+                    this.addToQueue(item.file, item.relativePath, item.id);
+                    return;
+                }
 
-            // 如果是可续传的文件
-            if (checkResult.uploaded_chunks && checkResult.uploaded_chunks.length > 0) {
-                const uploadedCount = checkResult.uploaded_chunks.length;
-                fileInfo.progress = (uploadedCount / totalChunks) * 100;
-            }
+                // 小文件攒够一包再加入队列
+                if (bundle.length >= this.bundleMaxFiles || bundleBytes + item.file.size > this.bundleMaxBytes) {
+                    this.addBundleToQueue(bundle);
+                    bundle = [];
+                    bundleBytes = 0;
+                }
+                bundle.push(item);
+                bundleBytes += item.file.size;
+            });
+            this.updateQueueUI();
+        }
 
-            this.uploadQueue.push(fileInfo);
+        if (bundle.length > 0) {
+            this.addBundleToQueue(bundle);
             this.updateQueueUI();
-            this.showToast(`已添加: ${relativePath}`, 'success');
+        }
 
-        } catch (error) {
-            this.showToast('添加文件失败: ' + error.message, 'danger');
+        if (skipped.length === 1) {
+            this.showToast('文件已存在: ' + skipped[0], 'warning');
+        } else if (skipped.length > 1) {
+            this.showToast(`${skipped.length} 个文件已存在，已跳过`, 'warning');
+        }
+        if (added === 1 && items.length === 1) {
+            this.showToast(`已添加: ${items[0].relativePath}`, 'success');
+        } else if (added > 0) {
+            this.showToast(`已添加 ${added} 个文件`, 'success');
         }
     }
 
-    async checkFileExists(fileId, filepath) {
+    addToQueue(file, relativePath, fileId) {
+        const fileInfo = this.createFileInfo({
+            id: fileId,
+            file: file,
+            name: file.name,
+            path: relativePath,
+            fullPath: this.currentPath ? `${this.currentPath}/${relativePath}` : relativePath,
+            size: file.size
+        });
+
+        // 加入队列时就开始计算摘要，与上传同时进行
+        fileInfo.digestPromise = this.computeDigest(fileInfo);
+
+        this.uploadQueue.push(fileInfo);
+    }
+
+    // 一批小文件作为队列中的一项，上传时打成一个tar包
+    addBundleToQueue(items) {
+        const size = items.reduce((sum, item) => sum + item.file.size, 0);
+        const fileInfo = this.createFileInfo({
+            id: `bundle_${Date.now().toString(16)}_${++this.bundleCounter}`,
+            bundle: items,
+            file: null,
+            name: items.length === 1 ? items[0].file.name : `${items.length} 个小文件`,
+            path: items.length === 1 ? items[0].relativePath : `${items[0].relativePath} 等 ${items.length} 个文件`,
+            size: size
+        });
+
+        // 小文件不计算摘要，也不尝试秒传
+        fileInfo.digestPromise = Promise.resolve(null);
+
+        this.uploadQueue.push(fileInfo);
+    }
+
+    createFileInfo(fields) {
+        return Object.assign({
+            bundle: null,
+            bundleResults: null,
+            // 分片参数在开始上传该文件、创建会话时确定
+            chunkSize: null,
+            totalChunks: null,
+            targetPath: this.currentPath,
+            ackedChunks: new Set(),
+            ackedBytes: 0,
+            nextChunk: 0,
+            inFlight: 0,
+            instantCheck: null,
+            cancelled: false,
+            digest: null,
+            hashedBytes: 0,
+            instant: false,
+            status: 'pending',
+            progress: 0,
+            startTime: null,
+            element: null
+        }, fields);
+    }
+
+    // 一次请求检查一批文件是否已存在或有未完成的上传，结果与请求顺序一致
+    async checkFilesBatch(batch) {
         try {
-            const response = await fetch(`${this.apiBase}/check`, {
+            const response = await fetch(`${this.apiBase}/check/batch`, {
                 method: 'POST',
                 headers: {
                     'Content-Type': 'application/json',
                     'Accept': 'application/json'
                 },
                 body: JSON.stringify({
-                    hash: fileId,
-                    filepath: filepath,
-                    filename: filepath.split('/').pop(),
-                    target_path: this.currentPath
+                    target_path: this.currentPath,
+                    files: batch.map(item => ({
+                        filepath: item.relativePath,
+                        hash: item.id,
+                        size: item.file.size
+                    }))
                 })
             });
 
@@ -437,23 +611,27 @@ class FileUploader {
                 throw new Error(`检查失败: ${response.status} ${response.statusText}`);
             }
 
-            return await response.json();
+            return (await response.json()).results;
 
         } catch (error) {
             this.showToast('检查文件失败: ' + error.message, 'warning');
-            return { exists: false, uploaded_chunks: [] };
+            return [];
         }
     }
 
     generateFileId(file, relativePath) {
-        // 使用文件路径+大小+最后修改时间生成标识
-        const identifier = `${this.currentPath}/${relativePath}_${file.size}_${file.lastModified}_${Date.now()}`;
-        let hash = 0;
+        // 使用文件路径+大小+最后修改时间生成标识，同一文件重新选择后得到相同标识，才能断点续传
+        const identifier = `${this.currentPath}/${relativePath}_${file.size}_${file.lastModified}`;
+        let h1 = 0xdeadbeef;
+        let h2 = 0x41c6ce57;
         for (let i = 0; i < identifier.length; i++) {
-            hash = ((hash << 5) - hash) + identifier.charCodeAt(i);
-            hash = hash & hash;
+            const ch = identifier.charCodeAt(i);
+            h1 = Math.imul(h1 ^ ch, 2654435761);
+            h2 = Math.imul(h2 ^ ch, 1597334677);
         }
-        return Math.abs(hash).toString(16);
+        h1 = Math.imul(h1 ^ (h1 >>> 16), 2246822507) ^ Math.imul(h2 ^ (h2 >>> 13), 3266489909);
+        h2 = Math.imul(h2 ^ (h2 >>> 16), 2246822507) ^ Math.imul(h1 ^ (h1 >>> 13), 3266489909);
+        return (h2 >>> 0).toString(16).padStart(8, '0') + (h1 >>> 0).toString(16).padStart(8, '0');
     }
 
     updateQueueUI() {
@@ -478,7 +656,7 @@ class FileUploader {
                             <i class="fas ${displayPath.includes('/') ? 'fa-folder' : 'fa-file'} me-1"></i> ${this.escapeHtml(displayPath)}
                         </div>
                         <div class="queue-details">
-                            ${fileSize} • ${fileInfo.uploadedChunks.length}/${fileInfo.totalChunks}分片
+                            ${fileSize} • ${fileInfo.ackedChunks.size}/${fileInfo.totalChunks ?? '-'}分片
                         </div>
                         <div class="queue-progress">
                             <div class="progress">
@@ -502,6 +680,9 @@ class FileUploader {
     removeFromQueue(fileId) {
         const index = this.uploadQueue.findIndex(f => f.id === fileId);
         if (index !== -1) {
+            this.uploadQueue[index].cancelled = true;
+            this.cancelDigest(this.uploadQueue[index]);
+
             // 如果正在上传，取消上传
             if (this.activeUploads.has(fileId)) {
                 this.cancelFileUpload(fileId);
@@ -520,6 +701,8 @@ class FileUploader {
     clearQueue() {
         // 取消所有上传
         this.uploadQueue.forEach(fileInfo => {
+            fileInfo.cancelled = true;
+            this.cancelDigest(fileInfo);
             if (this.activeUploads.has(fileInfo.id)) {
                 this.cancelFileUpload(fileInfo.id);
             }
@@ -550,58 +733,279 @@ class FileUploader {
         if (pauseBtn) pauseBtn.disabled = false;
         if (cancelBtn) cancelBtn.disabled = false;
 
-        // 上传每个文件
-        for (let fileInfo of this.uploadQueue.filter(f => f.status === 'pending')) {
-            if (this.isPaused) break;
+        // 同时保持maxParallelChunks个分片在传输，每个通道传完一个分片就领取下一个，可跨越文件
+        const lanes = [];
+        for (let i = 0; i < this.maxParallelChunks; i++) {
+            lanes.push(this.runUploadLane(i));
+        }
+        await Promise.all(lanes);
+        await Promise.all(this.pendingMerges);
 
-            try {
-                await this.uploadFile(fileInfo);
-            } catch (error) {
-                fileInfo.status = 'error';
-                this.showToast(`上传失败: ${fileInfo.name}`, 'danger');
-            }
+        // 暂停时未传完的文件回到等待状态，继续时从未确认的分片开始
+        this.uploadQueue.forEach(fileInfo => {
+            if (fileInfo.status === 'uploading') fileInfo.status = 'pending';
+        });
+
+        // 暂停时保留“继续”按钮，不当作上传结束
+        if (this.isPaused) {
+            this.isUploading = false;
+            return;
+        }
+
+        // 通道结束前后新加入或恢复的文件
+        if (this.uploadQueue.some(f => f.status === 'pending')) {
+            this.isUploading = false;
+            return this.startUpload();
         }
 
         this.finishUpload();
     }
 
-    async uploadFile(fileInfo) {
-        fileInfo.status = 'uploading';
-        fileInfo.startTime = Date.now();
-        this.activeUploads.set(fileInfo.id, fileInfo);
+    async runUploadLane(laneIndex) {
+        // 服务器建议的并发数小于通道数时，多余的通道退出
+        while (!this.isPaused && laneIndex < this.maxParallelChunks) {
+            const task = await this.nextChunkTask();
+            if (!task) break;
 
-        const uploadedChunks = new Set(fileInfo.uploadedChunks.map(c => parseInt(c.split('_')[1])));
+            const { fileInfo, index } = task;
+            const length = this.chunkLength(fileInfo, index);
+            fileInfo.inFlight++;
+            try {
+                const started = Date.now();
+                await this.uploadChunkWithRetry(fileInfo, index);
+                this.recordChunkTiming(length, Date.now() - started);
+
+                // 进度按服务器确认的字节数计算
+                fileInfo.ackedChunks.add(index);
+                fileInfo.ackedBytes += length;
+                fileInfo.progress = fileInfo.size > 0 ? (fileInfo.ackedBytes / fileInfo.size) * 100 : 100;
+                this.updateFileProgress(fileInfo);
+            } catch (error) {
+                // 秒传完成后服务器已清理暂存区，进行中的分片失败可以忽略
+                if (!fileInfo.instant && !fileInfo.cancelled && fileInfo.status === 'uploading') {
+                    fileInfo.status = 'error';
+                    this.showToast(`上传失败: ${fileInfo.name} (${error.message})`, 'danger');
+                }
+            } finally {
+                fileInfo.inFlight--;
+            }
+
+            this.checkFileDone(fileInfo);
+        }
+    }
 
-        // 上传分片
-        for (let i = 0; i < fileInfo.totalChunks; i++) {
-            if (this.isPaused) {
-                fileInfo.status = 'paused';
-                throw new Error('上传已暂停');
+    // 按队列顺序取下一个未确认且未在传输的分片；已开始的文件都没有可发的分片时才开始下一个文件，
+    // 每次只开始一个，同时开始的文件数不超过并发分片数，服务器只需为这几个文件预留暂存空间
+    async nextChunkTask() {
+        for (;;) {
+            let opening = null;
+            let started = 0;
+            for (const fileInfo of this.uploadQueue) {
+                if (fileInfo.status === 'opening') {
+                    opening = opening || fileInfo.sessionPromise;
+                    started++;
+                    continue;
+                }
+                if (fileInfo.status !== 'uploading') continue;
+                started++;
+                if (fileInfo.instant) continue;
+
+                while (fileInfo.nextChunk < fileInfo.totalChunks && fileInfo.ackedChunks.has(fileInfo.nextChunk)) {
+                    fileInfo.nextChunk++;
+                }
+                if (fileInfo.nextChunk < fileInfo.totalChunks) {
+                    return { fileInfo, index: fileInfo.nextChunk++ };
+                }
             }
 
-            if (uploadedChunks.has(i)) {
+            // 正在创建的会话完成后再决定是否开始新文件，分片大小也能参考它之前测得的吞吐量
+            if (opening) {
+                await opening;
                 continue;
             }
 
-            await this.uploadChunk(fileInfo, i);
+            const next = started < this.maxParallelChunks && this.uploadQueue.find(f => f.status === 'pending');
+            if (!next) return null;
+            this.beginFile(next);
+        }
+    }
+
+    beginFile(fileInfo) {
+        fileInfo.startTime = fileInfo.startTime || Date.now();
+        fileInfo.nextChunk = 0;
+        fileInfo.inFlight = 0;
+        this.activeUploads.set(fileInfo.id, fileInfo);
 
-            // 更新进度
-            fileInfo.progress = ((i + 1) / fileInfo.totalChunks) * 100;
-            this.updateFileProgress(fileInfo);
+        if (fileInfo.bundle) {
+            // 打包上传只有一个请求，不需要创建会话
+            fileInfo.chunkSize = fileInfo.size;
+            fileInfo.totalChunks = 1;
+            fileInfo.instantCheck = Promise.resolve(false);
+            fileInfo.status = 'uploading';
+            return;
+        }
+
+        fileInfo.status = 'opening';
+
+        fileInfo.sessionPromise = this.openSession(fileInfo)
+            .then(() => {
+                if (fileInfo.status !== 'opening') return;
+                fileInfo.status = 'uploading';
+                this.updateFileProgress(fileInfo);
+
+                // 续传时分片可能已经全部上传
+                this.checkFileDone(fileInfo);
+            })
+            .catch(error => {
+                if (fileInfo.status !== 'opening') return;
+                fileInfo.status = 'error';
+                this.showToast(`上传失败: ${fileInfo.name} (${error.message})`, 'danger');
+            });
+
+        // 摘要算出后询问服务器是否已有相同内容，有则停止上传分片
+        if (!fileInfo.instantCheck) {
+            fileInfo.instantCheck = fileInfo.digestPromise
+                .then(digest => digest ? this.tryInstantUpload(fileInfo, digest) : false)
+                .catch(() => false)
+                .then(instant => {
+                    if (instant) this.checkFileDone(fileInfo);
+                    return instant;
+                });
+        }
+    }
+
+    async openSession(fileInfo) {
+        const started = Date.now();
+        const response = await fetch(`${this.apiBase}/upload/session`, {
+            method: 'POST',
+            headers: {
+                'Content-Type': 'application/json',
+                'Accept': 'application/json'
+            },
+            body: JSON.stringify({
+                hash: fileInfo.id,
+                filepath: fileInfo.path,
+                filename: fileInfo.name,
+                target_path: fileInfo.targetPath,
+                size: fileInfo.size,
+                chunk_size: this.preferredChunkSize()
+            })
+        });
+
+        if (!response.ok) {
+            const result = await response.json().catch(() => ({}));
+            throw new Error(result.error || `创建上传会话失败: ${response.status}`);
         }
 
-        // 合并分片
-        await this.mergeChunks(fileInfo);
+        const session = await response.json();
+        this.recordLatency(Date.now() - started);
+
+        fileInfo.chunkSize = session.chunk_size;
+        fileInfo.totalChunks = session.total_chunks;
+        fileInfo.ackedChunks = new Set(session.received_chunks);
+        fileInfo.ackedBytes = session.received_bytes;
+        fileInfo.progress = fileInfo.size > 0 ? (fileInfo.ackedBytes / fileInfo.size) * 100 : 0;
+        if (session.max_parallel) {
+            this.maxParallelChunks = session.max_parallel;
+        }
+    }
+
+    // 建议的分片大小：传输约targetChunkSeconds秒，且往返延迟不超过传输时间的10%；还没有测量数据时由服务器决定
+    preferredChunkSize() {
+        if (!this.laneThroughput) return null;
+
+        const byTime = this.laneThroughput * this.targetChunkSeconds;
+        const byLatency = this.laneThroughput * ((this.latencyMs || 0) / 1000) * 10;
+        return Math.round(Math.max(byTime, byLatency));
+    }
+
+    recordLatency(elapsedMs) {
+        this.latencyMs = this.latencyMs === null ? elapsedMs : this.latencyMs * 0.7 + elapsedMs * 0.3;
+    }
+
+    recordChunkTiming(bytes, elapsedMs) {
+        // 小分片的耗时主要是往返延迟，不用来估计吞吐量
+        const latency = this.latencyMs || 0;
+        if (bytes < 256 * 1024 || elapsedMs <= latency) {
+            this.recordLatency(elapsedMs);
+            return;
+        }
+
+        const throughput = bytes / ((elapsedMs - latency) / 1000);
+        this.laneThroughput = this.laneThroughput === null ? throughput : this.laneThroughput * 0.7 + throughput * 0.3;
+    }
+
+    // 文件的分片都已确认（或已秒传）且没有在传输的分片时，开始合并
+    checkFileDone(fileInfo) {
+        if (fileInfo.status !== 'uploading' || fileInfo.inFlight > 0 || fileInfo.cancelled) return;
+        if (!fileInfo.instant && fileInfo.ackedChunks.size < fileInfo.totalChunks) return;
+
+        fileInfo.status = 'merging';
+        const merge = this.completeFile(fileInfo).finally(() => this.pendingMerges.delete(merge));
+        this.pendingMerges.add(merge);
+    }
+
+    async completeFile(fileInfo) {
+        try {
+            if (fileInfo.bundle) {
+                // 服务器接收时已经解包，逐个文件的结果随响应返回
+                const failed = fileInfo.bundleResults.filter(r => !r.success);
+                if (failed.length > 0 && failed.length === fileInfo.bundleResults.length) {
+                    throw new Error(failed[0].error);
+                }
+                if (failed.length > 0) {
+                    this.showToast(`${failed.length} 个文件上传失败，如 ${failed[0].path}: ${failed[0].error}`, 'danger');
+                }
+            } else if (await fileInfo.instantCheck) {
+                // 秒传后仍在传输的分片可能重新建立了暂存区，一并清理
+                await this.cancelFileUpload(fileInfo.id);
+            } else {
+                // 合并分片，服务器用摘要校验文件内容
+                await fileInfo.digestPromise;
+                await this.mergeChunks(fileInfo);
+            }
+        } catch (error) {
+            fileInfo.status = 'error';
+            this.showToast(`上传失败: ${fileInfo.name}`, 'danger');
+            return;
+        }
 
         fileInfo.status = 'completed';
         this.showToast(`上传完成: ${fileInfo.path}`, 'success');
 
         // 从队列移除
+        this.activeUploads.delete(fileInfo.id);
         this.removeFromQueue(fileInfo.id);
 
-        // 刷新文件列表
+        // 取新增的条目更新文件列表（已连接事件流时由服务器推送）
         if (window.fileManager) {
-            window.fileManager.loadFiles(this.currentPath);
+            window.fileManager.syncChanges();
+        }
+    }
+
+    chunkLength(fileInfo, chunkIndex) {
+        const chunkStart = chunkIndex * fileInfo.chunkSize;
+        return Math.max(0, Math.min(fileInfo.chunkSize, fileInfo.size - chunkStart));
+    }
+
+    async uploadChunkWithRetry(fileInfo, chunkIndex) {
+        for (let attempt = 0; ; attempt++) {
+            try {
+                if (fileInfo.bundle) {
+                    return await this.uploadBundle(fileInfo);
+                }
+                return await this.uploadChunk(fileInfo, chunkIndex);
+            } catch (error) {
+                // 4xx表示请求本身有问题，重试也不会成功（超时、限流和分片校验失败除外）；507表示服务器空间不足
+                const retryable = !error.status || (error.status >= 500 && error.status !== 507) || [408, 422, 429].includes(error.status);
+                if (!retryable || attempt >= this.maxChunkRetries || fileInfo.instant || fileInfo.cancelled) {
+                    throw error;
+                }
+
+                // 指数退避并加入随机抖动，避免失败的分片同时重试
+                const delay = this.retryBaseDelay * Math.pow(2, attempt) * (0.5 + Math.random());
+                await new Promise(resolve => setTimeout(resolve, delay));
+            }
         }
     }
 
@@ -609,32 +1013,150 @@ class FileUploader {
         const chunkStart = chunkIndex * fileInfo.chunkSize;
         const chunkEnd = Math.min(chunkStart + fileInfo.chunkSize, fileInfo.size);
         const chunk = fileInfo.file.slice(chunkStart, chunkEnd);
+        const crc = await this.computeChunkCrc(chunk);
+
+        // 分片作为原始请求体发送，服务器不需要解析multipart，直接写到文件的最终偏移处
+        const response = await fetch(`${this.apiBase}/upload/chunk/${encodeURIComponent(fileInfo.id)}/${chunkIndex}`, {
+            method: 'PUT',
+            headers: {
+                'Content-Type': 'application/octet-stream',
+                'X-File-Size': String(fileInfo.size),
+                'X-Chunk-Size': String(fileInfo.chunkSize),
+                'X-Total-Chunks': String(fileInfo.totalChunks),
+                'X-File-Path': encodeURIComponent(fileInfo.path),
+                'X-Target-Path': encodeURIComponent(fileInfo.targetPath),
+                ...(crc ? { 'X-Chunk-Crc32': crc } : {})
+            },
+            body: chunk
+        });
 
-        const formData = new FormData();
-        formData.append('hash', fileInfo.id);
-        formData.append('chunkIndex', chunkIndex);
-        formData.append('totalChunks', fileInfo.totalChunks);
-        formData.append('filename', fileInfo.name);
-        formData.append('filepath', fileInfo.path);
-        formData.append('target_path', this.currentPath);
-        formData.append('chunk', chunk);
+        if (!response.ok) {
+            const result = await response.json().catch(() => ({}));
+            const error = new Error(result.error || `上传分片失败: ${response.status}`);
+            error.status = response.status;
+            throw error;
+        }
 
-        try {
-            const response = await fetch(`${this.apiBase}/upload/chunk`, {
-                method: 'POST',
-                body: formData
-            });
+        return await response.json();
+    }
 
-            if (!response.ok) {
-                const error = await response.json().catch(() => ({}));
-                throw new Error(error.error || `上传分片失败: ${response.status}`);
-            }
+    async tryInstantUpload(fileInfo, digest) {
+        const response = await fetch(`${this.apiBase}/check`, {
+            method: 'POST',
+            headers: {
+                'Content-Type': 'application/json',
+                'Accept': 'application/json'
+            },
+            body: JSON.stringify({
+                hash: fileInfo.id,
+                filepath: fileInfo.path,
+                filename: fileInfo.name,
+                target_path: fileInfo.targetPath,
+                digest: digest,
+                size: fileInfo.size
+            })
+        });
 
-            return await response.json();
+        if (!response.ok) return false;
 
-        } catch (error) {
+        const result = await response.json();
+        if (result.instant) {
+            fileInfo.instant = true;
+            fileInfo.progress = 100;
+            this.updateFileProgress(fileInfo);
+        }
+        return fileInfo.instant;
+    }
+
+    async uploadBundle(fileInfo) {
+        const response = await fetch(`${this.apiBase}/upload/bundle`, {
+            method: 'PUT',
+            headers: {
+                'Content-Type': 'application/x-tar',
+                'X-Target-Path': encodeURIComponent(fileInfo.targetPath)
+            },
+            body: this.buildBundle(fileInfo.bundle)
+        });
+
+        if (!response.ok) {
+            const result = await response.json().catch(() => ({}));
+            const error = new Error(result.error || `上传文件包失败: ${response.status}`);
+            error.status = response.status;
             throw error;
         }
+
+        const result = await response.json();
+        fileInfo.bundleResults = result.results;
+        return result;
+    }
+
+    // 构造tar包：每个文件一个512字节的头，数据补齐到512字节，最后是两个空块
+    // Blob只引用各个File，发送时才读取文件内容
+    buildBundle(items) {
+        const encoder = new TextEncoder();
+        const zeros = new Uint8Array(1024);
+        const padding = size => zeros.subarray(0, (512 - size % 512) % 512);
+        const parts = [];
+
+        for (const item of items) {
+            const name = encoder.encode(item.relativePath);
+            const mtime = Math.floor((item.file.lastModified || Date.now()) / 1000);
+
+            // 路径超过100字节或含非ASCII字符时用PAX扩展头记录完整的UTF-8路径
+            if (name.length > 100 || name.some(b => b > 0x7f)) {
+                const record = this.paxRecord('path', name);
+                parts.push(this.tarHeader(encoder.encode('PaxHeader'), 'x', record.length, mtime), record, padding(record.length));
+            }
+
+            parts.push(this.tarHeader(name, '0', item.file.size, mtime), item.file, padding(item.file.size));
+        }
+
+        parts.push(zeros);
+        return new Blob(parts);
+    }
+
+    tarHeader(name, type, size, mtime) {
+        const header = new Uint8Array(512);
+        const writeOctal = (value, offset, length) => {
+            const text = value.toString(8).padStart(length - 1, '0');
+            for (let i = 0; i < text.length; i++) {
+                header[offset + i] = text.charCodeAt(i);
+            }
+        };
+
+        header.set(name.subarray(0, 100), 0);
+        writeOctal(0o644, 100, 8); // mode
+        writeOctal(0, 108, 8); // uid
+        writeOctal(0, 116, 8); // gid
+        writeOctal(size, 124, 12);
+        writeOctal(mtime, 136, 12);
+        header[156] = type.charCodeAt(0);
+        header.set([0x75, 0x73, 0x74, 0x61, 0x72, 0x00, 0x30, 0x30], 257); // "ustar\0" "00"
+
+        // 校验和按校验和字段为8个空格计算，写成6位八进制数、NUL和空格
+        header.fill(0x20, 148, 156);
+        const checksum = header.reduce((sum, b) => sum + b, 0);
+        writeOctal(checksum, 148, 7);
+        header[154] = 0;
+        return header;
+    }
+
+    // PAX记录格式为 "长度 键=值\n"，长度包含自身的位数
+    paxRecord(key, value) {
+        const encoder = new TextEncoder();
+        const prefix = encoder.encode(` ${key}=`);
+        const body = prefix.length + value.length + 1;
+        let length = body + String(body).length;
+        if (String(length).length + body !== length) {
+            length = String(length).length + body;
+        }
+
+        const record = new Uint8Array(length);
+        record.set(encoder.encode(String(length)), 0);
+        record.set(prefix, String(length).length);
+        record.set(value, String(length).length + prefix.length);
+        record[length - 1] = 0x0a;
+        return record;
     }
 
     async mergeChunks(fileInfo) {
@@ -649,8 +1171,9 @@ class FileUploader {
                     hash: fileInfo.id,
                     filename: fileInfo.name,
                     filepath: fileInfo.path,
-                    target_path: this.currentPath,
-                    totalChunks: fileInfo.totalChunks
+                    target_path: fileInfo.targetPath,
+                    totalChunks: fileInfo.totalChunks,
+                    digest: fileInfo.digest
                 })
             });
 
@@ -693,7 +1216,9 @@ class FileUploader {
         this.isPaused = false;
 
         // 取消所有活跃的上传
-        for (const fileInfo of this.uploadQueue.filter(f => f.status === 'uploading')) {
+        for (const fileInfo of this.uploadQueue.filter(f => ['opening', 'uploading', 'merging'].includes(f.status))) {
+            fileInfo.cancelled = true;
+            this.cancelDigest(fileInfo);
             await this.cancelFileUpload(fileInfo.id);
         }
 
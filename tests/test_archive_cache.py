@@ -0,0 +1,89 @@
+"""文件夹打包缓存：没有inotify监视时，绕过API的修改不能让下载拿到旧内容
+
+运行：python -m unittest discover -s tests
+"""
+import io
+import os
+import sys
+import time
+import shutil
+import tempfile
+import unittest
+import zipfile
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+WORKDIR = tempfile.mkdtemp(prefix='filefly-test-')
+_previous_cwd = os.getcwd()
+
+# app在导入时按当前目录创建uploads等文件夹
+os.chdir(WORKDIR)
+sys.path.insert(0, ROOT)
+import app  # noqa: E402
+
+
+def tearDownModule():
+    os.chdir(_previous_cwd)
+    shutil.rmtree(WORKDIR, ignore_errors=True)
+
+
+class ArchiveCacheExternalEditTest(unittest.TestCase):
+    def setUp(self):
+        self.client = app.app.test_client()
+        self.folder = os.path.join(app.UPLOAD_FOLDER, 'course')
+        os.makedirs(os.path.join(self.folder, 'sub'), exist_ok=True)
+        self.write('top.txt', 'x' * 1000)
+        self.write('sub/notes.txt', 'version-one')
+        self.assertFalse(app.fs_watcher.covers(self.folder))
+
+    def tearDown(self):
+        app.archive_cache.invalidate(self.folder)
+        shutil.rmtree(self.folder, ignore_errors=True)
+
+    def write(self, name, text):
+        # 保证mtime与上一次写入不同
+        time.sleep(0.01)
+        with open(os.path.join(self.folder, name), 'w') as f:
+            f.write(text)
+
+    def download(self, name='sub/notes.txt'):
+        response = self.client.get('/download-folder/course')
+        self.assertEqual(response.status_code, 200)
+        return response, zipfile.ZipFile(io.BytesIO(response.data)).read(name).decode()
+
+    def test_cached_archive_is_served_while_unchanged(self):
+        self.download()
+        response, notes = self.download()
+        self.assertEqual(notes, 'version-one')
+        key = next(iter(app.archive_cache._entries.values()))[0]
+        self.assertEqual(response.headers.get('ETag'), f'"{key}"')
+
+    def test_nested_edit_same_size(self):
+        self.download()
+        self.write('sub/notes.txt', 'version-two')
+        self.assertEqual(self.download()[1], 'version-two')
+
+    def test_nested_edit_new_size(self):
+        self.download()
+        self.write('sub/notes.txt', 'version-three!')
+        self.assertEqual(self.download()[1], 'version-three!')
+
+    def test_edit_during_build_is_not_cached(self):
+        members = app.fingerprint_members
+
+        def edit_after_notes(items, digest):
+            for item in members(items, digest):
+                yield item
+                if item[1] == 'sub/notes.txt':
+                    self.write('top.txt', 'y' * 1000)
+
+        app.fingerprint_members = edit_after_notes
+        try:
+            self.download()
+        finally:
+            app.fingerprint_members = members
+        self.assertFalse(app.archive_cache._entries)
+        self.assertEqual(self.download('top.txt')[1], 'y' * 1000)
+
+
+if __name__ == '__main__':
+    unittest.main()